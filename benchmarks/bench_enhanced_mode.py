@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark for enhanced (dual) mode linescan processing.
+
+Times enhanced_mode.EnhancedModeStage combining a stream of synthetic
+alternating aligned/misaligned frames, and compares it with the previous
+approach of converting each frame to float64 and differencing it with a
+copy of the previous frame. The pybundle processing which follows is not
+included. Results are printed and saved as JSON. If --min-fps is given,
+the script exits with an error if the stage is slower than this.
+
+Run from the benchmarks folder, e.g.
+
+    python bench_enhanced_mode.py --size 1024 --frames 500
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import sys
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from enhanced_mode import EnhancedModeStage
+
+
+def make_frames(size, numDistinct = 8, dtype = 'uint16'):
+    """ Returns a list of synthetic frames alternating between aligned
+    (background plus signal) and misaligned (background only).
+    """
+    rng = np.random.default_rng(0)
+    background = 1000 + 200 * rng.random((size, size))
+    signal = 2000 * rng.random((size, size))
+    frames = []
+    for idx in range(numDistinct):
+        frame = background + rng.normal(0, 20, (size, size))
+        if idx % 2 == 0:
+            frame = frame + signal
+        frames.append(np.clip(frame, 0, np.iinfo(dtype).max).astype(dtype))
+    return frames
+
+
+def legacy_process(state, inputFrame):
+    """ The per-frame differencing previously used in dual mode.
+    """
+    outputFrame = inputFrame
+    if state.get('previousImage') is not None:
+        inputFrame = inputFrame.astype('float64')
+        outputFrame = inputFrame - state['previousImage']
+        if np.min(outputFrame) < - np.max(outputFrame):
+            outputFrame = -1 * outputFrame
+        outputFrame[outputFrame < 0] = 0
+    state['previousImage'] = inputFrame.copy()
+    return outputFrame
+
+
+def bench_stage(frames, numFrames, useFrameNumbers = True):
+    """ Frames per second combined by EnhancedModeStage.
+    """
+    stage = EnhancedModeStage()
+    t0 = time.perf_counter()
+    for idx in range(numFrames):
+        stage.process(frames[idx % len(frames)], idx if useFrameNumbers else None)
+    return numFrames / (time.perf_counter() - t0)
+
+
+def bench_legacy(frames, numFrames):
+    """ Frames per second combined by the previous approach.
+    """
+    state = {}
+    t0 = time.perf_counter()
+    for idx in range(numFrames):
+        legacy_process(state, frames[idx % len(frames)])
+    return numFrames / (time.perf_counter() - t0)
+
+
+def check_agreement(frames):
+    """ Returns the maximum difference between the stage and the previous
+    approach over a few frames.
+    """
+    stage = EnhancedModeStage()
+    state = {}
+    maxDiff = 0
+    for idx, frame in enumerate(frames):
+        new = stage.process(frame)
+        old = legacy_process(state, frame)
+        if new is not None:
+            maxDiff = max(maxDiff, float(np.max(np.abs(new - old))))
+    return maxDiff
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Enhanced mode processing throughput benchmark.")
+    parser.add_argument('--size', type = int, default = 1024, help = "frame width and height (pixels)")
+    parser.add_argument('--frames', type = int, default = 500)
+    parser.add_argument('--min-fps', type = float, help = "fail if the stage is slower than this")
+    parser.add_argument('--output', default = 'enhanced_mode.json', help = "JSON file for results")
+    args = parser.parse_args()
+
+    frames = make_frames(args.size)
+
+    results = {'size': args.size,
+               'frames': args.frames,
+               'stageFps': bench_stage(frames, args.frames),
+               'stageNoFrameNumbersFps': bench_stage(frames, args.frames, False),
+               'legacyFps': bench_legacy(frames, args.frames),
+               'maxDifference': check_agreement(frames)}
+
+    print(f"Enhanced mode stage: {results['stageFps']:.1f} fps "
+          f"({results['stageNoFrameNumbersFps']:.1f} fps without frame numbers)")
+    print(f"Previous approach: {results['legacyFps']:.1f} fps")
+    print(f"Maximum difference: {results['maxDifference']:.3g}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+    if args.min_fps is not None and results['stageFps'] < args.min_fps:
+        print(f"Enhanced mode stage is slower than {args.min_fps} fps.")
+        sys.exit(1)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of real-time mosaicing (mosaic_stage.MosaicStage) for different
+mosaic sizes, using synthetic data (see synthetic.py).
+
+For each mosaic size, a circular field of view is moved in a serpentine
+raster across a textured scene of that size, and each frame is registered
+and blended into the mosaic. The frame rate, the time per frame and the
+tracking error (the largest difference along the path between the position
+found by registration and the true position) are reported, together with
+the number of tiles in memory and on disk. Each size is run:
+    - with all tiles in memory
+    - with at most --max-tiles tiles in memory, others spilled to disk
+    - with each frame repeated --dwell times (a slowly moving probe) and
+      registration skipped for frames with little motion
+
+As positions are found by adding up shifts between frames, small errors in
+each shift can add up along the path, most of all when the probe moves
+slowly. The tracking error is therefore also reported for the smallest
+mosaic size with the probe moving each of --steps pixels per frame.
+
+Results are printed and saved as JSON. The script exits with an error if
+any run is slower than --min-fps.
+
+Run from the benchmarks folder, e.g.
+
+    python bench_mosaic.py --sizes 1000 2000 3000 --output mosaic.json
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import sys
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import synthetic
+from bench_pipeline import summarise, environment
+from mosaic_stage import MosaicStage
+
+
+def bench_mosaic(scene, path, frameSize, dwell = 1, noise = 0, seed = 0, **kwargs):
+    """ Times MosaicStage.process for frames from 'scene' along 'path',
+    each repeated 'dwell' times with Gaussian noise of standard deviation
+    'noise' added. Keyword arguments are passed to MosaicStage.
+    """
+    rng = np.random.default_rng(seed)
+    stage = MosaicStage(**kwargs)
+    times = []
+    trackingError = 0
+    for point, frame in zip(path, synthetic.mosaic_frames(scene, path, frameSize)):
+        truth = np.subtract(point, path[0])
+        for idx in range(dwell):
+            if noise > 0:
+                frame = frame + rng.normal(0, noise, frame.shape).astype('float32')
+            t0 = time.perf_counter()
+            position = stage.process(frame)
+            times.append(time.perf_counter() - t0)
+            if position is None:
+                trackingError = None
+            elif trackingError is not None:
+                trackingError = max(trackingError, float(np.max(np.abs(np.subtract(position, truth)))))
+
+    result = summarise(times)
+    result['fps'] = len(times) / sum(times)
+    result['frames'] = len(times)
+    result['registered'] = stage.numRegistered
+    result['skipped'] = stage.numSkipped
+    result['blended'] = stage.numBlended
+    result['references'] = stage.numReferences
+    result['tilesInMemory'] = len(stage.canvas.tiles)
+    result['tilesOnDisk'] = len(stage.canvas.spilled)
+    result['memoryMB'] = stage.canvas.get_memory() / 2**20
+    result['trackingError'] = trackingError
+
+    t0 = time.perf_counter()
+    stage.get_mosaic((500, 500))
+    result['previewTime'] = time.perf_counter() - t0
+    stage.close()
+    return result
+
+
+def format_error(error):
+    """ Formats a tracking error for printing.
+    """
+    return "reset" if error is None else f"{error:.2f} px"
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Mosaicing benchmark using synthetic data.")
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 2000, 3000], help = "mosaic sizes (pixels)")
+    parser.add_argument('--frame-size', type = int, default = 400, help = "size of processed frames")
+    parser.add_argument('--step', type = int, default = 10, help = "movement per frame (pixels)")
+    parser.add_argument('--steps', type = int, nargs = '+', default = [4, 5, 7, 10], help = "movements per frame for tracking error")
+    parser.add_argument('--max-tiles', type = int, default = 16, help = "tiles in memory for the spill run")
+    parser.add_argument('--dwell', type = int, default = 4, help = "repeats of each frame for the motion skip run")
+    parser.add_argument('--noise', type = float, default = 0.01, help = "noise added to repeated frames")
+    parser.add_argument('--motion-threshold', type = float, default = 0.05)
+    parser.add_argument('--min-fps', type = float, help = "fail if any run is slower than this")
+    parser.add_argument('--output', default = 'mosaic.json', help = "JSON file for results")
+    args = parser.parse_args()
+
+    results = {'environment': environment(),
+               'config': vars(args),
+               'benchmarks': {}}
+    benchmarks = results['benchmarks']
+
+    runs = {'': {},
+            'Spill': {'maxTiles': args.max_tiles},
+            'MotionSkip': {'dwell': args.dwell, 'noise': args.noise, 'motionThreshold': args.motion_threshold}}
+
+    for size in args.sizes:
+        scene = synthetic.textured_scene((size, size))
+        path = synthetic.raster_path(size, args.frame_size, args.step)
+        for name, options in runs.items():
+            key = f"mosaic{size}{name}"
+            benchmarks[key] = bench_mosaic(scene, path, args.frame_size, **options)
+            r = benchmarks[key]
+            print(f"{key}: {r['fps']:.1f} fps, {r['median'] * 1000:.2f} ms median, {r['max'] * 1000:.2f} ms max, "
+                  f"{r['skipped']} skipped, tracking error {format_error(r['trackingError'])}, "
+                  f"{r['tilesInMemory']} tiles in memory ({r['memoryMB']:.0f} MB), {r['tilesOnDisk']} on disk")
+
+    size = min(args.sizes)
+    scene = synthetic.textured_scene((size, size))
+    for step in args.steps:
+        key = f"tracking{size}Step{step}"
+        path = synthetic.raster_path(size, args.frame_size, step)
+        benchmarks[key] = bench_mosaic(scene, path, args.frame_size)
+        r = benchmarks[key]
+        print(f"{key}: {r['frames']} frames, {r['references']} reference frames, "
+              f"tracking error {format_error(r['trackingError'])}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+    failed = False
+    if args.min_fps is not None:
+        for name, r in benchmarks.items():
+            if r['fps'] < args.min_fps:
+                print(f"{name} is slower than {args.min_fps} fps.")
+                failed = True
+
+    sys.exit(1 if failed else 0)
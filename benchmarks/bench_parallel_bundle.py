@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of tile-parallel bundle processing
+(parallel_bundle.ParallelBundleProcessor), using synthetic bundle images
+generated from a bundle background image (see synthetic.py).
+
+The background can be enlarged by --scale to simulate a larger sensor (the
+core size is scaled with it). The time to process each frame with
+PyBundle.process (single core) is compared with ParallelBundleProcessor for
+each number of threads in --threads, and the frame rate and speed-up over
+PyBundle are reported. The output of each is checked against PyBundle.
+
+Requires pybundle. Results are printed and saved as JSON. The script exits
+with an error if the output differs from PyBundle, or if the best speed-up
+is less than --min-speedup.
+
+Run from the benchmarks folder, e.g.
+
+    python bench_parallel_bundle.py --scale 2 --threads 1 2 4 8 16 --output parallel_bundle.json
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import sys
+import os
+import json
+import argparse
+
+import numpy as np
+import cv2 as cv
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import synthetic
+from bench_pipeline import summarise, environment, time_repeats
+from parallel_bundle import ParallelBundleProcessor
+
+
+def bench_frames(process, frames, repeats):
+    """ Returns the times to process each of 'frames', 'repeats' times over.
+    """
+    idx = [0]
+    def process_next():
+        process(frames[idx[0] % len(frames)])
+        idx[0] = idx[0] + 1
+    process_next()
+    return time_repeats(process_next, repeats * len(frames))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Tile-parallel bundle processing benchmark using synthetic data.")
+    parser.add_argument('--background', default = synthetic.DEFAULT_BACKGROUND, help = "bundle background image")
+    parser.add_argument('--scale', type = float, default = 1, help = "enlarge the background by this factor")
+    parser.add_argument('--core-size', type = float, default = 3, help = "core size before scaling")
+    parser.add_argument('--grid-size', type = int, default = 512)
+    parser.add_argument('--filter-size', type = float, help = "pybundle filter size (sigma) before scaling")
+    parser.add_argument('--frames', type = int, default = 4, help = "number of different frames")
+    parser.add_argument('--repeats', type = int, default = 5, help = "times each frame is processed")
+    parser.add_argument('--threads', type = int, nargs = '+', default = [1, 2, 4, 8, 16])
+    parser.add_argument('--min-speedup', type = float, help = "fail if the best speed-up is less than this")
+    parser.add_argument('--output', default = 'parallel_bundle.json', help = "JSON file for results")
+    args = parser.parse_args()
+
+    from pybundle import PyBundle
+
+    background = synthetic.load_background(args.background)
+    if args.scale != 1:
+        background = cv.resize(background, None, fx = args.scale, fy = args.scale, interpolation = cv.INTER_LINEAR)
+    frames = synthetic.bundle_frames(background, numFrames = args.frames)
+    filterSize = args.filter_size * args.scale if args.filter_size is not None else None
+
+    pyb = PyBundle(coreMethod = PyBundle.TRILIN, coreSize = args.core_size * args.scale,
+                   gridSize = args.grid_size, filterSize = filterSize, calibImage = background,
+                   background = background, normaliseImage = background, useNumba = False)
+    pyb.calibrate()
+
+    results = {'environment': environment(),
+               'config': vars(args),
+               'imageShape': list(background.shape),
+               'benchmarks': {}}
+    benchmarks = results['benchmarks']
+
+    benchmarks['pybundle'] = summarise(bench_frames(pyb.process, frames, args.repeats))
+    reference = benchmarks['pybundle']['median']
+    print(f"pybundle ({background.shape[1]} x {background.shape[0]}): {reference * 1000:.1f} ms, {1 / reference:.1f} fps")
+
+    expected = [pyb.process(frame) for frame in frames]
+    failed = False
+    bestSpeedup = 0
+    for numThreads in args.threads:
+        parallel = ParallelBundleProcessor(pyb, numThreads = numThreads)
+        name = f"parallel{numThreads}"
+        r = summarise(bench_frames(parallel.process, frames, args.repeats))
+        r['fps'] = 1 / r['median']
+        r['speedup'] = reference / r['median']
+        r['identical'] = all(np.array_equal(parallel.process(frame), out, equal_nan = True)
+                             for frame, out in zip(frames, expected))
+        parallel.close()
+        benchmarks[name] = r
+        bestSpeedup = max(bestSpeedup, r['speedup'])
+        print(f"{name}: {r['median'] * 1000:.1f} ms, {r['fps']:.1f} fps, speed-up {r['speedup']:.2f}"
+              f"{'' if r['identical'] else ', OUTPUT DIFFERS'}")
+        if not r['identical']:
+            failed = True
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+    if args.min_speedup is not None and bestSpeedup < args.min_speedup:
+        print(f"Speed-up is less than {args.min_speedup}.")
+        failed = True
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the main stages of the endomicroscope pipeline, using
+synthetic data generated from a bundle background image (see synthetic.py).
+
+Times:
+    - calibrate_virtual_slit on a synthetic linescan calibration stack
+    - generation of the scan ramp (scan_waveform), uncached and cached, and
+      starting a scan with the SimulatedScanner as in init_ls_scanning
+    - the pybundle calibration, and end-to-end processing of each frame by
+      EndomicroscopeEngine.process, in normal and enhanced (dual) mode
+
+Processing is only benchmarked if pybundle is installed. The synthetic data
+uses a fixed seed, so results from different runs and machines can be
+compared. Results are printed and saved as JSON, together with details of
+the machine and package versions. If a previous results file is given using
+--baseline, the script exits with an error if the median time of any stage
+has increased by more than --tolerance (a fraction), so that it can be
+used to catch performance regressions. Limits can also be given using
+--max-calibration and --min-fps.
+
+Run from the benchmarks folder, e.g.
+
+    python bench_pipeline.py --output pipeline.json
+    python bench_pipeline.py --baseline pipeline.json --tolerance 0.25
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import sys
+import os
+import json
+import time
+import argparse
+import platform
+import statistics
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import linescan_utilities
+import synthetic
+
+LINE_RATE = 130750.6
+SAMPLE_RATE = 250000
+
+
+def time_repeats(func, repeats, number = 1):
+    """ Calls 'func' 'number' times, 'repeats' times over, and returns the
+    mean time per call (s) of each repeat.
+    """
+    times = []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        for j in range(number):
+            func()
+        times.append((time.perf_counter() - t0) / number)
+    return times
+
+
+def summarise(times):
+
+    return {'median': statistics.median(times),
+            'min': min(times),
+            'max': max(times),
+            'repeats': len(times)}
+
+
+def environment():
+    """ Details of the machine and package versions.
+    """
+    env = {'python': platform.python_version(),
+           'numpy': np.__version__,
+           'platform': platform.platform(),
+           'processor': platform.processor(),
+           'cpuCount': os.cpu_count()}
+    try:
+        import pybundle
+        env['pybundle'] = getattr(pybundle, '__version__', 'unknown')
+    except ImportError:
+        env['pybundle'] = None
+    return env
+
+
+def bench_calibration(stack, volts, repeats = 10):
+    """ Times calibrate_virtual_slit on 'stack'. Also returns the fitted
+    scan parameters and the speed expected from the synthetic data model.
+    """
+    h = np.shape(stack)[0]
+    result = summarise(time_repeats(lambda: linescan_utilities.calibrate_virtual_slit(stack, volts, LINE_RATE), repeats))
+
+    speed, offset, scanRange = linescan_utilities.calibrate_virtual_slit(stack, volts, LINE_RATE)
+    result['speed'] = float(speed)
+    result['offset'] = float(offset)
+    result['range'] = float(scanRange)
+    result['expectedSpeed'] = LINE_RATE * (0.5 - 2.5) / (h - 1)
+    return result
+
+
+def bench_ramp(offset, speed, scanRange, dualOffset = 0.1, repeats = 10, number = 100):
+    """ Times generation of the scan ramp, uncached for a single and dual
+    ramp, and cached.
+    """
+    uncached = linescan_utilities.scan_waveform.__wrapped__
+    results = {}
+    results['scanWaveform'] = summarise(time_repeats(lambda: uncached(offset, speed, scanRange, False, dualOffset, SAMPLE_RATE), repeats, number))
+    results['scanWaveformDual'] = summarise(time_repeats(lambda: uncached(offset, speed, scanRange, True, dualOffset, SAMPLE_RATE), repeats, number))
+
+    linescan_utilities.scan_waveform(offset, speed, scanRange, False, dualOffset, SAMPLE_RATE)
+    results['scanWaveformCached'] = summarise(time_repeats(lambda: linescan_utilities.scan_waveform(offset, speed, scanRange, False, dualOffset, SAMPLE_RATE), repeats, number))
+
+    nPoints = int(linescan_utilities.scan_waveform(offset, speed, scanRange, False, dualOffset, SAMPLE_RATE)[1])
+    results['scanWaveform']['points'] = nPoints
+    results['scanWaveformDual']['points'] = 2 * nPoints
+    return results
+
+
+def bench_start_scanning(engine, offset, speed, scanRange, repeats = 10, number = 100):
+    """ Times setting the scan parameters and starting the scan, as
+    init_ls_scanning does, with the SimulatedScanner.
+    """
+    def start():
+        engine.set_scan_parameters(offset, speed, scanRange)
+        engine.start_scanning()
+    return summarise(time_repeats(start, repeats, number))
+
+
+def bench_processing(engine, frames, numFrames, dualMode = False):
+    """ Times EndomicroscopeEngine.process for each of 'numFrames' frames,
+    cycling through 'frames'. Returns statistics of the time per frame and
+    the frame rate.
+    """
+    engine.dualMode = dualMode
+    engine.enhancedMode.reset()
+    times = []
+    for idx in range(numFrames):
+        t0 = time.perf_counter()
+        engine.process(frames[idx % len(frames)], idx)
+        times.append(time.perf_counter() - t0)
+    engine.dualMode = False
+
+    result = summarise(times)
+    result['fps'] = numFrames / sum(times)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """ Returns a list of messages for each benchmark whose median time has
+    increased by more than 'tolerance' (fraction) relative to 'baseline'.
+    """
+    messages = []
+    for name, stats in results['benchmarks'].items():
+        old = baseline.get('benchmarks', {}).get(name)
+        if old is None:
+            continue
+        if stats['median'] > old['median'] * (1 + tolerance):
+            messages.append(f"{name}: median {stats['median'] * 1000:.3f} ms, baseline {old['median'] * 1000:.3f} ms.")
+    return messages
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Endomicroscope pipeline benchmark using synthetic data.")
+    parser.add_argument('--background', default = synthetic.DEFAULT_BACKGROUND, help = "bundle background image")
+    parser.add_argument('--repeats', type = int, default = 10)
+    parser.add_argument('--frames', type = int, default = 200, help = "number of frames processed")
+    parser.add_argument('--baseline', help = "JSON results to compare with")
+    parser.add_argument('--tolerance', type = float, default = 0.25, help = "allowed fractional increase in time over baseline")
+    parser.add_argument('--max-calibration', type = float, help = "fail if median calibrate_virtual_slit time (s) exceeds this")
+    parser.add_argument('--min-fps', type = float, help = "fail if processing is slower than this")
+    parser.add_argument('--output', default = 'pipeline.json', help = "JSON file for results")
+    args = parser.parse_args()
+
+    background = synthetic.load_background(args.background)
+    volts = np.arange(0, 3, 0.2)
+    stack = synthetic.linescan_stack(background, volts)
+
+    results = {'environment': environment(),
+               'config': {'background': os.path.basename(args.background),
+                          'shape': list(background.shape),
+                          'calibrationImages': len(volts),
+                          'repeats': args.repeats,
+                          'frames': args.frames},
+               'benchmarks': {}}
+    benchmarks = results['benchmarks']
+
+    benchmarks['calibrateVirtualSlit'] = bench_calibration(stack, volts, args.repeats)
+    calib = benchmarks['calibrateVirtualSlit']
+    print(f"calibrate_virtual_slit: {calib['median'] * 1000:.1f} ms "
+          f"(speed {calib['speed']:.1f} V/s, expected {calib['expectedSpeed']:.1f} V/s)")
+
+    offset, speed, scanRange = calib['offset'], -calib['speed'], calib['range']
+    benchmarks.update(bench_ramp(offset, speed, scanRange, repeats = args.repeats))
+    for name in ('scanWaveform', 'scanWaveformDual', 'scanWaveformCached'):
+        print(f"{name}: {benchmarks[name]['median'] * 1e6:.1f} us")
+
+    try:
+        from endomicroscope_engine import EndomicroscopeEngine
+    except ImportError as e:
+        EndomicroscopeEngine = None
+        print(f"Processing not benchmarked ({e}).")
+
+    if EndomicroscopeEngine is not None:
+        engine = EndomicroscopeEngine(scannerType = 'SimulatedScanner')
+
+        benchmarks['startScanning'] = bench_start_scanning(engine, offset, speed, scanRange, args.repeats)
+        print(f"startScanning: {benchmarks['startScanning']['median'] * 1e6:.1f} us")
+
+        engine.set_background(background)
+        engine.pyb.set_core_method(engine.pyb.TRILIN)
+        t0 = time.perf_counter()
+        engine.calibrate_bundle()
+        benchmarks['bundleCalibration'] = summarise([time.perf_counter() - t0])
+        print(f"Bundle calibration: {benchmarks['bundleCalibration']['median']:.2f} s")
+
+        frames = synthetic.bundle_frames(background)
+        engine.process(frames[0])
+        benchmarks['processFrame'] = bench_processing(engine, frames, args.frames)
+        benchmarks['processFrameEnhanced'] = bench_processing(engine, frames, args.frames, dualMode = True)
+        for name in ('processFrame', 'processFrameEnhanced'):
+            print(f"{name}: {benchmarks[name]['median'] * 1000:.2f} ms ({benchmarks[name]['fps']:.1f} fps)")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+    failed = False
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for message in compare(results, baseline, args.tolerance):
+            print("Slower than baseline: " + message)
+            failed = True
+    if args.max_calibration is not None and calib['median'] > args.max_calibration:
+        print(f"calibrate_virtual_slit time exceeds {args.max_calibration} s.")
+        failed = True
+    if args.min_fps is not None and 'processFrame' in benchmarks and benchmarks['processFrame']['fps'] < args.min_fps:
+        print(f"Processing is slower than {args.min_fps} fps.")
+        failed = True
+
+    sys.exit(1 if failed else 0)
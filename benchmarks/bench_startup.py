@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Start-up time benchmark for the Endomicroscope GUI.
+
+Measures, each in a fresh Python process:
+    - the time to import the endomicroscope module
+    - the time from creating the Endomicroscope window to the first frame
+      being displayed, using the Simulated Camera
+
+Results are printed and saved as JSON. If limits are given using
+--max-import or --max-first-frame, the script exits with an error if they
+are exceeded, so that it can be used to catch start-up regressions.
+
+Run from the benchmarks folder, e.g.
+
+    python bench_startup.py --source ../src/background.tif
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import sys
+import os
+import json
+import argparse
+import subprocess
+import statistics
+
+srcPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+# Run in a child process, from the src folder, to time the import
+IMPORT_SCRIPT = """
+import time
+t0 = time.perf_counter()
+import endomicroscope
+print(time.perf_counter() - t0)
+"""
+
+# Run in a child process, from the src folder, to time the first frame.
+# Prints the time taken, or -1 if no frame was displayed before the timeout
+FIRST_FRAME_SCRIPT = """
+import sys
+import time
+t0 = time.perf_counter()
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QTimer
+import endomicroscope
+
+app = QApplication(sys.argv)
+endomicroscope.Endomicroscope.sourceFilename = {source!r}
+window = endomicroscope.Endomicroscope()
+
+result = {{'firstFrame': -1}}
+displayImage = window.update_image_display
+
+def update_image_display():
+    displayImage()
+    if result['firstFrame'] < 0 and (window.currentImage is not None or window.currentProcessedImage is not None):
+        result['firstFrame'] = time.perf_counter() - t0
+        app.quit()
+
+window.update_image_display = update_image_display
+window.show()
+window.camSourceCombo.setCurrentIndex(window.camNames.index('Simulated Camera'))
+window.start_acquire()
+
+QTimer.singleShot(int({timeout} * 1000), app.quit)
+app.exec_()
+window.end_acquire()
+print(result['firstFrame'])
+"""
+
+
+def run_timed(script, repeats):
+    """ Runs 'script' in 'repeats' fresh Python processes from the src folder
+    and returns the times printed on the last line of output.
+    """
+    times = []
+    for i in range(repeats):
+        out = subprocess.run([sys.executable, '-c', script], cwd = srcPath,
+                             capture_output = True, text = True)
+        if out.returncode != 0:
+            print(out.stderr)
+            raise RuntimeError("Benchmark process failed.")
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return times
+
+
+def summarise(times):
+
+    return {'median': statistics.median(times),
+            'min': min(times),
+            'max': max(times),
+            'repeats': len(times)}
+
+
+def bench_import(repeats = 5):
+    """ Time to import the endomicroscope module (s).
+    """
+    return summarise(run_timed(IMPORT_SCRIPT, repeats))
+
+
+def bench_first_frame(source, repeats = 3, timeout = 30):
+    """ Time from start-up to first frame displayed using Simulated Camera
+    with images from 'source' (s).
+    """
+    times = run_timed(FIRST_FRAME_SCRIPT.format(source = os.path.abspath(source), timeout = timeout), repeats)
+    if min(times) < 0:
+        raise RuntimeError("No frame displayed within timeout.")
+    return summarise(times)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Endomicroscope start-up time benchmark.")
+    parser.add_argument('--source', help = "tif file for Simulated Camera, if not given first frame time is not measured")
+    parser.add_argument('--repeats', type = int, default = 5)
+    parser.add_argument('--max-import', type = float, help = "fail if median import time (s) exceeds this")
+    parser.add_argument('--max-first-frame', type = float, help = "fail if median time to first frame (s) exceeds this")
+    parser.add_argument('--output', default = 'startup.json', help = "JSON file for results")
+    args = parser.parse_args()
+
+    results = {'import': bench_import(args.repeats)}
+    print(f"Import: {results['import']['median']:.3f} s")
+
+    if args.source is not None:
+        results['firstFrame'] = bench_first_frame(args.source, args.repeats)
+        print(f"First frame: {results['firstFrame']['median']:.3f} s")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+    failed = False
+    if args.max_import is not None and results['import']['median'] > args.max_import:
+        print(f"Import time exceeds {args.max_import} s.")
+        failed = True
+    if args.max_first_frame is not None and 'firstFrame' in results and results['firstFrame']['median'] > args.max_first_frame:
+        print(f"Time to first frame exceeds {args.max_first_frame} s.")
+        failed = True
+
+    sys.exit(1 if failed else 0)
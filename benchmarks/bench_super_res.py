@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of real-time multi-frame super-resolution
+(super_res_stage.SuperResStage), using synthetic bundle images generated
+from a bundle background image (see synthetic.py) and known shifts.
+
+Times:
+    - the SuperRes calibration, when first made, when the current
+      calibration is reused, and when loaded from a CalibrationStore
+    - reconstruction of a single set
+    - the sustained output rate (sets reconstructed per second) with
+      reconstruction on pools of threads and processes of different sizes,
+      with frames added at --fps (sets are dropped if reconstruction
+      cannot keep up)
+
+Requires pybundle. Results are printed and saved as JSON. The script exits
+with an error if the best output rate is less than --min-rate.
+
+Run from the benchmarks folder, e.g.
+
+    python bench_super_res.py --workers 1 2 4 --output super_res.json
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import sys
+import os
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import synthetic
+from bench_pipeline import summarise, environment, time_repeats
+from super_res_stage import SuperResStage, _reconstruct
+from calibration_store import CalibrationStore, calibration_key
+
+
+def shift_grid(numShifts, step = 1.5):
+    """ Returns 'numShifts' shifts (pixels) on a square grid with spacing
+    'step'.
+    """
+    side = int(np.ceil(np.sqrt(numShifts)))
+    return np.array([[(idx % side) * step, (idx // side) * step] for idx in range(numShifts)])
+
+
+def bench_calibration(background, shifts, coreSize, gridSize):
+    """ Times the first calibration, reuse of the current calibration and
+    loading from a calibration store.
+    """
+    options = {'shifts': shifts, 'background': background, 'normalise': background}
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        store = CalibrationStore(folder)
+        key = calibration_key('benchmark', 'synthetic', 0, 0)
+
+        stage = SuperResStage(len(shifts))
+        t0 = time.perf_counter()
+        stage.calibrate(background, coreSize, gridSize, store = store, key = key, **options)
+        results['srCalibration'] = summarise([time.perf_counter() - t0])
+
+        results['srCalibrationReused'] = summarise(time_repeats(lambda: stage.calibrate(background, coreSize, gridSize, **options), 5))
+
+        def load():
+            SuperResStage(len(shifts)).calibrate(background, coreSize, gridSize, store = store, key = key, **options)
+        results['srCalibrationStored'] = summarise(time_repeats(load, 5))
+
+    return results, stage.calibration
+
+
+def bench_output_rate(calibration, frames, numSets, numWorkers, useProcesses, fps = None):
+    """ Adds frames for 'numSets' sets, at 'fps' or as fast as possible,
+    waits for all reconstructions, and returns the stage statistics.
+    """
+    stage = SuperResStage(calibration.nShifts, numWorkers = numWorkers, useProcesses = useProcesses)
+    stage.set_calibration(calibration)
+    stage.start()
+
+    # Warm up the pool
+    for frameNumber in range(1, calibration.nShifts + 1):
+        stage.add(frames[frameNumber % len(frames)], frameNumber)
+    stage.wait()
+    stage.reset()
+
+    numFrames = numSets * calibration.nShifts
+    t0 = time.perf_counter()
+    for frameNumber in range(1, numFrames + 1):
+        if fps is not None:
+            wait = t0 + frameNumber / fps - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        stage.add(frames[frameNumber % len(frames)], frameNumber)
+        stage.get_result()
+    stage.wait()
+    elapsed = time.perf_counter() - t0
+
+    result = stage.get_stats()
+    result['inputFps'] = numFrames / elapsed
+    result['overallRate'] = result['numReconstructed'] / elapsed
+    stage.stop()
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Super-resolution benchmark using synthetic data.")
+    parser.add_argument('--background', default = synthetic.DEFAULT_BACKGROUND, help = "bundle background image")
+    parser.add_argument('--shifts', type = int, default = 4, help = "number of shifted frames per set")
+    parser.add_argument('--core-size', type = float, default = 3)
+    parser.add_argument('--grid-size', type = int, default = 512)
+    parser.add_argument('--sets', type = int, default = 100, help = "number of sets reconstructed")
+    parser.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4])
+    parser.add_argument('--fps', type = float, default = 400, help = "rate frames are added, 0 for as fast as possible")
+    parser.add_argument('--min-rate', type = float, help = "fail if the best output rate (sets/s) is less than this")
+    parser.add_argument('--output', default = 'super_res.json', help = "JSON file for results")
+    args = parser.parse_args()
+
+    background = synthetic.load_background(args.background)
+    shifts = shift_grid(args.shifts)
+    frames = synthetic.bundle_frames(background, numFrames = args.shifts)
+
+    results = {'environment': environment(),
+               'config': vars(args),
+               'benchmarks': {}}
+    benchmarks = results['benchmarks']
+
+    calibResults, calibration = bench_calibration(background, shifts, args.core_size, args.grid_size)
+    benchmarks.update(calibResults)
+    for name in calibResults:
+        print(f"{name}: {benchmarks[name]['median'] * 1000:.1f} ms")
+
+    stack = np.stack(frames, axis = 2)
+    benchmarks['srReconstruction'] = summarise(time_repeats(lambda: _reconstruct(stack, calibration), 10))
+    print(f"srReconstruction: {benchmarks['srReconstruction']['median'] * 1000:.1f} ms")
+
+    bestRate = 0
+    for useProcesses in (False, True):
+        for numWorkers in args.workers:
+            name = f"srRate{'Processes' if useProcesses else 'Threads'}{numWorkers}"
+            r = bench_output_rate(calibration, frames, args.sets, numWorkers, useProcesses, args.fps or None)
+            benchmarks[name] = r
+            bestRate = max(bestRate, r['overallRate'])
+            print(f"{name}: {r['overallRate']:.1f} sets/s from {r['inputFps']:.0f} frames/s, "
+                  f"{r['numDroppedSets']} sets dropped, mean latency {r['meanLatency'] * 1000:.0f} ms")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+    failed = False
+    if args.min_rate is not None and bestRate < args.min_rate:
+        print(f"Output rate is less than {args.min_rate} sets/s.")
+        failed = True
+
+    sys.exit(1 if failed else 0)
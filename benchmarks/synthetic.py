@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic data for the benchmarks.
+
+Fibre bundle frames are made by multiplying a bundle background image (by
+default src/background.tif) by a smoothly varying random scene. Linescan
+calibration stacks are made by illuminating the background with a
+horizontal line at the row corresponding to each scanner voltage, using the
+same model as SimulatedLinescanCamera. Sequences for mosaicing are made by
+moving a circular field of view across a large textured scene. A fixed
+random seed is used so that the data, and hence the benchmarks, are
+reproducible.
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import os
+
+import numpy as np
+
+srcPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+DEFAULT_BACKGROUND = os.path.join(srcPath, 'background.tif')
+
+
+def load_background(filename = DEFAULT_BACKGROUND):
+    """ Loads a bundle background image as a 2D numpy array.
+    """
+    from PIL import Image
+    return np.array(Image.open(filename))
+
+
+def random_scene(shape, blockSize = 32, seed = 0):
+    """ Returns a smoothly varying random scene of 'shape' with values
+    between 0.2 and 1, with features of roughly 'blockSize' pixels.
+    """
+    rng = np.random.default_rng(seed)
+    h, w = shape
+    coarse = rng.random((h // blockSize + 2, w // blockSize + 2))
+
+    # Bilinear upsampling of the coarse random grid
+    y = np.arange(h) / blockSize
+    x = np.arange(w) / blockSize
+    y0 = y.astype(int)
+    x0 = x.astype(int)
+    fy = (y - y0)[:, None]
+    fx = (x - x0)[None, :]
+    scene = (coarse[y0][:, x0] * (1 - fy) * (1 - fx) + coarse[y0 + 1][:, x0] * fy * (1 - fx)
+             + coarse[y0][:, x0 + 1] * (1 - fy) * fx + coarse[y0 + 1][:, x0 + 1] * fy * fx)
+
+    return 0.2 + 0.8 * scene
+
+
+def textured_scene(shape, seed = 0):
+    """ Returns a float32 random scene of 'shape' with features at several
+    scales, suitable for registration, with values between 0.2 and 1.
+    """
+    scene = np.zeros(shape, dtype = 'float32')
+    for idx, blockSize in enumerate((64, 16, 4)):
+        scene += random_scene(shape, blockSize, seed = seed + idx) / 3
+    return scene
+
+
+def raster_path(size, frameSize, step, overlap = 0.8):
+    """ Returns a list of (y, x) positions of the top left of a field of
+    view of 'frameSize' moving 'step' pixels per frame in a serpentine
+    raster, with rows 'overlap' * 'frameSize' apart, so that the fields
+    cover a square of side 'size'.
+    """
+    rowStep = max(int(frameSize * overlap), 1)
+    last = max(size - frameSize, 0)
+    rows = list(range(0, last + 1, rowStep))
+    if rows[-1] != last:
+        rows.append(last)
+    cols = list(range(0, last + 1, step))
+    path = []
+    for idx, y in enumerate(rows):
+        for x in (cols if idx % 2 == 0 else cols[::-1]):
+            path.append((y, x))
+        # Move down to the next row in steps
+        nextRow = rows[idx + 1] if idx + 1 < len(rows) else y
+        for yStep in range(y + step, nextRow, step):
+            path.append((yStep, path[-1][1]))
+    return path
+
+
+def mosaic_frames(scene, path, frameSize):
+    """ Yields float32 frames of 'frameSize' cropped from 'scene' at each
+    (y, x) in 'path', with a circular mask as for processed bundle images.
+    """
+    y, x = np.mgrid[0:frameSize, 0:frameSize]
+    radius = frameSize / 2 - 2
+    mask = ((y - (frameSize - 1) / 2)**2 + (x - (frameSize - 1) / 2)**2 < radius**2).astype('float32')
+    for y, x in path:
+        yield scene[y:y + frameSize, x:x + frameSize] * mask
+
+
+def bundle_frames(background, numFrames = 8, noise = 1, seed = 0):
+    """ Returns a list of 'numFrames' synthetic bundle images, each the
+    background multiplied by a different random scene plus Gaussian noise,
+    with the same shape and type as the background.
+    """
+    rng = np.random.default_rng(seed)
+    maxVal = np.iinfo(background.dtype).max if np.issubdtype(background.dtype, np.integer) else np.inf
+    frames = []
+    for idx in range(numFrames):
+        frame = background * random_scene(background.shape, seed = seed + idx)
+        frame = frame + rng.normal(0, noise, background.shape)
+        frames.append(np.clip(frame, 0, maxVal).astype(background.dtype))
+    return frames
+
+
+def linescan_stack(background, volts, rowVoltsTop = 2.5, rowVoltsBottom = 0.5,
+                   lineWidth = 2, ambient = 0.02, level = 2000, noise = 10, seed = 0):
+    """ Returns a linescan calibration stack (height, width, image no.) of
+    uint16 images, one for each voltage in 'volts', as acquired with the
+    scanner held at that voltage. The background is scaled so that its mean
+    is 'level'.
+    """
+    rng = np.random.default_rng(seed)
+    h, w = background.shape
+    field = background * (level / np.mean(background))
+    rows = np.arange(h)
+
+    stack = np.empty((h, w, len(volts)), dtype = 'uint16')
+    for idx, v in enumerate(volts):
+        lineRow = (v - rowVoltsTop) / (rowVoltsBottom - rowVoltsTop) * (h - 1)
+        line = np.exp(-(rows - lineRow)**2 / (2 * lineWidth**2))
+        image = field * (ambient + (1 - ambient) * line)[:, None]
+        image = image + rng.normal(0, noise, (h, w))
+        stack[:, :, idx] = np.clip(image, 0, 65535)
+
+    return stack
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated camera which plays back a memory-mapped TIFF file.
+
+Extends the CAS Simulated Camera. Rather than pre-loading the whole file
+into memory, frames of uncompressed TIFF files are read on demand from a
+memory-mapped TiffFrameSource, so that long recordings can be played back
+without a long delay at start-up or running out of memory. Each image is
+a read-only view onto the file where possible, so should not be modified in
+place. Files which cannot be mapped (e.g. compressed TIFFs or videos) are
+loaded by the Simulated Camera as before.
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import time
+
+import numpy as np
+
+from cas_gui.cameras.SimulatedCamera import SimulatedCamera
+
+from tiff_source import TiffFrameSource
+
+
+class MappedFileCamera(SimulatedCamera):
+
+    prefetch = 4               # Number of frames to read ahead
+
+    def __init__(self, **kwargs):
+
+        self.source = None
+        self.dataset = None
+
+        # The file is opened by open_camera, so we do not let SimulatedCamera
+        # open it here
+        filename = kwargs.pop('filename', None)
+        super().__init__(**kwargs)
+        self.filename = filename
+
+
+    def open_camera(self, camID):
+
+        if self.filename is None:
+            return
+
+        try:
+            self.source = TiffFrameSource(self.filename, prefetch = self.prefetch)
+            self.camera_open = True
+        except ValueError:
+            super().open_camera(camID)
+        except OSError:
+            self.camera_open = False
+
+
+    def dispose(self):
+
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        elif self.dataset is not None:
+            super().dispose()
+
+
+    def pre_load(self, nImages):
+
+        # Mapped frames are read on demand, and prefetched, so there is no
+        # need to load them in advance
+        if self.source is None and self.dataset is not None:
+            super().pre_load(nImages)
+
+
+    def has_file(self):
+        """ Returns True if images are coming from a file.
+        """
+        return self.source is not None or self.dataset is not None
+
+
+    def get_file_shape(self):
+        """ Returns the (height, width) of images in the file.
+        """
+        if self.source is not None:
+            return self.source.shape
+        return self.dataset.size[1], self.dataset.size[0]
+
+
+    def frame_due(self):
+        """ Returns True if enough time has passed since the last image to
+        match the frame rate, in which case the frame timing is updated.
+        """
+        if self.fps > 0:
+            desiredWait = 1/self.fps
+        else:
+            desiredWait = 100000
+        currentTime = time.perf_counter()
+        waitNeeded = desiredWait - (currentTime - self.lastImageTimeAdjusted)
+
+        if waitNeeded >= 0:
+            return False
+
+        self.lastImageTime = time.perf_counter()
+
+        # As in SimulatedCamera, keeping the last time minus the wait needed
+        # gives a more accurate frame rate
+        if waitNeeded > -desiredWait:
+            self.lastImageTimeAdjusted = self.lastImageTime - waitNeeded
+        else:
+            self.lastImageTimeAdjusted = self.lastImageTime
+
+        return True
+
+
+    def get_image(self):
+
+        if self.source is None:
+            return super().get_image()
+
+        if not self.frame_due():
+            return None
+
+        if self.currentFrame >= self.source.n_frames:
+            self.currentFrame = 0
+
+        imData = self.source.get_frame(self.currentFrame)
+
+        # Only convert if the file is not already the camera data type, to
+        # avoid a copy
+        if imData.dtype != np.dtype(self.dtype):
+            imData = imData.astype(self.dtype)
+
+        self.currentFrame = self.currentFrame + 1
+        self.actualFrameRate = 1/max(time.perf_counter() - self.lastImageTime, 1e-9)
+
+        return imData
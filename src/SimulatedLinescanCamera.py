@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated rolling shutter camera for virtual slit linescan endomicroscopy.
+
+Extends MappedFileCamera. Each image (loaded from file, or a
+uniform field if no file is given) is illuminated by a line whose position
+is determined by the voltage of a SimulatedScanner, which should be passed
+using set_scanner(). When the scanner is holding a fixed voltage a single
+horizontal line is seen. When it is scanning, each camera row only sees
+light if the line is on that row at the time it is read out, so a correctly
+calibrated scan gives a uniformly illuminated image.
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import time
+
+import numpy as np
+
+from MappedFileCamera import MappedFileCamera
+
+
+class SimulatedLinescanCamera(MappedFileCamera):
+
+    lineRate = 130750.6        # Rolling shutter line rate (Hz)
+    rowVoltsTop = 2.5          # Scanner voltage that puts line on first row
+    rowVoltsBottom = 0.5       # Scanner voltage that puts line on last row
+    lineWidth = 2              # Standard deviation of line (rows)
+    ambient = 0.02             # Fraction of light reaching rows away from line
+    noise = 0                  # Standard deviation of added noise
+    fieldSize = (512, 512)     # Size of uniform field if no file is given
+    fieldLevel = 1000          # Intensity of uniform field
+
+    def __init__(self, **kwargs):
+
+        super().__init__(**kwargs)
+        self.scanner = None
+        self.rng = np.random.default_rng()
+
+
+    def open_camera(self, camID):
+
+        super().open_camera(camID)
+        if not self.has_file():
+            self.camera_open = True
+
+
+    def set_scanner(self, scanner):
+        """ Sets the SimulatedScanner which controls the line position.
+        """
+        self.scanner = scanner
+
+
+    def voltage_to_row(self, volts):
+        """ Returns the row that the line is on for a scanner voltage.
+        """
+        h = self.get_field_shape()[0]
+        return (volts - self.rowVoltsTop) / (self.rowVoltsBottom - self.rowVoltsTop) * (h - 1)
+
+
+    def get_field_shape(self):
+
+        if self.has_file():
+            return self.get_file_shape()
+        else:
+            return self.fieldSize
+
+
+    def get_uniform_field(self):
+        """ Returns a uniform image at the simulated frame rate, or None if
+        it is not yet time for the next image.
+        """
+        if self.fps > 0 and time.perf_counter() - self.lastImageTime < 1 / self.fps:
+            return None
+        self.lastImageTime = time.perf_counter()
+        return np.full(self.fieldSize, self.fieldLevel, dtype = 'float64')
+
+
+    def get_illumination(self, h):
+        """ Returns the relative illumination of each of 'h' rows for the
+        current frame.
+        """
+        rows = np.arange(h)
+
+        if self.scanner is None:
+            return np.ones(h)
+
+        ramp = self.scanner.trigger()
+        if ramp is not None and len(ramp) > 0:
+
+            # Each row sees the voltage output at the time it is read out, after
+            # the end of the ramp the last voltage is held
+            sampleIdx = np.minimum((rows / self.lineRate * self.scanner.sampleRate).astype(int), len(ramp) - 1)
+            lineRow = self.voltage_to_row(ramp[sampleIdx])
+        else:
+            lineRow = self.voltage_to_row(self.scanner.get_voltage())
+
+        line = np.exp(-(rows - lineRow)**2 / (2 * self.lineWidth**2))
+        return self.ambient + (1 - self.ambient) * line
+
+
+    def get_image(self):
+
+        if self.has_file():
+            scene = super().get_image()
+        else:
+            scene = self.get_uniform_field()
+
+        if scene is None:
+            return None
+
+        h = np.shape(scene)[0]
+        image = scene * self.get_illumination(h)[:, None]
+        if self.noise > 0:
+            image = image + self.rng.normal(0, self.noise, np.shape(image))
+
+        return np.clip(image, 0, np.iinfo(self.dtype).max).astype(self.dtype)
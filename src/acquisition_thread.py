@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+CAS image acquisition thread using a preallocated ring buffer.
+
+RingBufferAcquisitionThread is a drop-in replacement for the CAS
+ImageAcquisitionThread which stores frames in a frame_buffer.FrameRingBuffer
+rather than a queue, so that acquiring a frame does not allocate memory or
+pickle the image. get_next_image, get_next_image_wait and get_latest_image
+return read-only views which remain valid until the next call to the same
+method.
+
+If 'recorder' is set to a recorder.FrameRecorder, every frame is also
+queued for recording as it is acquired, together with the frame number and
+the metadata returned by 'frameMetadata(frameNumber)' if this is set.
+
+TaggedAcquisitionThread is a CAS ImageAcquisitionThread which puts
+(frame, frameNumber) in the image queue rather than the frame alone, so
+that the processor knows which camera frame it is processing (see
+EndomicroscopeProcessor). get_next_image and get_next_image_wait return the
+frame alone, as the CAS thread does.
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import time
+
+from cas_gui.threads.image_acquisition_thread import ImageAcquisitionThread
+
+from frame_buffer import FrameRingBuffer
+
+
+class RingBufferAcquisitionThread(ImageAcquisitionThread):
+
+    recorder = None
+    frameMetadata = None
+
+    def __init__(self, camName, bufferSize = 10, acquisitionLock = None, imageQueue = None,
+                 auxillaryQueue = None, cameraID = 0, **camArgs):
+
+        super().__init__(camName, bufferSize, acquisitionLock, imageQueue, auxillaryQueue, cameraID, **camArgs)
+        self.ringBuffer = FrameRingBuffer(bufferSize)
+
+
+    def run(self):
+
+        while self.isOpen:
+
+            if not self.isPaused:
+
+                frame = self.cam.get_image()
+
+                if frame is not None:
+
+                    self.currentFrameNumber = self.currentFrameNumber + 1
+                    self.currentFrameTime = time.perf_counter()
+
+                    self.ringBuffer.put(frame, self.currentFrameTime, self.currentFrameNumber)
+                    self.numDroppedFrames = self.ringBuffer.numDropped + self.ringBuffer.numOverruns
+
+                    recorder = self.recorder
+                    if recorder is not None:
+                        metadata = self.frameMetadata(self.currentFrameNumber) if self.frameMetadata is not None else {}
+                        recorder.put(frame, self.currentFrameTime, frameNumber = self.currentFrameNumber, **metadata)
+
+                    if self.useAuxillaryQueue and (not self.auxillaryQueue.full()):
+                        self.auxillaryQueue.put(frame)
+
+                    self.frameStepTime = self.currentFrameTime - self.lastFrameTime
+                    self.lastFrameTime = self.currentFrameTime
+                else:
+                    time.sleep(0.002)
+            else:
+                time.sleep(0.002)
+
+
+    def get_num_images_in_queue(self):
+
+        return self.ringBuffer.num_waiting()
+
+
+    def get_next_image(self):
+
+        return self.ringBuffer.get_next()
+
+
+    def get_next_image_wait(self, timeout = None):
+
+        return self.ringBuffer.get_next_wait(timeout)
+
+
+    def get_latest_image(self):
+
+        return self.ringBuffer.get_latest()
+
+
+    def flush_buffer(self):
+
+        self.ringBuffer.flush()
+
+
+
+class TaggedAcquisitionThread(ImageAcquisitionThread):
+
+    def run(self):
+
+        while self.isOpen:
+
+            if not self.isPaused:
+
+                # Handles full queue
+                if self.imageQueue.full():
+                    if self.acquisitionLock is not None: self.acquisitionLock.acquire()
+                    for idx in range(self.numRemoveWhenFull):
+                        if self.imageQueue.qsize() > 0:
+                            self.numDroppedFrames += 1
+                            self.imageQueue.get()
+                    if self.acquisitionLock is not None: self.acquisitionLock.release()
+
+                frame = self.cam.get_image()
+
+                if frame is not None:
+
+                    self.currentFrameNumber = self.currentFrameNumber + 1
+                    self.imageQueue.put((frame, self.currentFrameNumber))
+                    if self.useAuxillaryQueue and (not self.auxillaryQueue.full()):
+                        self.auxillaryQueue.put(frame)
+
+                    self.currentFrame = frame
+                    self.currentFrameTime = time.perf_counter()
+                    self.frameStepTime = self.currentFrameTime - self.lastFrameTime
+                    self.lastFrameTime = self.currentFrameTime
+                else:
+                    time.sleep(0.002)
+            else:
+                time.sleep(0.002)
+
+
+    def get_next_image(self):
+
+        im = super().get_next_image()
+        return im[0] if isinstance(im, tuple) else im
+
+
+    def get_next_image_wait(self):
+
+        im = super().get_next_image_wait()
+        return im[0] if isinstance(im, tuple) else im
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming background acquisition using running statistics.
+
+RunningBackground estimates a background image from a stream of frames
+without keeping the frames. The per-pixel mean and variance are updated in
+place in float32 using Welford's method as each frame is added, so the
+memory needed is a few frames whatever the number of frames averaged.
+
+Once a few frames have been added, outliers are rejected:
+    - pixels further than clipSigma standard deviations from the mean
+      (e.g. cosmic rays or hot pixels in a single frame) are not included
+      in the statistics for that pixel
+    - frames with more than maxOutlierFraction of such pixels (e.g. the
+      probe moved or the illumination changed) are rejected entirely
+
+is_converged() returns True once the standard error of the mean is small
+compared with the background level for nearly all pixels, so acquisition
+can stop as soon as the background is good enough rather than after a
+fixed number of frames.
+
+    background = RunningBackground()
+    for frame in frames:
+        background.add(frame)
+        if background.is_converged():
+            break
+    image = background.get_mean()
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import numpy as np
+
+
+class RunningBackground:
+    """ Running per-pixel mean and variance of frames, with outlier
+    rejection.
+
+    Keyword Arguments:
+        clipSigma          : float
+                             pixels further than this many standard
+                             deviations from the mean are rejected,
+                             default 5
+        varianceFloor      : float
+                             pixel variances are taken to be at least this
+                             fraction of the mean variance, so that pixels
+                             whose variance is underestimated from a few
+                             frames are not wrongly rejected, default 0.5
+        minDeviation       : float
+                             pixels closer than this (grey levels) to the
+                             mean are never rejected, default 3
+        maxOutlierFraction : float
+                             frames with more than this fraction of rejected
+                             pixels are rejected, default 0.02
+        warmupFrames       : int
+                             number of frames added before outliers are
+                             rejected, default 5 (at least 2)
+        minFrames          : int
+                             minimum number of frames before the mean can be
+                             converged, default 10
+        tolerance          : float
+                             the mean is converged when the standard error
+                             of the mean is less than this fraction of the
+                             mean background level, default 0.002
+        percentile         : float
+                             percentage of pixels which must meet the
+                             tolerance, default 99
+    """
+
+    def __init__(self, **kwargs):
+
+        self.clipSigma = kwargs.get('clipSigma', 5)
+        self.varianceFloor = kwargs.get('varianceFloor', 0.5)
+        self.minDeviation = kwargs.get('minDeviation', 3)
+        self.maxOutlierFraction = kwargs.get('maxOutlierFraction', 0.02)
+        self.warmupFrames = kwargs.get('warmupFrames', 5)
+        self.minFrames = kwargs.get('minFrames', 10)
+        self.tolerance = kwargs.get('tolerance', 0.002)
+        self.percentile = kwargs.get('percentile', 99)
+        self.reset()
+
+
+    def reset(self):
+        """ Discards all frames added so far.
+        """
+        self.shape = None
+        self.mean = None
+        self.m2 = None
+        self.counts = None
+        self.numFrames = 0
+        self.numAccepted = 0
+        self.numRejected = 0
+        self.numClipped = 0
+        self.lastOutlierFraction = 0
+
+
+    def _allocate(self, shape):
+        self.shape = shape
+        self.mean = np.zeros(shape, dtype = 'float32')
+        self.m2 = np.zeros(shape, dtype = 'float32')
+        self.counts = np.zeros(shape, dtype = 'float32')
+
+        # Working arrays, so that adding a frame does not allocate memory
+        self.delta = np.zeros(shape, dtype = 'float32')
+        self.deviation = np.zeros(shape, dtype = 'float32')
+        self.limit = np.zeros(shape, dtype = 'float32')
+        self.accept = np.zeros(shape, dtype = 'bool')
+
+
+    def add(self, frame):
+        """ Adds a frame. Returns False if the frame was rejected as an
+        outlier.
+        """
+        frame = np.asarray(frame)
+        if self.shape is None or frame.shape != self.shape:
+            self.reset()
+            self._allocate(frame.shape)
+        self.numFrames = self.numFrames + 1
+
+        delta = self.delta
+        np.subtract(frame, self.mean, out = delta, casting = 'unsafe')
+
+        if self.numAccepted >= max(self.warmupFrames, 2):
+            # Pixels are rejected if they are far from the mean compared with
+            # the standard deviation so far
+            np.subtract(self.counts, 1, out = self.limit)
+            np.divide(self.m2, self.limit, out = self.limit)
+            np.maximum(self.limit, self.varianceFloor * float(np.mean(self.limit)), out = self.limit)
+            np.sqrt(self.limit, out = self.limit)
+            np.multiply(self.limit, self.clipSigma, out = self.limit)
+            np.maximum(self.limit, self.minDeviation, out = self.limit)
+            np.abs(delta, out = self.deviation)
+            np.less_equal(self.deviation, self.limit, out = self.accept)
+            numClipped = int(self.accept.size - np.count_nonzero(self.accept))
+            self.lastOutlierFraction = numClipped / self.accept.size
+            if self.lastOutlierFraction > self.maxOutlierFraction:
+                self.numRejected = self.numRejected + 1
+                return False
+            self.numClipped = self.numClipped + numClipped
+            np.multiply(delta, self.accept, out = delta)
+            np.add(self.counts, self.accept, out = self.counts)
+        else:
+            self.lastOutlierFraction = 0
+            np.add(self.counts, 1, out = self.counts)
+
+        # Welford's update, mean += delta / n and m2 += delta * (x - mean),
+        # using the updated mean. Rejected pixels have delta = 0 so are
+        # unchanged.
+        np.divide(delta, self.counts, out = self.limit)
+        np.add(self.mean, self.limit, out = self.mean)
+        np.subtract(frame, self.mean, out = self.limit, casting = 'unsafe')
+        np.multiply(self.limit, delta, out = self.limit)
+        np.add(self.m2, self.limit, out = self.m2)
+
+        self.numAccepted = self.numAccepted + 1
+        return True
+
+
+    def get_mean(self):
+        """ Returns the mean image (float32), or None if no frames have been
+        added.
+        """
+        return self.mean
+
+
+    def get_variance(self):
+        """ Returns the per-pixel (sample) variance, or None if fewer than two
+        frames have been accepted.
+        """
+        if self.numAccepted < 2:
+            return None
+        return self.m2 / np.maximum(self.counts - 1, 1)
+
+
+    def get_standard_error(self):
+        """ Returns the per-pixel standard error of the mean, or None if
+        fewer than two frames have been accepted.
+        """
+        variance = self.get_variance()
+        if variance is None:
+            return None
+        return np.sqrt(variance / np.maximum(self.counts, 1))
+
+
+    def get_relative_error(self):
+        """ Returns the 'percentile' percentile of the standard error of the
+        mean, as a fraction of the mean background level, or None if fewer
+        than two frames have been accepted.
+        """
+        standardError = self.get_standard_error()
+        if standardError is None:
+            return None
+        level = max(float(np.mean(self.mean)), 1e-6)
+        return float(np.percentile(standardError, self.percentile)) / level
+
+
+    def is_converged(self):
+        """ Returns True if at least minFrames frames have been accepted and
+        the relative standard error of the mean is less than tolerance.
+        """
+        if self.numAccepted < max(self.minFrames, 2):
+            return False
+        return self.get_relative_error() < self.tolerance
+
+
+    def get_stats(self):
+        """ Returns a dictionary of frame counts and the relative standard
+        error of the mean.
+        """
+        return {'numFrames': self.numFrames,
+                'numAccepted': self.numAccepted,
+                'numRejected': self.numRejected,
+                'numClippedPixels': self.numClipped,
+                'relativeError': self.get_relative_error(),
+                'converged': self.is_converged()}
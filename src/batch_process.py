@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Offline batch reprocessing of recorded TIFF stacks.
+
+Streams the frames of one or more TIFF stacks (e.g. record_*.tif files
+saved by the GUI), or chunked recordings (folders written by
+recorder.FrameRecorder), through pybundle processing, using the same
+calibration as the GUI (calib.dat, as saved by Save Calibration, and
+background.tif).
+Frames are processed in parallel on a pool of processes but are written
+out in order, as they are completed, to a TIFF stack for each input file.
+Only a limited number of frames are held in memory at once.
+
+Example, from the src folder:
+
+    python batch_process.py data/record_*.tif --workers 8
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import sys
+sys.path.append('..\\..\\cas\\src')
+sys.path.append('..\\..\\pyfibrebundle\\src')
+
+import os
+import glob
+import time
+import argparse
+import collections
+import multiprocessing
+
+import numpy as np
+from PIL import Image, TiffImagePlugin
+
+from endomicroscope_engine import EndomicroscopeEngine
+from tiff_source import TiffFrameSource
+from recorder import ChunkedFrameReader
+
+
+# Each worker process has its own copy of the PyBundle object, set by
+# init_worker
+workerPyb = None
+
+
+def init_worker(pyb):
+    """ Called once in each worker process to store the configured PyBundle.
+    """
+    global workerPyb
+    workerPyb = pyb
+
+
+def process_frame(frame):
+    """ Processes a single frame in a worker process.
+    """
+    return workerPyb.process(frame)
+
+
+def read_frames(filename):
+    """ Generator yielding the frames of a TIFF stack or chunked recording
+    folder one at a time as 2D numpy arrays. Uncompressed TIFFs are
+    memory-mapped, otherwise PIL is used.
+    """
+    if os.path.isdir(filename):
+        with ChunkedFrameReader(filename) as reader:
+            for idx in range(reader.n_frames):
+                yield reader.get_frame(idx)
+        return
+
+    try:
+        source = TiffFrameSource(filename, loop = False)
+    except ValueError:
+        source = None
+
+    if source is not None:
+        with source:
+            for idx in range(source.n_frames):
+                yield source.get_frame(idx)
+        return
+
+    with Image.open(filename) as dataset:
+        for idx in range(getattr(dataset, 'n_frames', 1)):
+            dataset.seek(idx)
+            yield np.array(dataset)
+
+
+def create_engine(calibration = 'calib.dat', background = 'background.tif', method = 'interpolation',
+                  gridSize = None, filterSize = None):
+    """ Returns an EndomicroscopeEngine with pybundle configured in the same
+    way as the GUI. The calibration file is used if it exists, otherwise
+    a calibration is performed using the background.
+    """
+    engine = EndomicroscopeEngine()
+    pyb = engine.pyb
+
+    if background is not None and os.path.exists(background):
+        engine.load_background(background)
+        pyb.set_calib_image(engine.backgroundImage)
+
+    if gridSize is not None:
+        pyb.set_grid_size(gridSize)
+    if filterSize is not None:
+        pyb.set_filter_size(filterSize)
+
+    if method == 'interpolation':
+        pyb.set_core_method(pyb.TRILIN)
+        if calibration is not None and os.path.exists(calibration):
+            engine.load_calibration(calibration)
+        elif engine.backgroundImage is not None:
+            engine.calibrate_bundle()
+        else:
+            raise FileNotFoundError("Interpolation requires a calibration file or a background image.")
+    else:
+        pyb.set_core_method(pyb.FILTER)
+        if engine.backgroundImage is not None:
+            engine.calibrate_bundle()
+
+    pyb.set_output_type('float')
+
+    return engine
+
+
+def process_file(filename, outFilename, pool, maxInFlight = 32, progress = True):
+    """ Processes all frames in the TIFF stack 'filename' using 'pool' and
+    writes the results to 'outFilename' as a float32 TIFF stack, in order.
+    At most 'maxInFlight' frames are queued or being processed at once.
+    Returns the number of frames processed.
+    """
+    inFlight = collections.deque()
+    numFrames = 0
+
+    def write_next(writer):
+        outFrame = inFlight.popleft().get()
+        Image.fromarray(outFrame.astype('float32')).save(writer)
+        writer.newFrame()
+
+    with TiffImagePlugin.AppendingTiffWriter(outFilename, True) as writer:
+        for frame in read_frames(filename):
+            if len(inFlight) >= maxInFlight:
+                write_next(writer)
+            inFlight.append(pool.apply_async(process_frame, (frame,)))
+            numFrames = numFrames + 1
+            if progress and numFrames % 100 == 0:
+                print(f"{filename}: {numFrames} frames")
+        while len(inFlight) > 0:
+            write_next(writer)
+
+    return numFrames
+
+
+def output_filename(filename, outFolder = None, suffix = '_processed'):
+    """ Returns the filename for the processed version of 'filename'.
+    """
+    base, ext = os.path.splitext(os.path.basename(os.path.normpath(filename)))
+    folder = outFolder if outFolder is not None else os.path.dirname(filename)
+    return os.path.join(folder, base + suffix + '.tif')
+
+
+def batch_process(filenames, engine, workers = None, outFolder = None, maxInFlight = None):
+    """ Processes each of the TIFF stacks in 'filenames' using the pybundle
+    settings of 'engine', using a pool of 'workers' processes (default
+    is the number of CPUs). Returns a list of (input, output, number of
+    frames, time) for each file.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if maxInFlight is None:
+        maxInFlight = 4 * workers
+    if outFolder is not None:
+        os.makedirs(outFolder, exist_ok = True)
+
+    results = []
+    with multiprocessing.Pool(workers, initializer = init_worker, initargs = (engine.pyb,)) as pool:
+        for filename in filenames:
+            outFilename = output_filename(filename, outFolder)
+            t0 = time.perf_counter()
+            numFrames = process_file(filename, outFilename, pool, maxInFlight)
+            elapsed = time.perf_counter() - t0
+            results.append((filename, outFilename, numFrames, elapsed))
+            print(f"{filename} -> {outFilename}: {numFrames} frames in {elapsed:.1f} s ({numFrames / max(elapsed, 1e-9):.1f} fps)")
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Reprocess recorded TIFF stacks with pybundle.")
+    parser.add_argument('files', nargs = '+', help = "TIFF stacks or chunked recordings to process, wildcards allowed")
+    parser.add_argument('--calibration', default = 'calib.dat', help = "pybundle calibration file, as saved by the GUI")
+    parser.add_argument('--background', default = 'background.tif', help = "background image")
+    parser.add_argument('--method', choices = ['interpolation', 'filter'], default = 'interpolation')
+    parser.add_argument('--grid-size', type = int, help = "output image size for interpolation")
+    parser.add_argument('--filter-size', type = float, help = "filter size")
+    parser.add_argument('--workers', type = int, help = "number of processes, default is number of CPUs")
+    parser.add_argument('--output-folder', help = "folder for processed files, default is alongside input")
+    args = parser.parse_args()
+
+    filenames = []
+    for pattern in args.files:
+        filenames.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    engine = create_engine(args.calibration, args.background, args.method, args.grid_size, args.filter_size)
+    batch_process(filenames, engine, args.workers, args.output_folder)
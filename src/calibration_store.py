@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk store of calibrations, keyed by probe and camera settings.
+
+Each calibration is an uncompressed .npz file in the store folder, named
+from its key (probe ID, camera, exposure, gain and binning), and can hold
+a pybundle interpolation calibration, a pybundle SuperRes calibration, the
+background image and the virtual slit linescan scan parameters. Only numpy
+arrays are stored, so files are loaded without unpickling. Each file
+records the store format version and a SHA-256 hash of its contents, which
+is checked when it is loaded.
+
+Example:
+
+    store = CalibrationStore('calibrations')
+    key = calibration_key('probe1', 'FlirCamera', 8000, 18)
+    store.save(key, bundleCalibration = pyb.calibration, background = background)
+    record = store.load(key)
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import zipfile
+
+import numpy as np
+
+STORE_VERSION = 1
+
+
+def calibration_key(probe, camera, exposure, gain, binning = 1):
+    """ Returns the key identifying a calibration as a dictionary.
+    """
+    return {'probe': str(probe),
+            'camera': str(camera),
+            'exposure': float(exposure),
+            'gain': float(gain),
+            'binning': int(binning)}
+
+
+def _hash_arrays(arrays):
+    # SHA-256 of the names, types, shapes and contents of a dict of arrays
+    h = hashlib.sha256()
+    for name in sorted(arrays):
+        arr = np.ascontiguousarray(arrays[name])
+        h.update(name.encode())
+        h.update(str(arr.dtype).encode())
+        h.update(str(arr.shape).encode())
+        h.update(arr.data if arr.size > 0 else b'')
+    return h.hexdigest()
+
+
+def calibration_to_arrays(calibration):
+    """ Splits a pybundle BundleCalibration into a dictionary of arrays and a
+    dictionary describing how to restore the other attributes. Attributes
+    which are not arrays, numbers, tuples or None (i.e. the Delaunay
+    triangulation, which is not needed for reconstruction) are not stored.
+    """
+    arrays = {}
+    attributes = {'tuples': [], 'scalars': [], 'none': [], 'omitted': []}
+
+    for name, value in vars(calibration).items():
+        if value is None:
+            attributes['none'].append(name)
+        elif isinstance(value, np.ndarray):
+            arrays[name] = value
+        elif isinstance(value, tuple):
+            arrays[name] = np.asarray(value)
+            attributes['tuples'].append(name)
+        elif isinstance(value, (bool, int, float, str, np.generic)):
+            arrays[name] = np.asarray(value)
+            attributes['scalars'].append(name)
+        else:
+            attributes['omitted'].append(name)
+
+    return arrays, attributes
+
+
+def arrays_to_calibration(arrays, attributes):
+    """ Rebuilds a pybundle BundleCalibration from the output of
+    calibration_to_arrays.
+    """
+    from pybundle import BundleCalibration
+
+    calibration = BundleCalibration()
+    for name, value in arrays.items():
+        if name in attributes['tuples']:
+            value = tuple(value.tolist())
+        elif name in attributes['scalars']:
+            value = value.item()
+        setattr(calibration, name, value)
+    for name in attributes['none'] + attributes['omitted']:
+        setattr(calibration, name, None)
+
+    return calibration
+
+
+class CalibrationStore:
+    """ Folder of calibrations. Raises ValueError when loading a file which
+    fails the integrity check or was written by a newer version.
+
+    Arguments:
+        folder : str
+                 folder for calibration files, created if necessary
+    """
+
+    def __init__(self, folder = 'calibrations'):
+
+        self.folder = folder
+
+
+    def filename(self, key):
+        """ Returns the file used for calibration 'key'.
+        """
+        parts = [key['probe'], key['camera'], f"e{key['exposure']:g}", f"g{key['gain']:g}", f"b{key['binning']}"]
+        name = '_'.join(re.sub(r'[^A-Za-z0-9.\-]+', '-', part) for part in parts)
+        return os.path.join(self.folder, name + '.npz')
+
+
+    def exists(self, key):
+        """ Returns True if there is a calibration stored for 'key'.
+        """
+        return os.path.exists(self.filename(key))
+
+
+    def save(self, key, **items):
+        """ Stores calibration items for 'key'. Items not given are kept from
+        any existing calibration for the key. Items are:
+            bundleCalibration : pybundle BundleCalibration (pyb.calibration)
+            superResCalibration : pybundle BundleCalibration made by
+                                  SuperRes.calib_multi_tri_interp
+            background        : background image as 2D numpy array
+            scanParameters    : (offset, speed, range) of linescan
+        Returns the filename.
+        """
+        try:
+            record = self.load(key) or {}
+        except ValueError:
+            record = {}
+        record.pop('meta', None)
+        record.update({name: value for name, value in items.items() if value is not None})
+
+        arrays = {}
+        meta = {'version': STORE_VERSION,
+                'key': key,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+        if record.get('bundleCalibration') is not None:
+            calibArrays, meta['bundleCalibration'] = calibration_to_arrays(record['bundleCalibration'])
+            arrays.update({'calib/' + name: value for name, value in calibArrays.items()})
+        if record.get('superResCalibration') is not None:
+            calibArrays, meta['superResCalibration'] = calibration_to_arrays(record['superResCalibration'])
+            arrays.update({'srcalib/' + name: value for name, value in calibArrays.items()})
+        if record.get('background') is not None:
+            arrays['background'] = np.asarray(record['background'])
+        if record.get('scanParameters') is not None:
+            arrays['scanParameters'] = np.asarray(record['scanParameters'], dtype = 'float64')
+
+        meta['hash'] = _hash_arrays(arrays)
+        arrays['meta'] = np.array(json.dumps(meta))
+
+        # Write to a temporary file first so an interrupted save does not
+        # leave a corrupt calibration
+        os.makedirs(self.folder, exist_ok = True)
+        filename = self.filename(key)
+        tempFilename = filename + '.tmp'
+        with open(tempFilename, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tempFilename, filename)
+
+        return filename
+
+
+    def load(self, key):
+        """ Returns the calibration for 'key' as a dictionary containing any of
+        'bundleCalibration', 'superResCalibration', 'background' and
+        'scanParameters' that were stored, and 'meta', or None if there is
+        no calibration for 'key'.
+        """
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+
+        try:
+            with np.load(filename, allow_pickle = False) as data:
+                arrays = {name: data[name] for name in data.files}
+            meta = json.loads(str(arrays.pop('meta')))
+        except (OSError, KeyError, zipfile.BadZipFile, json.JSONDecodeError):
+            raise ValueError(f"Calibration {filename} is corrupt.")
+
+        if meta.get('version', 0) > STORE_VERSION:
+            raise ValueError(f"Calibration {filename} is from a newer version (format {meta['version']}).")
+        if _hash_arrays(arrays) != meta.get('hash'):
+            raise ValueError(f"Calibration {filename} is corrupt.")
+
+        record = {'meta': meta}
+        if 'bundleCalibration' in meta:
+            calibArrays = {name[6:]: value for name, value in arrays.items() if name.startswith('calib/')}
+            record['bundleCalibration'] = arrays_to_calibration(calibArrays, meta['bundleCalibration'])
+        if 'superResCalibration' in meta:
+            calibArrays = {name[8:]: value for name, value in arrays.items() if name.startswith('srcalib/')}
+            record['superResCalibration'] = arrays_to_calibration(calibArrays, meta['superResCalibration'])
+        if 'background' in arrays:
+            record['background'] = arrays['background']
+        if 'scanParameters' in arrays:
+            record['scanParameters'] = tuple(arrays['scanParameters'].tolist())
+
+        return record
+
+
+    def list_keys(self):
+        """ Returns the keys of all calibrations in the store.
+        """
+        keys = []
+        if not os.path.isdir(self.folder):
+            return keys
+        for name in sorted(os.listdir(self.folder)):
+            if name.endswith('.npz'):
+                try:
+                    with np.load(os.path.join(self.folder, name), allow_pickle = False) as data:
+                        keys.append(json.loads(str(data['meta']))['key'])
+                except:
+                    print(f"Could not read calibration {name}")
+        return keys
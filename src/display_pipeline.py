@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Preparation of frames for display, away from the GUI thread.
+
+Frames are submitted to a DisplayWorker, which runs in its own thread. The
+worker downsamples the most recently submitted frame to the size of the
+display widget (by averaging blocks of pixels), scales it to 8 bit and
+stores it, ready for the GUI to collect. Only the latest frame is kept, so
+submitting never blocks and frames arriving faster than they can be
+displayed are skipped. The worker renders at most maxFps frames per second,
+independent of the acquisition and processing rates.
+
+Autoscaling is done by AutoScaler, which finds the display range from
+percentiles of a subsample of pixels, rather than the minimum and maximum of
+the full frame. The range is only changed when the new estimate differs
+from the current range by more than a set fraction (hysteresis), so the
+brightness of the display does not flicker from frame to frame.
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import time
+import threading
+
+import numpy as np
+
+
+def decimate(image, maxSize):
+    """ Returns 'image' downsampled by an integer factor, by averaging
+    blocks of pixels, so that it fits within 'maxSize' (height, width). If
+    the image already fits it is returned unchanged. The last few rows and
+    columns are discarded if the image is not a multiple of the factor.
+    """
+    h, w = np.shape(image)[0:2]
+    factor = int(np.ceil(max(h / max(maxSize[0], 1), w / max(maxSize[1], 1))))
+    if factor <= 1:
+        return image
+
+    h, w = h // factor, w // factor
+    blocks = image[:h * factor, :w * factor].reshape((h, factor, w, factor) + np.shape(image)[2:])
+    return blocks.mean(axis = (1, 3), dtype = 'float32')
+
+
+class AutoScaler:
+    """ Autoscaling to 8 bit with hysteresis.
+
+    Keyword Arguments:
+        step          : int
+                        pixel step of subsample used to find range, default 4
+        lowPercentile : float
+                        percentile of subsample mapped to 0, default 0.1
+        highPercentile: float
+                        percentile of subsample mapped to 255, default 99.9
+        hysteresis    : float
+                        the range is only updated when either limit moves by
+                        more than this fraction of the range, default 0.1
+        minRange      : float
+                        minimum difference between limits, default 1
+    """
+
+    def __init__(self, **kwargs):
+
+        self.step = kwargs.get('step', 4)
+        self.lowPercentile = kwargs.get('lowPercentile', 0.1)
+        self.highPercentile = kwargs.get('highPercentile', 99.9)
+        self.hysteresis = kwargs.get('hysteresis', 0.1)
+        self.minRange = kwargs.get('minRange', 1)
+        self.reset()
+
+
+    def reset(self):
+        """ Forgets the current range, so it is set from the next image.
+        """
+        self.lower = None
+        self.upper = None
+        self.numUpdates = 0
+
+
+    def update(self, image):
+        """ Updates the range using 'image' if it has moved by more than the
+        hysteresis. Returns (lower, upper).
+        """
+        sample = image[::self.step, ::self.step]
+        lower, upper = np.percentile(sample, (self.lowPercentile, self.highPercentile))
+        upper = max(upper, lower + self.minRange)
+
+        if self.lower is None:
+            changed = True
+        else:
+            tolerance = self.hysteresis * (self.upper - self.lower)
+            changed = abs(lower - self.lower) > tolerance or abs(upper - self.upper) > tolerance
+
+        if changed:
+            self.lower, self.upper = float(lower), float(upper)
+            self.numUpdates = self.numUpdates + 1
+
+        return self.lower, self.upper
+
+
+    def apply(self, image):
+        """ Returns 'image' scaled to the current range as uint8, updating
+        the range first.
+        """
+        lower, upper = self.update(image)
+        scaled = np.subtract(image, lower, dtype = 'float32')
+        scaled *= 255 / (upper - lower)
+        np.clip(scaled, 0, 255, out = scaled)
+        return scaled.astype('uint8')
+
+
+class DisplayWorker:
+    """ Prepares frames for display in a background thread.
+
+    Keyword Arguments:
+        maxFps     : float
+                     maximum rate at which frames are rendered, default 30
+        maxSize    : (int, int)
+                     size (height, width) frames are downsampled to fit, or
+                     None to not downsample, default (300, 300)
+        autoScaler : AutoScaler
+                     used to scale frames to 8 bit, if None (default) a new
+                     AutoScaler is created
+    """
+
+    def __init__(self, **kwargs):
+
+        self.maxFps = kwargs.get('maxFps', 30)
+        self.maxSize = kwargs.get('maxSize', (300, 300))
+        self.autoScaler = kwargs.get('autoScaler', None) or AutoScaler()
+
+        self.lock = threading.Lock()
+        self.newFrame = threading.Event()
+        self.thread = None
+        self.running = False
+
+        self.pending = None
+        self.pendingId = None
+        self.rendered = None
+        self.renderedId = None
+        self.lastRenderTime = 0
+
+        self.numSubmitted = 0
+        self.numRendered = 0
+        self.numSkipped = 0
+        self.renderTime = 0
+
+
+    def start(self):
+        """ Starts the worker thread.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.running = True
+            self.thread = threading.Thread(target = self._run, daemon = True)
+            self.thread.start()
+
+
+    def stop(self):
+        """ Stops the worker thread.
+        """
+        self.running = False
+        self.newFrame.set()
+        if self.thread is not None:
+            self.thread.join(timeout = 1)
+            self.thread = None
+
+
+    def set_max_size(self, maxSize):
+        """ Sets the size (height, width) that frames are downsampled to fit,
+        or None to not downsample.
+        """
+        self.maxSize = maxSize
+
+
+    def submit(self, image, frameId = None, copy = False):
+        """ Hands a frame to the worker, replacing any frame which has not
+        yet been rendered. Set 'copy' to True if the array may be changed
+        before it is rendered, e.g. a view of the acquisition ring buffer.
+        """
+        if image is None:
+            return
+        if copy:
+            image = np.array(image)
+        with self.lock:
+            if self.pending is not None:
+                self.numSkipped = self.numSkipped + 1
+            self.pending = image
+            self.pendingId = frameId
+            self.numSubmitted = self.numSubmitted + 1
+        self.newFrame.set()
+
+
+    def get_display_image(self):
+        """ Returns (image, frameId) for the most recently rendered frame if
+        it has not already been returned, otherwise (None, None).
+        """
+        with self.lock:
+            image, frameId = self.rendered, self.renderedId
+            self.rendered = None
+            self.renderedId = None
+        return image, frameId
+
+
+    def render(self, image):
+        """ Returns 'image' downsampled and scaled to 8 bit for display.
+        """
+        if np.iscomplexobj(image):
+            image = np.abs(image)
+        if self.maxSize is not None:
+            image = decimate(image, self.maxSize)
+        return self.autoScaler.apply(image)
+
+
+    def _run(self):
+
+        while self.running:
+            self.newFrame.wait(timeout = 0.1)
+
+            # Cap the display rate
+            if self.maxFps is not None and self.maxFps > 0:
+                wait = self.lastRenderTime + 1 / self.maxFps - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+
+            with self.lock:
+                image, frameId = self.pending, self.pendingId
+                self.pending = None
+                self.newFrame.clear()
+            if image is None:
+                continue
+
+            t0 = time.perf_counter()
+            try:
+                rendered = self.render(image)
+            except Exception as e:
+                print(f"Display error: {e}")
+                continue
+            self.lastRenderTime = time.perf_counter()
+            self.renderTime = self.lastRenderTime - t0
+
+            with self.lock:
+                self.rendered = rendered
+                self.renderedId = frameId
+                self.numRendered = self.numRendered + 1
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Closed-loop tracking of virtual slit linescan drift during live imaging.
+
+Galvo and thermal drift slowly move the scanning line away from the rolling
+shutter, so that less light is detected. DriftTracker follows the scan
+offset which gives the most light while imaging continues, rather than
+stopping to rerun the linescan calibration.
+
+The detected intensity falls off either side of the correct offset, so a
+single frame does not give the direction of the error. The tracker
+therefore dithers the offset by a small amount, +dither, -dither, -dither,
++dither, for framesPerPhase frames each, and compares the mean intensity
+of the frames in each phase. The normalised difference is proportional to
+the offset error near the optimum. After each cycle the offset is moved
+towards the optimum by at most maxStep, and never by more than
+maxCorrection from the offset it started from (e.g. the calibration), in
+which case 'saturated' is set, suggesting a recalibration. Cycles in which
+the scene changed (the two blocks of frames with the same dither differ by
+more than maxSceneChange) are discarded.
+
+Writing an offset briefly stops the scanner output (see
+scanners.NIDAQScanner), and a camera trigger arriving then gets no ramp.
+Dithering therefore stops once a cycle finds the offset to be within
+'deadband' of the optimum: the undithered offset is written once and then
+held, with no further writes, so the frame rate is not reduced while it is
+held. While the offset is held, the mean intensity of each block of framesPerPhase frames
+is compared with the first, and dithering resumes if it falls by more than
+maxIntensityDrop (as drift, or a change of scene, would cause), or in any
+case after holdFrames frames. Frames taken within settleFrames of a write,
+or repeated frames, are ignored.
+
+Intensities are the means of decimated frames. The offset moves the line
+relative to the rolling shutter by the same amount for every row, so an
+offset error dims all rows equally, and the row profile gives no more
+information about it than its mean.
+
+The time spent by the tracker, including writing new offsets, is measured,
+and if it exceeds 'budget' seconds per frame, only every frameStride'th
+frame is analysed, so that tracking does not hold up the processing of
+frames.
+
+    tracker = DriftTracker(offset, engine.apply_scan_offset)
+    for frame, frameNumber in frames:
+        tracker.add(frame, frameNumber)
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import time
+
+import numpy as np
+
+
+class DriftTracker:
+    """ Tracks the scan offset giving the most light, see module docstring.
+
+    Arguments:
+        offset          : float
+                          starting scan offset (V)
+        setOffset       : callable
+                          setOffset(volts) writes a new scan offset to the
+                          scanner, and returns the number of the most recent
+                          camera frame, or None if not known
+
+    Keyword Arguments:
+        dither          : float
+                          offset dither (V), default 0.003
+        gain            : float
+                          offset step (V) per unit normalised intensity
+                          difference, default 0.02
+        maxStep         : float
+                          maximum change of offset per cycle (V), default
+                          0.002
+        maxCorrection   : float
+                          maximum total change from the starting offset (V),
+                          default 0.1
+        framesPerPhase  : int
+                          frames averaged for each dither phase, default 8
+        settleFrames    : int
+                          frames ignored after each offset change, default 1
+        maxSceneChange  : float
+                          maximum fractional change of intensity between
+                          blocks of frames with the same dither, default
+                          0.05
+        deadband        : float
+                          dithering stops when the estimated offset
+                          correction for a cycle is less than this (V),
+                          default 0.0003
+        holdFrames      : int
+                          analysed frames after which dithering resumes,
+                          default 2000
+        maxIntensityDrop: float
+                          fractional fall in intensity while the offset is
+                          held at which dithering resumes, default 0.05
+        maxPixels       : int
+                          frames are decimated to no more than this many
+                          pixels, default 16384
+        budget          : float
+                          maximum mean time (s) spent per frame, default
+                          0.0005
+        maxStride       : int
+                          maximum frameStride, default 16
+    """
+
+    # Dither sign for each phase of a cycle
+    phases = (1, -1, -1, 1)
+
+    def __init__(self, offset, setOffset, **kwargs):
+
+        self.setOffset = setOffset
+        self.dither = kwargs.get('dither', 0.003)
+        self.gain = kwargs.get('gain', 0.02)
+        self.maxStep = kwargs.get('maxStep', 0.002)
+        self.maxCorrection = kwargs.get('maxCorrection', 0.1)
+        self.framesPerPhase = kwargs.get('framesPerPhase', 8)
+        self.settleFrames = kwargs.get('settleFrames', 1)
+        self.maxSceneChange = kwargs.get('maxSceneChange', 0.05)
+        self.deadband = kwargs.get('deadband', 0.0003)
+        self.holdFrames = kwargs.get('holdFrames', 2000)
+        self.maxIntensityDrop = kwargs.get('maxIntensityDrop', 0.05)
+        self.maxPixels = kwargs.get('maxPixels', 16384)
+        self.budget = kwargs.get('budget', 0.0005)
+        self.maxStride = kwargs.get('maxStride', 16)
+        self.reset(offset)
+
+
+    def reset(self, offset):
+        """ Starts tracking again from 'offset' (V), e.g. after the scan
+        parameters have been changed or recalibrated. The offset is not
+        written to the scanner until the next frame is added.
+        """
+        self.startOffset = offset
+        self.offset = offset
+        self.correction = 0
+        self.saturated = False
+        self.decimation = None
+        self.phase = 0
+        self.phaseSums = np.zeros(len(self.phases))
+        self.phaseCounts = np.zeros(len(self.phases), dtype = int)
+        self.holding = False
+        self.holdLevel = None
+        self.holdSum = 0
+        self.holdCount = 0
+        self.numHeld = 0
+        self.changeFrame = None
+        self.writtenOffset = None
+        self.numWrites = 0
+        self.lastFrameNumber = None
+        self.frameStride = 1
+        self.totalTime = 0
+        self.maxTime = 0
+        self.numFrames = 0
+        self.numAnalysed = 0
+        self.numCycles = 0
+        self.numRejected = 0
+        self.numHolds = 0
+        self.lastError = None
+
+
+    def _write_offset(self, frameNumber):
+        # Writes the offset, with the dither for the current phase unless it
+        # is held, if it differs from the voltage already being output
+        volts = self.offset
+        if not self.holding:
+            volts = volts + self.phases[self.phase] * self.dither
+        if volts == self.writtenOffset:
+            return
+        latest = self.setOffset(volts)
+        self.writtenOffset = volts
+        self.numWrites = self.numWrites + 1
+        self.changeFrame = latest if latest is not None else frameNumber
+
+
+    def add(self, frame, frameNumber):
+        """ Adds a raw frame with camera frame number 'frameNumber'. Returns
+        True if the (undithered) offset was changed.
+        """
+        if self.lastFrameNumber is not None and frameNumber <= self.lastFrameNumber:
+            return False
+        self.lastFrameNumber = frameNumber
+        self.numFrames = self.numFrames + 1
+
+        if self.changeFrame is None:
+            t0 = time.perf_counter()
+            self._write_offset(frameNumber)
+            self._account(time.perf_counter() - t0)
+            return False
+
+        if frameNumber <= self.changeFrame + self.settleFrames or self.numFrames % self.frameStride != 0:
+            return False
+
+        t0 = time.perf_counter()
+        changed = self._analyse(frame, frameNumber)
+        self._account(time.perf_counter() - t0)
+        return changed
+
+
+    def _analyse(self, frame, frameNumber):
+
+        if self.decimation is None:
+            self.decimation = max(int(np.ceil(np.sqrt(np.size(frame) / self.maxPixels))), 1)
+        intensity = np.mean(frame[::self.decimation, ::self.decimation])
+        self.numAnalysed = self.numAnalysed + 1
+
+        if self.holding:
+            self._check_hold(intensity, frameNumber)
+            return False
+
+        self.phaseSums[self.phase] = self.phaseSums[self.phase] + intensity
+        self.phaseCounts[self.phase] = self.phaseCounts[self.phase] + 1
+        if self.phaseCounts[self.phase] < self.framesPerPhase:
+            return False
+
+        # Move to the next phase, and at the end of a cycle update the
+        # offset, and hold it if it was close enough to the optimum
+        changed = False
+        self.phase = (self.phase + 1) % len(self.phases)
+        if self.phase == 0:
+            step = self._update_offset()
+            changed = step is not None and step != 0
+            if step is not None and abs(step) < self.deadband:
+                self._hold()
+        self._write_offset(frameNumber)
+        return changed
+
+
+    def _hold(self):
+        # Stops dithering, the undithered offset is then written once
+        self.holding = True
+        self.holdLevel = None
+        self.holdSum = 0
+        self.holdCount = 0
+        self.numHeld = 0
+        self.numHolds = self.numHolds + 1
+
+
+    def _check_hold(self, intensity, frameNumber):
+        # Resumes dithering if the intensity has fallen since the offset was
+        # held, or the offset has been held for holdFrames frames
+        self.numHeld = self.numHeld + 1
+        self.holdSum = self.holdSum + intensity
+        self.holdCount = self.holdCount + 1
+        resume = self.numHeld >= self.holdFrames
+        if self.holdCount >= self.framesPerPhase:
+            level = self.holdSum / self.holdCount
+            self.holdSum = 0
+            self.holdCount = 0
+            if self.holdLevel is None:
+                self.holdLevel = level
+            elif level < (1 - self.maxIntensityDrop) * self.holdLevel:
+                resume = True
+        if resume:
+            self.holding = False
+            self.phase = 0
+            self._write_offset(frameNumber)
+
+
+    def _update_offset(self):
+        # Returns the step in the offset at the end of a cycle, or None if
+        # the cycle was not used
+
+        means = self.phaseSums / self.phaseCounts
+        self.phaseSums[:] = 0
+        self.phaseCounts[:] = 0
+        self.numCycles = self.numCycles + 1
+
+        level = np.mean(means)
+        if level <= 0:
+            return None
+        if abs(means[0] - means[3]) > self.maxSceneChange * level or abs(means[1] - means[2]) > self.maxSceneChange * level:
+            self.numRejected = self.numRejected + 1
+            return None
+
+        plus = means[np.array(self.phases) > 0].mean()
+        minus = means[np.array(self.phases) < 0].mean()
+        self.lastError = float((plus - minus) / (plus + minus))
+        step = float(np.clip(self.gain * self.lastError, -self.maxStep, self.maxStep))
+
+        correction = np.clip(self.correction + step, -self.maxCorrection, self.maxCorrection)
+        self.saturated = bool(abs(correction) >= self.maxCorrection)
+        step = float(correction - self.correction)
+        self.correction = float(correction)
+        self.offset = float(self.startOffset + self.correction)
+        return step
+
+
+    def _account(self, elapsed):
+        # Adjusts the fraction of frames analysed to keep within the budget
+        self.totalTime = self.totalTime + elapsed
+        self.maxTime = max(self.maxTime, elapsed)
+        meanTime = self.totalTime / self.numFrames
+        if meanTime > self.budget and self.frameStride < self.maxStride:
+            self.frameStride = self.frameStride + 1
+        elif meanTime < self.budget / 2 and self.frameStride > 1:
+            self.frameStride = self.frameStride - 1
+
+
+    def get_stats(self):
+        """ Returns a dictionary describing the tracking.
+        """
+        return {'offset': self.offset,
+                'correction': self.correction,
+                'saturated': self.saturated,
+                'lastError': self.lastError,
+                'numFrames': self.numFrames,
+                'numAnalysed': self.numAnalysed,
+                'numCycles': self.numCycles,
+                'numRejected': self.numRejected,
+                'holding': self.holding,
+                'numHolds': self.numHolds,
+                'numWrites': self.numWrites,
+                'frameStride': self.frameStride,
+                'meanTimePerFrame': self.totalTime / self.numFrames if self.numFrames > 0 else 0,
+                'maxTime': self.maxTime}
@@ -11,43 +11,99 @@ virtual slit linescan systems.
 
 import sys 
 import os
+import time
+import threading
 sys.path.append('..\\..\\cas\\src')
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
 sys.path.append('..\\..\\pyfibrebundle\\src')
 
-import time
-import numpy as np
-import math
-import pickle
-import threading
-
-import matplotlib.pyplot as plt
-from PIL import Image
-import cv2 as cv
-import logging
-
-from PyQt5 import QtGui, QtCore, QtWidgets
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
-from PyQt5.QtWidgets import *
-from PyQt5.QtGui import QPalette, QColor, QImage, QPixmap, QPainter, QPen, QGuiApplication, QIcon
-from PyQt5.QtGui import QPainter, QBrush, QPen
-
-try:
-    import nidaqmx
-    from nidaqmx import stream_writers
-except:
-    pass    
+from PyQt5.QtGui import QIcon
 
-import pybundle
-from pybundle import PyBundle
-from pybundle import SuperRes
+# Only modules needed to start the GUI should be imported here. Anything
+# only used by optional features (e.g. nidaqmx, see scanners) is imported 
+# when first needed, to keep start-up fast.
 
 from cas_gui.subclasses.cas_bundle import CAS_GUI_Bundle
-from cas_gui.threads.bundle_processor import BundleProcessor
 
-import linescan_utilities
+from endomicroscope_engine import EndomicroscopeEngine
+from endomicroscope_processor import EndomicroscopeProcessor
+from acquisition_thread import TaggedAcquisitionThread
+from calibration_store import CalibrationStore, calibration_key
+from display_pipeline import DisplayWorker, AutoScaler
+
 
+class LSCalibrationThread(QThread):
+    """ Runs the linescan calibration (EndomicroscopeEngine.calibrate_ls) 
+    so that the GUI remains responsive. 'progress' is emitted with the 
+    progress dictionary after each step, and 'calibrated' with the scan
+    parameters (or None) when the calibration ends. Call cancel() to stop
+    the calibration at the next step.
+    """
+    
+    progress = pyqtSignal(dict)
+    calibrated = pyqtSignal(object)
+    
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+        self.cancelEvent = threading.Event()
+        
+        
+    def run(self):
+        try:
+            scanParameters = self.engine.calibrate_ls(progress = self.progress.emit, cancel = self.cancelEvent)
+        except Exception as e:
+            print(f"Linescan calibration failed: {e}")
+            scanParameters = None
+        self.calibrated.emit(scanParameters)
+        
+        
+    def cancel(self):
+        self.cancelEvent.set()
+        
+        
+        
+class BackgroundThread(QThread):
+    """ Acquires a background (EndomicroscopeEngine.acquire_background)
+    from the auxillary queue of the image acquisition thread, so that the
+    GUI remains responsive and processing continues. The auxillary queue
+    must be in use before the thread is started. 'acquired' is emitted
+    with the background image (or None) when it ends.
+    """
+    
+    acquired = pyqtSignal(object)
+    
+    def __init__(self, engine, imageThread, numFrames, maxTime):
+        super().__init__()
+        self.engine = engine
+        self.imageThread = imageThread
+        self.numFrames = numFrames
+        self.maxTime = maxTime
+        
+        
+    def run(self):
+        try:
+            background = self.engine.acquire_background(numFrames = self.numFrames, 
+                                                        maxTime = self.maxTime,
+                                                        getImage = self.get_image)
+        except Exception as e:
+            print(f"Background acquisition failed: {e}")
+            background = None
+        self.acquired.emit(background)
+        
+        
+    def get_image(self, timeout):
+        # The CAS auxillary queue cannot be waited on, so poll
+        deadline = time.perf_counter() + timeout
+        while True:
+            frame = self.imageThread.get_next_auxillary_image()
+            if frame is not None or time.perf_counter() >= deadline:
+                return frame
+            time.sleep(0.001)
+        
+        
 
 class Endomicroscope(CAS_GUI_Bundle):
     
@@ -55,22 +111,45 @@ class Endomicroscope(CAS_GUI_Bundle):
     appName = "Endomicroscope"
     windowTitle = "Kent Endomicroscope"
     resPath = "../../cas/res"
+    processor = EndomicroscopeProcessor
     
     # If Simulated Camera is chosen, this is the source file:
     #sourceFilename = r"C:\Users\AOG\OneDrive - University of Kent\Experimental\Endomicroscopy\Example Videos\leaf widefield\leaf.tif"
     sourceFilename = r"C:\Users\mrh40\Dropbox\Programming\Python\endomicroscope\dev\data\record_2024_06_07_15_04_29.tif"
+    
+    # Camera class used for Simulated Camera. MappedFileCamera plays back
+    # the source file from a memory map rather than loading it all first.
+    simulatedCamera = 'MappedFileCamera'
     rawImageBufferSize = 10
     imageDisplaySize = 300
     controlPanelSize = 250
     mosaicingEnabled = False
     manualImageTransfer = False
     
+    # Frames are downsampled to the display size and autoscaled in a 
+    # background thread, at up to displayMaxFps
+    displayDecimation = True
+    displayMaxFps = 30
+    
+    # Recordings are written by a background thread (see recorder), to a
+    # chunked compressed folder, or a tif if 'Record Tif' is checked. Set 
+    # False to use CAS recording (tif or avi)
+    backgroundRecording = True
+    recordQueueSize = 256
+    
     # Set True for Virtual Slit LineScan
     ls = False             
         
+    # Scanner for virtual slit linescan, a class from scanners. Use 
+    # 'SimulatedScanner' together with the SimulatedLinescanCamera to test
+    # without hardware.
+    scannerType = 'NIDAQScanner'
+    
     # DAQ fo virtual slit linescan
     lsAOChannel= "Dev1/ao0"
     lsCtrChannel = "Dev1/ctr0"
+    lsTriggerChannel = "/Dev1/PFI0"
+    lsClockSource = "/Dev1/Ctr0InternalOutput"
         
     # Virtual slit linescan calibration values
     lsCalibMinV = 0
@@ -78,21 +157,55 @@ class Endomicroscope(CAS_GUI_Bundle):
     lsCalibStepV = 0.2
     lsCalibExposure = 8000
     lsCalibGain = 18
+    lsCalibTolerance = 0.01    # Stop calibration once speed is known to this fraction
+    lsCalibMinLines = 4        # and at least this many lines have been found
+    lsCalibSettleTimeout = 0.5 # Maximum wait for scanner to settle at each step (s)
     lsOffsetTweak = -0.03
     lineRate = 130750.6
+    sampleRate = 250000        # Max rate of DAQ
+    lsUpdateDelay = 50         # Delay to coalesce scan parameter changes (ms)
+    
+    # Backgrounds are averaged over up to backgroundFrames frames, with 
+    # outliers rejected, stopping once the mean has converged or after
+    # backgroundMaxTime (s), see background_stats. Set backgroundFrames to 1
+    # to use the current image, as CAS does.
+    backgroundFrames = 100
+    backgroundMaxTime = 5
+    
+    # Calibrations are stored for each probe and camera settings
+    probeID = "default"
+    binning = 1
+    calibrationFolder = "calibrations"
     
     
     def __init__(self,parent=None):
      
+        self.lastAcquiredFrame = None
+        self.lastDisplayedFrame = None
+        self.processedFrame = None
+        self.displayWorker = None
+        self.recorder = None
+        self.lsCalibThread = None
+        self.backgroundThread = None
+        self.calibrateAfterBackground = False
+        
         super(Endomicroscope, self).__init__(parent)    
         
-        try:
-            self.load_calibration()
-        except:
-            pass
+        if getattr(self, 'engine', None) is None:
+            self.engine = self.create_engine()
+        self.calibrationStore = CalibrationStore(self.calibrationFolder)
+        
+        self.load_stored_calibration()
         
         
     
+    def load_camera_names(self):
+        """ Uses simulatedCamera in place of the CAS Simulated Camera.
+        """
+        super().load_camera_names()
+        self.camSources = [self.simulatedCamera if source == 'SimulatedCamera' else source for source in self.camSources]
+        
+        
     def create_layout(self):
         """ Creates the GUI by creating widgets or calling functions which
         create widgets.
@@ -110,8 +223,17 @@ class Endomicroscope(CAS_GUI_Bundle):
             self.lsPanel = self.create_ls_panel()
        
               
-        self.mainDisplay.set_auto_scale(True)
-        self.mainDisplay.minAutoscaleUpper = 20
+        self.metricsMenuButton = self.create_menu_button("Metrics", QIcon(os.path.join(self.resPath, 'icons', 'eye_white.svg')), self.metrics_menu_button_clicked, True, True, 9)
+        self.metricsPanel = self.create_metrics_panel()
+              
+        if self.displayDecimation:
+            self.mainDisplay.set_auto_scale(False)
+            self.displayWorker = DisplayWorker(maxFps = self.displayMaxFps,
+                                               autoScaler = AutoScaler(minRange = 20))
+            self.displayWorker.start()
+        else:    
+            self.mainDisplay.set_auto_scale(True)
+            self.mainDisplay.minAutoscaleUpper = 20
         
         
     # Control options for virtual slit linescan
@@ -151,7 +273,17 @@ class Endomicroscope(CAS_GUI_Bundle):
         self.lsFixedVoltageInput.setMinimum(-10)
         self.lsFixedVoltageInput.setMaximum(10)
         
+        # Corrects the scan offset for drift during live imaging
+        self.lsDriftCheck = QCheckBox("Drift Tracking", objectName = "lsDriftCheck")
+        
+        self.lsCalibProgress = QProgressBar()
+        self.lsCalibProgress.setVisible(False)
+        self.lsCalibStatusLabel = QLabel("")
+        self.lsCalibStatusLabel.setWordWrap(True)
+        
         layout.addWidget(self.lsCalibBtn)
+        layout.addWidget(self.lsCalibProgress)
+        layout.addWidget(self.lsCalibStatusLabel)
         layout.addWidget(QLabel("Scan Speed (V/s):"))
         layout.addWidget(self.lsScanSpeedInput)
         layout.addWidget(QLabel("Scan Offset (V):"))
@@ -164,6 +296,12 @@ class Endomicroscope(CAS_GUI_Bundle):
         layout.addWidget(self.lsDualCheck)
         layout.addWidget(QLabel("Enhanced Offset (V):"))
         layout.addWidget(self.lsDualOffsetInput)
+        layout.addWidget(self.lsDriftCheck)
+
+        # Shows the maximum frame rate for the scan and any timing problems
+        self.lsTimingLabel = QLabel("")
+        self.lsTimingLabel.setWordWrap(True)
+        layout.addWidget(self.lsTimingLabel)
 
         self.lsScanSpeedInput.valueChanged[float].connect(self.scanning_parameters_changed)
         self.lsScanOffsetInput.valueChanged[float].connect(self.scanning_parameters_changed)
@@ -176,116 +314,217 @@ class Endomicroscope(CAS_GUI_Bundle):
         self.lsDualCheck.stateChanged.connect(self.scanning_parameters_changed)
         self.lsDualOffsetInput.valueChanged[float].connect(self.scanning_parameters_changed)
         
+        self.lsDriftCheck.stateChanged.connect(self.drift_tracking_changed)
+        
+        # Used to coalesce rapid changes of the scanning parameters
+        self.lsUpdateTimer = QTimer()
+        self.lsUpdateTimer.setSingleShot(True)
+        self.lsUpdateTimer.timeout.connect(self.init_ls_scanning)
+        
         return widget
     
     
     def ls_menu_button_clicked(self):
         self.expanding_menu_clicked(self.lsMenuButton, self.lsPanel)
+        
+        
+    def create_metrics_panel(self):
+        """ Panel showing frame rates, latencies and counters from the 
+        engine's PipelineMetrics.
+        """
+        widget, layout = self.panel_helper(title = "Metrics")
+        
+        self.metricsLabel = QLabel("")
+        self.metricsLabel.setWordWrap(True)
+        self.metricsSaveBtn = QPushButton('Save Metrics')
+        self.metricsResetBtn = QPushButton('Reset Metrics')
+        
+        layout.addWidget(self.metricsLabel)
+        layout.addWidget(self.metricsSaveBtn)
+        layout.addWidget(self.metricsResetBtn)
+        
+        self.metricsSaveBtn.clicked.connect(self.save_metrics_clicked)
+        self.metricsResetBtn.clicked.connect(self.engine_metrics().reset)
+        
+        self.metricsTimer = QTimer()
+        self.metricsTimer.timeout.connect(self.update_metrics_display)
+        self.metricsTimer.start(1000)
+        
+        return widget
+    
+    
+    def metrics_menu_button_clicked(self):
+        self.expanding_menu_clicked(self.metricsMenuButton, self.metricsPanel)
+        
+        
+    def engine_metrics(self):
+        """ Returns the PipelineMetrics of the engine. The panel is created 
+        before the engine, so the engine is created here if necessary.
+        """
+        if getattr(self, 'engine', None) is None:
+            self.engine = self.create_engine()
+        return self.engine.metrics
+        
+        
+    def update_metrics_display(self):
+        
+        self.metricsLabel.setText(self.engine_metrics().summary_text())
+        
+        
+    def save_metrics_clicked(self):
+        
+        filename = QFileDialog.getSaveFileName(self, 'Save Metrics', 'metrics.json', filter = 'JSON (*.json);;CSV (*.csv)')[0]
+        if filename != "":
+            self.engine_metrics().export(filename)
             
     
     def scanning_parameters_changed(self, event):
-        """ Called when any options on the linescan control panel are changed"""
-        self.init_ls_scanning()
+        """ Called when any options on the linescan control panel are changed. 
+        Changes are coalesced so that dragging a control does not reconfigure
+        the scanner on every step.
+        """
+        self.lsUpdateTimer.start(self.lsUpdateDelay)
         
 
     def init_ls_scanning(self):
         """ For virtual slit linescan, sets up DAQ to generate ramp voltage on 
-        galvos, triggered by strobe from camera
+        galvos, triggered by strobe from camera. If the DAQ tasks are already
+        set up for a ramp of the same length, only the new voltages are 
+        written.
         """
         
-        lineRate = 130750.6      # Camera line rate parameter
+        self.lsUpdateTimer.stop()
+        
+        # The calibration controls the scanner until it finishes
+        if self.is_calibrating_ls():
+            return
+        
         if self.imageProcessor is not None:
             self.imageProcessor.dualMode = self.lsDualCheck.isChecked()
+            
+        self.engine.set_scan_parameters(self.lsScanOffsetInput.value(),
+                                        self.lsScanSpeedInput.value(),
+                                        self.lsScanRangeInput.value(),
+                                        self.lsDualCheck.isChecked(),
+                                        self.lsDualOffsetInput.value())
         
         if self.camOpen is True:
-            # Stop tasks
-            try:                
-                self.aoTask.close()
-                self.ctrTask.close()
-                self.aoTask.stop()
-                self.ctrTask.stop()
-                self.aoTask.clear()
-                self.ctrTask.clear()
-            except:
-                print("Could not dispose of old task.")
             
             # lsFixedCheck is an option for the user to fix a voltage
             # rather than scanning, for debug purposes
             if self.lsFixedCheck.isChecked() is False:  
-     
-                self.sampleRate = 250000   # Max rate of DAQ
-                offset = self.lsScanOffsetInput.value()
-                scanSpeed = self.lsScanSpeedInput.value()
-                scanRange = self.lsScanRangeInput.value()    
-                
-                if scanSpeed > 0:
-                    nPoints = np.abs(int(scanRange / scanSpeed * self.sampleRate))
-                else:
-                    nPoints = 1
-                print(nPoints)    
-                vals = np.linspace(offset, offset + scanRange, nPoints)
-        
-                #self.lsDualOffset = 0.01
-                #self.lsDualMode = False
-                if self.lsDualCheck.isChecked():
-                    offsetVals = vals + self.lsDualOffsetInput.value()
-                    vals = np.concatenate((vals, offsetVals))
-                
-                self.aoTask = nidaqmx.Task()
-                self.ctrTask = nidaqmx.Task() 
-              
-                self.aoTask.ao_channels.add_ao_voltage_chan("dev1/ao0")
-
-                        
-                # Create a counter task that will be triggered by PFI0
-                self.ctrTask.co_channels.add_co_pulse_chan_freq("dev1/ctr0", freq = self.sampleRate)
-                self.ctrTask.timing.cfg_implicit_timing(samps_per_chan = nPoints)
-                self.ctrTask.triggers.start_trigger.cfg_dig_edge_start_trig("/dev1/PFI0", trigger_edge = nidaqmx.constants.Edge.FALLING)
-                self.ctrTask.triggers.start_trigger.retriggerable = True
-                
-                # Set the AO clock source to be the counter clock output so that it will be triggered by PFI0
-                self.aoTask.timing.cfg_samp_clk_timing(self.sampleRate, sample_mode = nidaqmx.constants.AcquisitionType.CONTINUOUS, samps_per_chan = nPoints, source = "/dev1/Ctr0InternalOutput")
-                #self.aoTask.timing.cfg_samp_clk_timing(self.sampleRate, sample_mode = nidaqmx.constants.AcquisitionType.CONTINUOUS, source = "/Dev1/Ctr0InternalOutput")
-                
-              
-                writer = nidaqmx.stream_writers.AnalogSingleChannelWriter(self.aoTask.out_stream)
-                
-                # Send voltage values
-                writer.write_many_sample(vals)
-              
-                self.aoTask.start()
-                self.ctrTask.start()
-                # Make sure to start aotask first in case it misses some points
-                 
-                
-               # except:
-                #    QMessageBox.about(self, "Error", "Unable to connect to scanner.")
-            
+                self.engine.start_scanning()
+                self.update_scan_timing_label()
             else:
                 self.ls_fixed_voltage(self.lsFixedVoltageInput.value())
 
 
+    def drift_tracking_changed(self):
+        """ Starts or stops correcting the scan offset for drift, when the
+        Drift Tracking box is checked or unchecked.
+        """
+        if getattr(self, 'engine', None) is None:
+            self.engine = self.create_engine()
+        if self.lsDriftCheck.isChecked():
+            self.engine.enable_drift_tracking()
+        else:
+            self.engine.disable_drift_tracking()
+            
+            
+    def track_drift(self, frameNumber):
+        """ Passes the latest raw image to the engine drift tracker and shows
+        any new scan offset, without rescanning.
+        """
+        if self.currentImage is None or self.is_calibrating_ls() or self.lsFixedCheck.isChecked():
+            return
+        if self.engine.track_drift(self.currentImage, frameNumber):
+            self.lsScanOffsetInput.blockSignals(True)
+            self.lsScanOffsetInput.setValue(self.engine.scanOffset)
+            self.lsScanOffsetInput.blockSignals(False)
+            
+    
+    def update_scan_timing_label(self):
+        """ Shows the maximum frame rate for the current ramp, and any scan
+        timing errors and warnings, in the Line Scanning panel.
+        """
+        report = self.engine.scanTiming
+        if report is None:
+            return
+        text = f"Max frame rate: {report['maxFrameRate']:.1f} Hz"
+        for message in report['errors']:
+            text = text + f"<br><b>{message}</b>"
+        for message in report['warnings']:
+            text = text + "<br>" + message
+        self.lsTimingLabel.setText(text)
 
 
+    def create_engine(self):
+        """ Creates the headless engine which handles scanning and linescan
+        calibration, with settings from this class.
+        """
+        engine = EndomicroscopeEngine(scannerType = self.scannerType,
+                                      lineRate = self.lineRate,
+                                      sampleRate = self.sampleRate,
+                                      aoChannel = self.lsAOChannel,
+                                      ctrChannel = self.lsCtrChannel,
+                                      triggerSource = self.lsTriggerChannel,
+                                      clockSource = self.lsClockSource)
+        for attr in ['lsCalibMinV', 'lsCalibMaxV', 'lsCalibStepV', 'lsCalibExposure',
+                     'lsCalibGain', 'lsCalibTolerance', 'lsCalibMinLines', 
+                     'lsCalibSettleTimeout', 'lsOffsetTweak']:
+            setattr(engine, attr, getattr(self, attr))
+        return engine
+    
+    
     def stop_ls(self):
         """ Stops the galvo scanner"""
-        try:
-            self.aoTask.close()
-        except:
-            print("Could not close DAQ AO")
-        
-        try: 
-            self.ctrTask.close()
-        except:
-            print("Could not close DAQ Counter")
+        self.engine.stop_scanning()
 
         
     def start_acquire(self):
-        """ In addition to the super class acquisition, also starts the galvo
-        scanner if we are doing line scanning
+        """ Begins acquiring images as the super class, but using a
+        TaggedAcquisitionThread so that each processed image carries the
+        number of the camera frame it came from (imageId). Also starts the
+        galvo scanner if we are doing line scanning.
         """
-        super().start_acquire()
+        self.camSource = self.camSources[self.camSourceCombo.currentIndex()]
+        self.camType = self.camTypes[self.camSourceCombo.currentIndex()]
+
+        if self.camType == self.SIM_TYPE:
+            
+            # If we are using a simulated camera, ask for a file if not hard-coded
+            if self.sourceFilename is None:
+                filename = QFileDialog.getOpenFileName(filter  = '*.tif')[0]
+                if filename != "":
+                    self.sourceFilename = filename
+
+            if self.sourceFilename is not None:
+                self.imageThread = TaggedAcquisitionThread(self.camSource, self.rawImageBufferSize, self.acquisitionLock, 
+                                                           imageQueue = self.inputQueue, filename = self.sourceFilename)
+                self.imageThread.get_camera().pre_load(-1)
+        else:
+            self.imageThread = TaggedAcquisitionThread(self.camSource, self.rawImageBufferSize, self.acquisitionLock, 
+                                                       imageQueue = self.inputQueue, cameraID = self.cameraIDSpin.value())
+            
+        if self.imageThread is not None:
+            
+            self.cam = self.imageThread.get_camera()
+    
+            if self.cam is not None and self.cam.camera_open:
+                self.camOpen = True
+                self.update_camera_from_GUI()
+                self.update_camera_ranges()
+                self.update_image_display()
+                self.imageThread.start()       
+                self.GUITimer.start(self.GUIupdateInterval)
+                self.imageTimer.start(self.imagesUpdateInterval)
+                self.liveButton.setChecked(True)
+            else:
+                QMessageBox.about(self, "Error", "Unable to connect to camera, check connections.")   
+                self.liveButton.setChecked(False)
+                
         if self.ls is True:
+            self.engine.attach_camera(self.imageThread)
             self.init_ls_scanning()
         
     
@@ -294,70 +533,441 @@ class Endomicroscope(CAS_GUI_Bundle):
         scanner if we are doing line scanning
         """
         if self.ls is True:
+            self.cancel_calibrate_ls()
             self.stop_ls()
+        self.wait_background()
         super().end_acquire()
         
         
+    def closeEvent(self, event):
+        """ In addition to the super class close, cancels any linescan
+        calibration and stops the display and mosaic workers.
+        """
+        self.cancel_calibrate_ls()
+        self.wait_background()
+        super().closeEvent(event)
+        if self.displayWorker is not None:
+            self.displayWorker.stop()
+        if self.imageProcessor is not None:
+            self.imageProcessor.get_processor().mosaic.stop()
+        
+        
+    def start_recording(self):
+        """ If backgroundRecording is True, starts recording raw or processed
+        frames using a recorder.FrameRecorder created by the engine, otherwise
+        uses the super class recording. Buffered recording always uses the
+        super class.
+        """
+        if not self.backgroundRecording or self.recordBufferCheck.isChecked():
+            return super().start_recording()
+        
+        self.recordRaw = self.recordRawCheck.isChecked() or self.imageProcessor is None
+        if self.recordRaw and self.imageThread is None:
+            QMessageBox.about(self, "Error", "Images not being acquired.")
+            return
+        
+        recordFormat = 'tif' if self.recordTifCheck.isChecked() else 'chunked'
+        self.recordFilename = os.path.join(self.recordFolder, time.strftime('record_%Y_%m_%d_%H_%M_%S'))
+        if recordFormat == 'tif':
+            self.recordFilename = self.recordFilename + '.tif'
+            
+        self.recordBuffered = False
+        self.numFramesRecorded = 0
+        self.recorder = self.engine.create_recorder(self.recordFilename, format = recordFormat,
+                                                    queueSize = self.recordQueueSize)
+        self.recorder.start()
+        
+        if self.recordRaw:
+            # Frames are taken from the auxillary queue on every timer tick, 
+            # so it only needs to hold the frames acquired in between
+            self.imageThread.set_auxillary_queue_size(self.recordQueueSize)
+            self.imageThread.flush_auxillary_buffer()
+            self.imageThread.set_use_auxillary_queue(True)
+        
+        self.recording = True
+        self.toggleRecordButton.setText("Stop Recording")
+        self.recordRawCheck.setEnabled(False)
+        self.recordFolderButton.setEnabled(False)
+        
+        
+    def record(self):
+        """ Passes all new frames to the recorder if there is one, 
+        otherwise uses the super class recording.
+        """
+        if self.recorder is None:
+            return super().record()
+        
+        if self.recordRaw:
+            self.record_raw_frames()
+        elif self.gotProcessedImage and self.currentProcessedImage is not None:
+            self.recorder.put(self.currentProcessedImage, **self.engine.get_frame_metadata())
+        
+        stats = self.recorder.get_stats()
+        self.numFramesRecorded = stats['numWritten']
+        self.recordStatusLabel.setText(f"Recorded {stats['numWritten']} frames, {stats['queueFill']} waiting, {stats['numDropped']} dropped.")
+        if stats['error'] is not None:
+            self.stop_recording()
+            self.recordStatusLabel.setText(f"Recording stopped: {stats['error']}")
+            
+            
+    def record_raw_frames(self):
+        """ Passes all frames waiting in the auxillary queue to the recorder.
+        The CAS acquisition thread does not store frame numbers, so these are
+        estimated from the number of frames waiting.
+        """
+        numWaiting = self.imageThread.get_num_images_in_auxillary_queue()
+        frameNumber = self.imageThread.currentFrameNumber - numWaiting
+        while True:
+            im = self.imageThread.get_next_auxillary_image()
+            if im is None:
+                break
+            frameNumber = frameNumber + 1
+            self.recorder.put(im, copy = False, frameNumber = frameNumber, **self.engine.get_frame_metadata(frameNumber))
+            
+            
+    def stop_recording(self):
+        """ Stops the recorder, waiting for queued frames to be written, if
+        there is one, otherwise uses the super class.
+        """
+        if self.recorder is None:
+            return super().stop_recording()
+        
+        if self.recordRaw and self.imageThread is not None:
+            self.record_raw_frames()
+            self.imageThread.set_use_auxillary_queue(False)
+        stats = self.recorder.stop()
+        self.recorder = None
+        
+        metrics = self.engine_metrics()
+        metrics.set_count('recordedFrames', stats['numWritten'])
+        metrics.set_count('recordDroppedFrames', stats['numDropped'])
+        
+        self.recording = False
+        self.videoOut = None
+        self.toggleRecordButton.setText("Start Recording")
+        self.recordRawCheck.setEnabled(True)
+        self.recordFolderButton.setEnabled(True)
+        self.recordStatusLabel.setText(f"Recorded {stats['numWritten']} frames, {stats['numDropped']} dropped.")
+        
+    
+    def acquire_background(self):
+        """ Acquires a background averaged over a stream of frames, with
+        outliers rejected, see EndomicroscopeEngine.acquire_background. This
+        runs in a BackgroundThread, using frames from the auxillary queue so
+        that processing is not interrupted, and the background is applied by
+        acquire_background_finished. Uses the super class (current image)
+        if backgroundFrames is 1 or the camera is not running. Returns True
+        if the background was acquired now.
+        """
+        if self.backgroundFrames <= 1 or self.imageThread is None or self.camOpen is not True:
+            super().acquire_background()
+            return True
+        
+        if self.is_acquiring_background():
+            return False
+        
+        # The auxillary queue is used by recording
+        if self.recording:
+            QMessageBox.about(self, "Error", "Stop recording before acquiring a background.")
+            self.calibrateAfterBackground = False
+            return False
+        
+        self.engine.attach_camera(self.imageThread)
+        self.imageThread.set_auxillary_queue_size(self.rawImageBufferSize)
+        self.imageThread.flush_auxillary_buffer()
+        self.imageThread.set_use_auxillary_queue(True)
+        
+        self.backgroundThread = BackgroundThread(self.engine, self.imageThread, 
+                                                 self.backgroundFrames, self.backgroundMaxTime)
+        self.backgroundThread.acquired.connect(self.acquire_background_finished)
+        self.backgroundThread.start()
+        return False
+    
+    
+    def is_acquiring_background(self):
+        """ Returns True if a background is being acquired in a
+        BackgroundThread.
+        """
+        return self.backgroundThread is not None and self.backgroundThread.isRunning()
+    
+    
+    def wait_background(self):
+        """ Waits for any background acquisition to finish (at most
+        backgroundMaxTime).
+        """
+        if self.backgroundThread is not None:
+            self.backgroundThread.wait()
+        
+        
+    def acquire_background_finished(self, background):
+        """ Applies the background acquired by the BackgroundThread, and
+        calibrates if this was requested by global_calibrate.
+        """
+        self.backgroundThread = None
+        if self.imageThread is not None and not self.recording:
+            self.imageThread.set_use_auxillary_queue(False)
+        calibrate = self.calibrateAfterBackground
+        self.calibrateAfterBackground = False
+        
+        stats = self.engine.backgroundStats
+        if background is None:
+            QMessageBox.about(self, "Error", "Unable to acquire a background image.")
+            return
+        print(f"Background: {stats['numAccepted']} frames averaged in {stats['elapsed']:.2f} s, "
+              f"{stats['numRejected']} rejected, {stats['numClippedPixels']} outlier pixels.")
+        self.backgroundImage = background
+        self.backgroundSource = f"Averaged {stats['numAccepted']} frames at {time.strftime('%Y-%m-%d %H:%M:%S')}."
+        self.processing_options_changed()
+        
+        if calibrate:
+            self.handle_calibrate()
+            self.store_calibration()
+        
+        
     def global_calibrate(self):
         """ Acquires a background image and then call the calibrate function
-        of pyfibrebundle.
+        of pyfibrebundle. If the background is acquired in a BackgroundThread,
+        calibration is done when it has finished.
         """
-        self.acquire_background()
-        self.handle_calibrate()
+        if self.is_acquiring_background():
+            return
+        self.calibrateAfterBackground = True
+        if self.acquire_background():
+            self.calibrateAfterBackground = False
+            self.handle_calibrate()
+            self.store_calibration()
         
         
    
     def calibrate_ls(self, event):
         """ Determines the galvo scanning speed and offset so that the scanning
-        line is aligned with the camera rolling shutter """
+        line is aligned with the camera rolling shutter. The calibration runs
+        in an LSCalibrationThread, and the scan parameters are applied when 
+        it finishes. If a calibration is already running, it is cancelled.
+        """
+        if self.is_calibrating_ls():
+            self.cancel_calibrate_ls(wait = False)
+            return
         
+        if self.camOpen is not True:
+            return
         
-        # Grab a series of images at different galvo voltages
-        testV = np.arange(self.lsCalibMinV, self.lsCalibMaxV, self.lsCalibStepV)
-        testIm = self.get_single_image(exposure = self.lsCalibExposure, gain = self.lsCalibGain)
-
-        im = np.zeros((np.shape(self.currentImage)[0], np.shape(self.currentImage)[1],np.shape(testV)[0] ))
-        for i, v in enumerate(testV):
-            self.ls_fixed_voltage(v)
-            time.sleep(0.1)
-            im[:,:, i] = self.get_single_image(exposure = self.lsCalibExposure, gain = self.lsCalibGain)
-
-        speed, offset, scanRange = linescan_utilities.calibrate_virtual_slit(im, testV, self.lineRate)
+        self.lsUpdateTimer.stop()
+        self.lsCalibBtn.setText("Cancel Calibration")
+        self.lsCalibProgress.setValue(0)
+        self.lsCalibProgress.setVisible(True)
+        self.lsCalibStatusLabel.setText("Calibrating...")
+        
+        self.lsCalibThread = LSCalibrationThread(self.engine)
+        self.lsCalibThread.progress.connect(self.calibrate_ls_progress)
+        self.lsCalibThread.calibrated.connect(self.calibrate_ls_finished)
+        self.lsCalibThread.start()
+        
+        
+    def is_calibrating_ls(self):
+        """ Returns True if a linescan calibration is running.
+        """
+        return self.lsCalibThread is not None and self.lsCalibThread.isRunning()
         
-        self.lsScanSpeedInput.setValue(-speed)
-        self.lsScanOffsetInput.setValue(offset + self.lsOffsetTweak)
-        self.lsScanRangeInput.setValue(scanRange)
+        
+    def cancel_calibrate_ls(self, wait = True):
+        """ Cancels a running linescan calibration. If 'wait' is True, 
+        returns once the calibration thread has finished.
+        """
+        if self.lsCalibThread is not None:
+            self.lsCalibThread.cancel()
+            if wait:
+                self.lsCalibThread.wait()
+        
+        
+    def calibrate_ls_progress(self, progress):
+        """ Shows the progress of the linescan calibration, called after each
+        step.
+        """
+        self.lsCalibProgress.setMaximum(progress['numSteps'])
+        self.lsCalibProgress.setValue(progress['step'])
+        text = f"{progress['volts']:.2f} V, {progress['numLines']} lines found"
+        if progress['uncertainty'] is not None:
+            speed = progress['scanParameters'][0]
+            text = text + f", speed {-speed:.1f} ± {progress['uncertainty'][0]:.1f} V/s"
+        self.lsCalibStatusLabel.setText(text)
+        
+        
+    def calibrate_ls_finished(self, scanParameters):
+        """ Applies the scan parameters found by the linescan calibration and
+        restarts scanning.
+        """
+        self.lsCalibThread.wait()
+        self.lsCalibBtn.setText("Auto Calibration")
+        self.lsCalibProgress.setVisible(False)
+        
+        if self.engine.lsCalibCancelled:
+            self.lsCalibStatusLabel.setText("Calibration cancelled.")
+        elif scanParameters is None:
+            self.lsCalibStatusLabel.setText("")
+            QMessageBox.about(self, "Error", "Unable to find the scan line, check the laser is on.")
+        else:
+            offset, speed, scanRange = scanParameters
+            self.lsCalibStatusLabel.setText(f"Calibrated in {len(self.engine.lsCalibTimings)} steps.")
+            self.lsScanSpeedInput.setValue(speed)
+            self.lsScanOffsetInput.setValue(offset)
+            self.lsScanRangeInput.setValue(scanRange)
+            self.store_calibration()
 
-        self.init_ls_scanning()
-        self.update_camera_from_GUI()
+        if self.camOpen is True:
+            self.init_ls_scanning()
+            self.update_camera_from_GUI()
         
     
+    def handle_images(self):
+        """ In addition to the super class handling, records metrics for 
+        newly acquired and processed frames, and passes new frames to the
+        display worker. Processed frames are identified by imageId, the
+        camera frame number returned by the processor, which is None if it
+        is not known (CAS multi-core processing without shared memory does
+        not pass it on).
+        """
+        self.imageId = None
+        super().handle_images()
+        
+        metrics = self.engine_metrics()
+        newRawImage = False
+        frameNumber = None
+        if self.imageThread is not None:
+            frameNumber = self.imageThread.currentFrameNumber
+            if frameNumber != self.lastAcquiredFrame and frameNumber > 0:
+                metrics.mark('acquired', frameNumber, getattr(self.imageThread, 'currentFrameTime', None))
+                self.lastAcquiredFrame = frameNumber
+                newRawImage = True
+            metrics.set_count('acquiredFrames', frameNumber)
+            metrics.set_count('droppedFrames', self.imageThread.numDroppedFrames)
+        if newRawImage and self.ls is True and self.engine.driftTracker is not None:
+            self.track_drift(frameNumber)
+        if getattr(self, 'gotProcessedImage', False):
+            self.processedFrame = self.imageId
+            metrics.mark('processed', self.imageId)
+            
+        if self.displayWorker is not None:
+            if getattr(self, 'gotProcessedImage', False):
+                self.displayWorker.submit(self.currentProcessedImage, self.imageId)
+            elif newRawImage and self.currentProcessedImage is None and self.fallBackToRaw:
+                # The raw image may be a view of the acquisition buffer
+                self.displayWorker.submit(self.currentImage, frameNumber, copy = True)
+            
+    
+    def update_image_display(self):
+        """ In addition to the super class display update, records the time
+        each new frame is displayed. If displayDecimation is True, displays
+        the latest frame prepared by the display worker instead, if there is
+        a new one, and the mosaic preview if it has changed. Frames are not
+        downsampled while the display is zoomed.
+        """
+        if self.displayWorker is None:
+            super().update_image_display()
+            if getattr(self, 'currentProcessedImage', None) is not None:
+                frameNumber = self.processedFrame
+            else:
+                frameNumber = self.imageThread.currentFrameNumber if self.imageThread is not None else None
+        else:
+            if self.mainDisplay.zoomLevel > 0:
+                self.displayWorker.set_max_size(None)
+            else:
+                self.displayWorker.set_max_size((self.mainDisplay.height(), self.mainDisplay.width()))
+            image, frameNumber = self.displayWorker.get_display_image()
+            if image is not None:
+                self.mainDisplay.set_image(image)
+            self.engine_metrics().set_count('displaySkippedFrames', self.displayWorker.numSkipped)
+            if self.mosaicingEnabled and self.imageProcessor is not None:
+                mosaic = self.imageProcessor.get_processor().mosaic
+                if mosaic.is_preview_changed():
+                    self.mosaicDisplay.set_image(mosaic.get_mosaic())
+        
+        if frameNumber is not None and frameNumber != self.lastDisplayedFrame and frameNumber > 0:
+            self.engine_metrics().mark('displayed', frameNumber)
+            self.lastDisplayedFrame = frameNumber
+        
+        
+    def calibration_key(self):
+        """ Returns the calibration store key for the current probe and camera
+        settings.
+        """
+        camera = self.camSources[self.camSourceCombo.currentIndex()]
+        return calibration_key(self.probeID, camera, self.exposureInput.value(),
+                               self.gainInput.value(), self.binning)
+    
+    
+    def store_calibration(self):
+        """ Saves the current bundle calibration, background and linescan
+        parameters in the calibration store.
+        """
+        calibration = None
+        if self.imageProcessor is not None:
+            calibration = self.imageProcessor.get_processor().pyb.calibration
+        scanParameters = None
+        if self.ls is True:
+            scanParameters = (self.lsScanOffsetInput.value(), 
+                              self.lsScanSpeedInput.value(),
+                              self.lsScanRangeInput.value())
+        try:
+            self.calibrationStore.save(self.calibration_key(), 
+                                       bundleCalibration = calibration,
+                                       background = self.backgroundImage,
+                                       scanParameters = scanParameters)
+        except OSError as e:
+            print(f"Could not store calibration: {e}")
+            
+    
+    def load_stored_calibration(self):
+        """ Loads the calibration for the current probe and camera settings
+        from the calibration store. If there is none, the calibration saved by
+        Save Calibration is loaded instead, if it exists. Returns True if a 
+        stored calibration was found.
+        """
+        try:
+            record = self.calibrationStore.load(self.calibration_key())
+        except ValueError as e:
+            print(e)
+            record = None
+            
+        if record is None:
+            try:
+                self.load_calibration()
+            except:
+                pass
+            return False
+        
+        if 'background' in record:
+            self.backgroundImage = record['background']
+            self.backgroundSource = "Calibration store"
+        if 'bundleCalibration' in record and self.imageProcessor is not None:
+            self.imageProcessor.get_processor().pyb.calibration = record['bundleCalibration']
+        if 'scanParameters' in record and self.ls is True:
+            offset, speed, scanRange = record['scanParameters']
+            self.lsScanOffsetInput.setValue(offset)
+            self.lsScanSpeedInput.setValue(speed)
+            self.lsScanRangeInput.setValue(scanRange)
+        self.processing_options_changed()
+        return True
+    
+    
+    def set_probe(self, probeID):
+        """ Changes to a different probe, loading its stored calibration if 
+        there is one.
+        """
+        self.probeID = probeID
+        return self.load_stored_calibration()
+    
+    
     def get_single_image(self, **kwargs):
         """ Grab a single image, optionally with exposure and gain set. Note this will
-        flush the acquisition buffer
+        flush the acquisition buffer. See EndomicroscopeEngine.get_single_image.
         """        
-        exposure = kwargs.get('exposure', None)
-        gain = kwargs.get('gain', None)
-        if exposure is not None:
-            self.imageThread.cam.set_exposure(exposure)
-        if gain is not None:
-            self.imageThread.cam.set_gain(gain)
-    
-        self.imageThread.flush_buffer()
-        
-        return self.imageThread.get_next_image_wait()
+        return self.engine.get_single_image(**kwargs)
      
     
     def ls_fixed_voltage(self,volts):
         """ Write a fixed voltage to the scanner and leave it there"""
-        
-        try:
-            self.stop_ls()  # stops the current scanning
-        except:
-            pass
-        self.aoTask = nidaqmx.Task()
-        self.aoTask.ao_channels.add_ao_voltage_chan(self.lsAOChannel)
-        self.aoTask.write(volts)
+        self.engine.set_fixed_voltage(volts)
         
                  
 
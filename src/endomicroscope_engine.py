@@ -0,0 +1,1013 @@
+# -*- coding: utf-8 -*-
+"""
+Headless acquisition and processing engine for endomicroscopy.
+
+EndomicroscopeEngine owns the camera acquisition thread, the fibre bundle
+processing (a PyBundle object), the galvo scanner and the calibration state,
+and does not require Qt. It can be used on its own for unattended
+acquisitions, batch jobs or to measure pipeline throughput, e.g.
+
+    engine = EndomicroscopeEngine()
+    engine.open_camera('SimulatedCamera', filename = 'record.tif')
+    engine.load_calibration('calib.dat')
+    stats = engine.run(numFrames = 1000)
+
+The Endomicroscope GUI uses an engine for all scanning and linescan
+calibration, attaching it to the GUI's own acquisition thread.
+
+Run this file directly to measure throughput from the command line.
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import sys
+sys.path.append('..\\..\\cas\\src')
+sys.path.append('..\\..\\pyfibrebundle\\src')
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pybundle import PyBundle
+
+import linescan_utilities
+import scanners
+import scan_timing
+from enhanced_mode import EnhancedModeStage
+from pipeline_metrics import PipelineMetrics
+
+
+class EndomicroscopeEngine:
+    """ Acquisition, processing and scanning without a GUI.
+
+    Keyword Arguments:
+        scannerType     : str
+                          name of scanner class in scanners, default
+                          'NIDAQScanner'
+        lineRate        : float
+                          camera line rate (Hz), default 130750.6
+        sampleRate      : int
+                          scanner sample rate (Hz), default 250000
+
+    Any other keyword arguments are passed to the scanner.
+    """
+
+    lineRate = 130750.6
+    sampleRate = 250000
+
+    # Virtual slit linescan calibration values
+    lsCalibMinV = 0
+    lsCalibMaxV = 3
+    lsCalibStepV = 0.2
+    lsCalibExposure = 8000
+    lsCalibGain = 18
+    lsCalibTolerance = 0.01
+    lsCalibMinLines = 4
+    lsCalibSettleTimeout = 0.5
+    lsOffsetTweak = -0.03
+
+    # Scan timing checks, see scan_timing. Camera exposure values are
+    # multiplied by exposureUnits to give seconds. If strictTiming is True,
+    # scans which would miss triggers are not started.
+    exposureUnits = 1e-6
+    triggerJitter = 0
+    strictTiming = False
+
+    def __init__(self, **kwargs):
+
+        self.scannerType = kwargs.pop('scannerType', 'NIDAQScanner')
+        self.lineRate = kwargs.pop('lineRate', self.lineRate)
+        self.sampleRate = kwargs.pop('sampleRate', self.sampleRate)
+        self.scannerArgs = kwargs
+
+        self.scanner = None
+        self.imageThread = None
+        self.ownsImageThread = False
+
+        # Scan parameters
+        self.scanOffset = 0
+        self.scanSpeed = 0
+        self.scanRange = 0
+        self.dualMode = False
+        self.dualOffset = 0
+        self.lsCalibTimings = []
+        self.lsCalibCancelled = False
+        self.scanTiming = None
+
+        # Scanner state, recorded with each frame
+        self.scanning = False
+        self.scanStartFrame = 0
+        self.fixedVoltage = None
+
+        # Live correction of the scan offset, see enable_drift_tracking
+        self.driftTracker = None
+
+        # Processing. If parallel is set (see set_processing_threads), frames
+        # are processed on a pool of threads
+        self.pyb = PyBundle()
+        self.parallel = None
+        self.backgroundImage = None
+        self.backgroundStats = None
+        self.enhancedMode = EnhancedModeStage()
+
+        self.running = False
+        self.stats = None
+        self.metrics = PipelineMetrics()
+        self.numFramesReceived = 0
+
+        # Recording
+        self.recorder = None
+        self.recordRaw = True
+        self.recordInThread = False
+
+        # Super-resolution, see enable_super_res
+        self.superRes = None
+
+        # Multi-process acquisition and processing, see start_multiprocess
+        self.pipeline = None
+
+
+    ##### Camera
+
+    def open_camera(self, camName, bufferSize = 10, cameraID = 0, **camArgs):
+        """ Creates and starts an image acquisition thread for the camera
+        class 'camName', any camArgs are passed to the camera. Frames are
+        held in a preallocated ring buffer of 'bufferSize' frames. Returns
+        True if the camera was opened.
+        """
+        from acquisition_thread import RingBufferAcquisitionThread
+
+        self.imageThread = RingBufferAcquisitionThread(camName, bufferSize, cameraID = cameraID, **camArgs)
+        self.ownsImageThread = True
+
+        cam = self.imageThread.get_camera()
+        if cam is None or not cam.camera_open:
+            return False
+        if hasattr(cam, 'pre_load'):
+            cam.pre_load(-1)
+        if hasattr(cam, 'set_scanner'):
+            cam.set_scanner(self.get_scanner())
+
+        self.imageThread.start()
+        return True
+
+
+    def attach_camera(self, imageThread):
+        """ Uses an existing, running, image acquisition thread, such as the
+        one created by a GUI.
+        """
+        self.imageThread = imageThread
+        self.ownsImageThread = False
+        if imageThread is not None and hasattr(imageThread.cam, 'set_scanner'):
+            imageThread.cam.set_scanner(self.get_scanner())
+
+
+    def close_camera(self):
+        """ Stops the image acquisition thread if it was created by
+        open_camera.
+        """
+        if self.imageThread is not None and self.ownsImageThread:
+            self.imageThread.stop()
+        self.imageThread = None
+
+
+    def get_single_image(self, **kwargs):
+        """ Grab a single image, optionally with exposure and gain set. Note this will
+        flush the acquisition buffer. If a linescan_utilities.SettleDetector is
+        passed as 'settle', images are taken until the scan line is stable and
+        the last one is returned.
+        """
+        exposure = kwargs.get('exposure', None)
+        gain = kwargs.get('gain', None)
+        settle = kwargs.get('settle', None)
+        if exposure is not None:
+            self.imageThread.cam.set_exposure(exposure)
+        if gain is not None:
+            self.imageThread.cam.set_gain(gain)
+
+        self.imageThread.flush_buffer()
+
+        if settle is not None:
+            return settle.wait(self.imageThread.get_next_image_wait)
+        else:
+            return self.imageThread.get_next_image_wait()
+
+
+    def get_next_image_timeout(self, timeout):
+        """ Returns the next image from the acquisition thread, waiting at
+        most 'timeout' (s), or None if no image arrives in time.
+        """
+        if hasattr(self.imageThread, 'ringBuffer'):
+            return self.imageThread.get_next_image_wait(max(timeout, 0))
+
+        # The CAS thread only waits indefinitely, so poll
+        deadline = time.perf_counter() + timeout
+        while True:
+            frame = self.imageThread.get_next_image()
+            if frame is not None or time.perf_counter() >= deadline:
+                return frame
+            time.sleep(0.0005)
+
+
+    ##### Scanning
+
+    def get_scanner(self):
+        """ Returns the galvo scanner, creating it if necessary.
+        """
+        if self.scanner is None:
+            self.scanner = getattr(scanners, self.scannerType)(**self.scannerArgs)
+        return self.scanner
+
+
+    def set_scan_parameters(self, offset, speed, scanRange, dualMode = False, dualOffset = 0):
+        """ Sets the scan offset (V), speed (V/s) and range (V), and whether
+        to use dual (enhanced) mode with a second ramp offset by dualOffset (V).
+        Takes effect on the next call to start_scanning.
+        """
+        self.scanOffset = offset
+        self.scanSpeed = speed
+        self.scanRange = scanRange
+        self.dualMode = dualMode
+        self.dualOffset = dualOffset
+
+
+    def get_scan_parameters(self):
+        """ Returns the scan offset (V), speed (V/s) and range (V).
+        """
+        return self.scanOffset, self.scanSpeed, self.scanRange
+
+
+    def start_scanning(self):
+        """ Starts the galvo ramp, triggered by the camera, using the current
+        scan parameters.
+        """
+        vals, nPoints = linescan_utilities.scan_waveform(self.scanOffset,
+                                                         self.scanSpeed,
+                                                         self.scanRange,
+                                                         self.dualMode,
+                                                         self.dualOffset,
+                                                         self.sampleRate)
+        report = self.check_scan_timing(nPoints)
+        if not report['ok'] and self.strictTiming:
+            raise ValueError("Scan not started: " + ' '.join(report['errors']))
+
+        self.enhancedMode.reset()
+        scanner = self.get_scanner()
+        scanner.start_scan(vals, nPoints, self.sampleRate)
+        self.scanning = True
+        self.scanStartFrame = getattr(self.imageThread, 'currentFrameNumber', 0)
+        if self.driftTracker is not None:
+            self.driftTracker.reset(self.scanOffset)
+
+        self.metrics.count('scanStarts')
+        self.metrics.set_count('scanPoints', int(nPoints))
+        self.metrics.set_count('daqReconfigurations', scanner.numReconfigurations)
+        self.metrics.set_count('daqRewrites', scanner.numRewrites)
+
+
+    def get_camera_timing(self):
+        """ Returns the camera frame period (s), exposure (s) and number of
+        rows, each None if not known.
+        """
+        cam = getattr(self.imageThread, 'cam', None)
+        framePeriod = exposure = None
+        if cam is not None:
+            try:
+                fps = cam.get_frame_rate()
+                framePeriod = 1 / fps if fps else None
+                exposure = cam.get_exposure() * self.exposureUnits or None
+            except Exception:
+                pass
+        shape = getattr(getattr(self.imageThread, 'ringBuffer', None), 'shape', None)
+        numRows = shape[0] if shape is not None else None
+        return framePeriod, exposure, numRows
+
+
+    def check_scan_timing(self, nPoints = None, framePeriod = None):
+        """ Checks the ramp for the current scan parameters against the
+        camera frame period, exposure and line rate, see
+        scan_timing.scan_timing. The frame period is taken from the camera
+        if not given. Errors and warnings are printed when they change.
+        Returns the report, also stored in 'scanTiming'.
+        """
+        if nPoints is None:
+            nPoints = linescan_utilities.scan_waveform(self.scanOffset, self.scanSpeed, self.scanRange,
+                                                       self.dualMode, self.dualOffset, self.sampleRate)[1]
+        camPeriod, exposure, numRows = self.get_camera_timing()
+        if framePeriod is None:
+            framePeriod = camPeriod
+
+        report = scan_timing.scan_timing(nPoints, self.sampleRate, framePeriod,
+                                         exposure = exposure, lineRate = self.lineRate, numRows = numRows,
+                                         scanRange = self.scanRange, scanSpeed = self.scanSpeed,
+                                         jitter = self.triggerJitter)
+
+        messages = report['errors'] + report['warnings']
+        if self.scanTiming is None or messages != self.scanTiming['errors'] + self.scanTiming['warnings']:
+            for message in messages:
+                print("Scan timing: " + message)
+        self.scanTiming = report
+        self.metrics.set_count('scanTimingErrors', len(report['errors']))
+        return report
+
+
+    def analyse_trigger_jitter(self, times = None):
+        """ Analyses trigger times (s), by default those recorded by the
+        scanner (SimulatedScanner), against the current ramp duration, see
+        scan_timing.analyse_trigger_times. Returns None if there are no
+        trigger times.
+        """
+        if times is None:
+            times = getattr(self.scanner, 'triggerTimes', None)
+            if times is None:
+                return None
+        rampDuration = self.scanTiming['rampDuration'] if self.scanTiming is not None else None
+        rearmTime = self.scanTiming['rearmTime'] if self.scanTiming is not None else 0
+        return scan_timing.analyse_trigger_times(list(times), rampDuration, rearmTime = rearmTime)
+
+
+    def set_fixed_voltage(self, volts):
+        """ Write a fixed voltage to the scanner and leave it there.
+        """
+        self.get_scanner().set_voltage(volts)
+        self.scanning = False
+        self.fixedVoltage = volts
+
+
+    def stop_scanning(self):
+        """ Stops the galvo scanner.
+        """
+        if self.scanner is not None:
+            self.scanner.stop()
+        self.scanning = False
+
+
+    def calibrate_ls(self, progress = None, cancel = None):
+        """ Determines the galvo scanning speed and offset so that the scanning
+        line is aligned with the camera rolling shutter. The scanner is stepped
+        through voltages until the fit converges. If successful, the scan
+        parameters are updated and returned as (offset, speed, range),
+        otherwise returns None. Scanning is not restarted. The timing of
+        each step is stored in lsCalibTimings.
+
+        This may be called from a thread other than the one that owns the
+        camera. If 'progress' is given it is called after each image has been
+        analysed with a dictionary of the step, number of steps, voltage,
+        number of lines found and the current estimates of the scan
+        parameters and their uncertainties. If 'cancel' is given (e.g. a
+        threading.Event), the sweep stops before the next step once
+        cancel.is_set() returns True; None is returned and lsCalibCancelled
+        is set.
+        """
+
+        # Grab a series of images at different galvo voltages, and stop once
+        # the fit has converged
+        testV = np.arange(self.lsCalibMinV, self.lsCalibMaxV, self.lsCalibStepV)
+
+        # Sets the calibration exposure and gain, the image is not used
+        self.get_single_image(exposure = self.lsCalibExposure, gain = self.lsCalibGain)
+
+        # Rather than waiting a fixed time after each voltage change, we
+        # wait until the line position stops changing
+        calibrator = linescan_utilities.VirtualSlitCalibrator(self.lineRate)
+        settleDetector = linescan_utilities.SettleDetector(timeout = self.lsCalibSettleTimeout)
+        self.lsCalibTimings = []
+        self.lsCalibCancelled = False
+
+        def analyse(volts, im):
+            t0 = time.perf_counter()
+            lineFound = calibrator.add(volts, im)
+            return lineFound, time.perf_counter() - t0
+
+        def analysed(future, step):
+            # Waits for analysis of 'step' to finish and reports progress
+            t0 = time.perf_counter()
+            lineFound, analysisTime = future.result()
+            self.lsCalibTimings[step]['analysisTime'] = analysisTime
+            self.lsCalibTimings[step]['analysisWaitTime'] = time.perf_counter() - t0
+            if progress is not None:
+                progress({'step': step + 1,
+                          'numSteps': len(testV),
+                          'volts': self.lsCalibTimings[step]['volts'],
+                          'lineFound': lineFound,
+                          'numLines': calibrator.num_valid(),
+                          'scanParameters': calibrator.get_scan_parameters(),
+                          'uncertainty': calibrator.get_uncertainty()})
+
+        # Each image is analysed on a separate thread while the scanner
+        # moves to the next voltage and settles, so the convergence check
+        # after acquiring an image uses the images up to the one before
+        analyser = ThreadPoolExecutor(max_workers = 1)
+        pending = None
+        try:
+            for v in testV:
+                if cancel is not None and cancel.is_set():
+                    self.lsCalibCancelled = True
+                    break
+                t0 = time.perf_counter()
+                self.set_fixed_voltage(v)
+                t1 = time.perf_counter()
+                im = np.array(self.get_single_image(settle = settleDetector))
+                t2 = time.perf_counter()
+                if pending is not None:
+                    analysed(pending, len(self.lsCalibTimings) - 1)
+                    pending = None
+                    if calibrator.is_converged(self.lsCalibTolerance, self.lsCalibMinLines):
+                        break
+                pending = analyser.submit(analyse, v, im)
+                self.lsCalibTimings.append({'volts': v,
+                                            'setVoltageTime': t1 - t0,
+                                            'acquireTime': t2 - t1,
+                                            **settleDetector.timings[-1]})
+            if pending is not None:
+                analysed(pending, len(self.lsCalibTimings) - 1)
+        finally:
+            analyser.shutdown(wait = True)
+
+        print(f"Linescan calibration: {len(self.lsCalibTimings)} steps, "
+              f"{sum(t['setVoltageTime'] for t in self.lsCalibTimings):.3f} s setting voltage, "
+              f"{sum(t['acquireTime'] for t in self.lsCalibTimings):.3f} s acquiring/settling, "
+              f"{sum(t.get('analysisTime', 0) for t in self.lsCalibTimings):.3f} s analysing "
+              f"({sum(t.get('analysisWaitTime', 0) for t in self.lsCalibTimings):.3f} s not overlapped).")
+
+        if self.lsCalibCancelled or calibrator.get_scan_parameters() is None:
+            return None
+
+        speed, offset, scanRange = calibrator.get_scan_parameters()
+
+        self.scanOffset = offset + self.lsOffsetTweak
+        self.scanSpeed = -speed
+        self.scanRange = scanRange
+
+        return self.get_scan_parameters()
+
+
+    def get_frame_metadata(self, frameNumber = None):
+        """ Returns a dictionary of the scanner state for camera frame
+        'frameNumber', for recording: 'scanVoltage', the voltage at the start of
+        the ramp for the frame (or the fixed voltage if not scanning), and
+        'dualPhase', 0 or 1 for the first or second ramp in dual mode (or -1
+        if not in dual mode). The phase assumes that no camera triggers have
+        been missed since scanning started.
+        """
+        if not self.scanning:
+            return {'scanVoltage': self.fixedVoltage, 'dualPhase': -1}
+        if not self.dualMode or frameNumber is None:
+            return {'scanVoltage': self.scanOffset, 'dualPhase': -1}
+        phase = (frameNumber - self.scanStartFrame - 1) % 2
+        return {'scanVoltage': self.scanOffset + phase * self.dualOffset, 'dualPhase': phase}
+
+
+    def get_recording_metadata(self):
+        """ Returns a dictionary of settings saved with a recording.
+        """
+        return {'scanOffset': self.scanOffset,
+                'scanSpeed': self.scanSpeed,
+                'scanRange': self.scanRange,
+                'dualMode': self.dualMode,
+                'dualOffset': self.dualOffset,
+                'lineRate': self.lineRate,
+                'sampleRate': self.sampleRate,
+                'started': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+    ##### Drift tracking
+
+    def enable_drift_tracking(self, **kwargs):
+        """ Starts correcting the scan offset for drift while scanning, using
+        raw frames passed to track_drift (done by run()). The offset is
+        dithered and moved towards the offset giving the most light, see
+        drift_tracker. Keyword arguments are passed to DriftTracker.
+        Returns the tracker.
+        """
+        from drift_tracker import DriftTracker
+
+        self.driftTracker = DriftTracker(self.scanOffset, self.apply_scan_offset, **kwargs)
+        return self.driftTracker
+
+
+    def disable_drift_tracking(self):
+        """ Stops drift tracking, leaving the scan at the tracked offset.
+        """
+        if self.driftTracker is None:
+            return
+        self.driftTracker = None
+        if self.scanning and not self.dualMode:
+            self.apply_scan_offset(self.scanOffset)
+
+
+    def apply_scan_offset(self, volts):
+        """ Rewrites the ramp of the current scan with offset 'volts' (V),
+        without changing the scan parameters. As the ramp length does not
+        change, the DAQ tasks are not reconfigured, but the output is
+        stopped while the voltages are written (for the scanner's
+        rewriteTime), and a camera trigger in that time gets no ramp.
+        Returns the number of the latest camera frame, or None if not known.
+        """
+        vals, nPoints = linescan_utilities.scan_waveform(volts,
+                                                         self.scanSpeed,
+                                                         self.scanRange,
+                                                         self.dualMode,
+                                                         self.dualOffset,
+                                                         self.sampleRate)
+        scanner = self.get_scanner()
+        scanner.start_scan(vals, nPoints, self.sampleRate)
+        self.metrics.set_count('daqRewrites', scanner.numRewrites)
+        self.metrics.set_count('missedTriggers', scanner.numMissedTriggers)
+        return getattr(self.imageThread, 'currentFrameNumber', None)
+
+
+    def track_drift(self, frame, frameNumber):
+        """ Passes raw frame 'frame' with camera frame number 'frameNumber'
+        to the drift tracker, if enabled and scanning (not in enhanced
+        mode). scanOffset follows the tracked offset. Returns True if the
+        offset was changed.
+        """
+        if self.driftTracker is None or not self.scanning or self.dualMode or frame is None:
+            return False
+        changed = self.driftTracker.add(frame, frameNumber)
+        if changed:
+            self.scanOffset = self.driftTracker.offset
+        self.metrics.set_count('driftCycles', self.driftTracker.numCycles)
+        self.metrics.set_count('driftRejectedCycles', self.driftTracker.numRejected)
+        self.metrics.set_count('driftFrameStride', self.driftTracker.frameStride)
+        self.metrics.set_count('driftWrites', self.driftTracker.numWrites)
+        self.metrics.set_count('driftHolds', self.driftTracker.numHolds)
+        if self.scanner is not None:
+            self.metrics.set_count('missedTriggers', self.scanner.numMissedTriggers)
+        return changed
+
+
+    ##### Recording
+
+    def create_recorder(self, filename, **kwargs):
+        """ Returns a recorder.FrameRecorder for 'filename', which is not
+        started, with the scan settings saved as the recording metadata. Any
+        keyword arguments are passed to FrameRecorder.
+        """
+        from recorder import FrameRecorder
+        return FrameRecorder(filename, metadata = self.get_recording_metadata(), **kwargs)
+
+
+    def start_recording(self, filename, raw = True, **kwargs):
+        """ Starts recording raw frames (or processed frames if 'raw' is
+        False) to 'filename' in a background thread, see recorder. Raw
+        frames are recorded by the acquisition thread if it supports this
+        (RingBufferAcquisitionThread), so every frame is recorded whether or
+        not it is processed, otherwise by run(). Keyword arguments are passed
+        to recorder.FrameRecorder, e.g. format = 'tif'. Returns the recorder.
+        """
+        self.stop_recording()
+        self.recorder = self.create_recorder(filename, **kwargs)
+        self.recorder.start()
+        self.recordRaw = raw
+        self.recordInThread = raw and hasattr(self.imageThread, 'recorder')
+        if self.recordInThread:
+            self.imageThread.frameMetadata = self.get_frame_metadata
+            self.imageThread.recorder = self.recorder
+        return self.recorder
+
+
+    def stop_recording(self):
+        """ Stops recording, waits for queued frames to be written and
+        returns the recording statistics, or None if not recording.
+        """
+        if self.recorder is None:
+            return None
+        if self.recordInThread:
+            self.imageThread.recorder = None
+        stats = self.recorder.stop()
+        self.recorder = None
+        self.recordInThread = False
+        self.metrics.set_count('recordedFrames', stats['numWritten'])
+        self.metrics.set_count('recordDroppedFrames', stats['numDropped'])
+        return stats
+
+
+    ##### Processing
+
+    def set_background(self, backgroundImage):
+        """ Sets the background image used for bundle calibration and
+        background subtraction.
+        """
+        self.backgroundImage = backgroundImage
+        self.pyb.set_background(backgroundImage)
+        self.pyb.set_normalise_image(backgroundImage)
+
+
+    def load_background(self, filename):
+        """ Loads the background image from a file.
+        """
+        from PIL import Image
+        self.set_background(np.array(Image.open(filename)))
+
+
+    def acquire_background(self, numFrames = 100, maxTime = 5, getImage = None, **kwargs):
+        """ Acquires up to 'numFrames' frames, for at most 'maxTime' (s),
+        and sets their mean as the background image. The mean is
+        accumulated frame by frame with outlier pixels and frames rejected,
+        and acquisition stops once it has converged, see
+        background_stats.RunningBackground, to which keyword arguments are
+        passed. Frames are taken from the acquisition thread, or from
+        getImage(timeout) if given, which returns None if there is no frame
+        within timeout (s). Statistics are stored in 'backgroundStats'.
+        Returns the background image (float32), or None if no frames were
+        accepted.
+        """
+        from background_stats import RunningBackground
+
+        background = RunningBackground(**kwargs)
+        if getImage is None:
+            self.imageThread.flush_buffer()
+            getImage = self.get_next_image_timeout
+        t0 = time.perf_counter()
+        while background.numFrames < numFrames and time.perf_counter() - t0 < maxTime:
+            frame = getImage(maxTime - (time.perf_counter() - t0))
+            if frame is None:
+                continue
+            background.add(frame)
+            if background.is_converged():
+                break
+
+        self.backgroundStats = background.get_stats()
+        self.backgroundStats['elapsed'] = time.perf_counter() - t0
+        if background.numAccepted == 0:
+            return None
+        self.set_background(background.get_mean())
+        return self.backgroundImage
+
+
+    def calibrate_bundle(self):
+        """ Performs the pybundle calibration using the background image.
+        """
+        self.pyb.set_calib_image(self.backgroundImage)
+        self.pyb.calibrate()
+
+
+    def load_calibration(self, filename = 'calib.dat'):
+        """ Loads a pybundle calibration, as saved by the GUI.
+        """
+        self.pyb.set_core_method(self.pyb.TRILIN)
+        self.pyb.load_calibration(filename)
+
+
+    def save_calibration(self, filename = 'calib.dat'):
+        """ Saves the pybundle calibration.
+        """
+        self.pyb.save_calibration(filename)
+
+
+    def save_to_store(self, store, key):
+        """ Saves the bundle calibration, background and scan parameters in
+        a calibration_store.CalibrationStore under 'key'. Returns the filename.
+        """
+        scanParameters = self.get_scan_parameters() if self.scanSpeed != 0 else None
+        return store.save(key, bundleCalibration = getattr(self.pyb, 'calibration', None),
+                               background = self.backgroundImage,
+                               scanParameters = scanParameters)
+
+
+    def load_from_store(self, store, key):
+        """ Loads whatever is stored for 'key' in a
+        calibration_store.CalibrationStore. Returns False if there is nothing
+        stored for the key.
+        """
+        record = store.load(key)
+        if record is None:
+            return False
+        if 'background' in record:
+            self.set_background(record['background'])
+        if 'bundleCalibration' in record:
+            self.pyb.set_core_method(self.pyb.TRILIN)
+            self.pyb.calibration = record['bundleCalibration']
+        if 'scanParameters' in record:
+            self.scanOffset, self.scanSpeed, self.scanRange = record['scanParameters']
+        return True
+
+
+    def set_processing_threads(self, numThreads):
+        """ Processes each frame on 'numThreads' threads, splitting it into
+        tiles, see parallel_bundle. Use 1 for pybundle's own processing.
+        """
+        if self.parallel is not None:
+            self.parallel.close()
+            self.parallel = None
+        if numThreads > 1:
+            from parallel_bundle import ParallelBundleProcessor
+            self.parallel = ParallelBundleProcessor(self.pyb, numThreads = numThreads)
+
+
+    def process(self, inputFrame, frameNumber = None):
+        """ Processes a raw frame, returns the processed frame. In dual mode
+        the difference from the previous frame is processed, see
+        enhanced_mode. If given, 'frameNumber' is used to avoid combining
+        frames which were not consecutive.
+        """
+        outputFrame = inputFrame
+
+        if self.dualMode:
+            combined = self.enhancedMode.process(inputFrame, frameNumber)
+            if combined is not None:
+                outputFrame = combined
+
+        if self.parallel is not None:
+            return self.parallel.process(outputFrame)
+        return self.pyb.process(outputFrame)
+
+
+    def get_frame_number(self, frame):
+        """ Returns the camera frame number of a frame from the acquisition
+        thread if it is known, otherwise None.
+        """
+        ringBuffer = getattr(self.imageThread, 'ringBuffer', None)
+        if ringBuffer is None:
+            return None
+        return ringBuffer.get_frame_number(frame)
+
+
+    def get_frame_timestamp(self, frame):
+        """ Returns the time (time.perf_counter) a frame from the acquisition
+        thread was acquired if it is known, otherwise None.
+        """
+        ringBuffer = getattr(self.imageThread, 'ringBuffer', None)
+        if ringBuffer is None:
+            return None
+        return ringBuffer.get_timestamp(frame)
+
+
+    ##### Super-resolution
+
+    def enable_super_res(self, numShifts, **kwargs):
+        """ Switches to multi-frame super-resolution, reconstructing each set
+        of 'numShifts' shifted frames rather than processing single frames.
+        Keyword arguments are passed to super_res_stage.SuperResStage. The
+        calibration must be set using calibrate_super_res. Returns the stage.
+        """
+        from super_res_stage import SuperResStage
+
+        self.disable_super_res()
+        self.superRes = SuperResStage(numShifts, useNumba = self.pyb.useNumba, **kwargs)
+        return self.superRes
+
+
+    def disable_super_res(self):
+        """ Stops super-resolution and returns to processing single frames.
+        """
+        if self.superRes is not None:
+            self.superRes.stop()
+            self.superRes = None
+
+
+    def calibrate_super_res(self, shifts = None, calibImages = None, store = None, key = None, **kwargs):
+        """ Performs the super-resolution calibration, using the background
+        image and the pybundle core size, grid size and filter, and either
+        known 'shifts' (numShifts, 2) or a set of shifted images
+        'calibImages' (height, width, numShifts). The calibration is only
+        recalculated if these have changed since the last calibration or,
+        if given, the one saved in calibration_store.CalibrationStore 'store'
+        under 'key'. Other keyword arguments are passed to
+        SuperRes.calib_multi_tri_interp. Returns True if a new calibration
+        was made.
+        """
+        if self.superRes is None:
+            raise RuntimeError("Super-resolution is not enabled.")
+        if self.backgroundImage is None:
+            raise RuntimeError("A background image is needed for super-resolution calibration.")
+
+        return self.superRes.calibrate(self.backgroundImage, self.pyb.coreSize, self.pyb.gridSize,
+                                       store = store, key = key,
+                                       shifts = None if shifts is None else np.asarray(shifts, dtype = 'float64'),
+                                       calibImages = calibImages,
+                                       background = self.pyb.background,
+                                       normalise = self.pyb.normaliseImage,
+                                       filterSize = self.pyb.filterSize,
+                                       **kwargs)
+
+
+    ##### Multi-process
+
+    def start_multiprocess(self, camName, numWorkers = 2, bufferSize = 16, **kwargs):
+        """ Acquires from camera class 'camName' in a separate process and
+        processes frames with the current pybundle settings in 'numWorkers'
+        processes, passing frames through shared memory, see
+        multiprocess_pipeline. run() then returns processed frames in
+        order, with rawFrame None. Processing settings are copied to the
+        workers now, so restart after changing the calibration. Other
+        keyword arguments are passed to MultiProcessPipeline and the camera.
+        Returns the pipeline.
+        """
+        from multiprocess_pipeline import MultiProcessPipeline
+
+        if self.dualMode or self.superRes is not None:
+            raise RuntimeError("Enhanced mode and super-resolution are not supported with multi-process processing.")
+        self.stop_multiprocess()
+        self.pipeline = MultiProcessPipeline(camName, self.pyb.process, numWorkers = numWorkers,
+                                             numSlots = bufferSize, **kwargs)
+        self.pipeline.start()
+        return self.pipeline
+
+
+    def stop_multiprocess(self):
+        """ Stops multi-process acquisition and processing.
+        """
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+
+
+    def get_num_dropped_frames(self):
+        """ Returns the number of frames dropped by acquisition.
+        """
+        if self.pipeline is not None:
+            return self.pipeline.get_stats()['numDropped']
+        return getattr(self.imageThread, 'numDroppedFrames', 0)
+
+
+    def run(self, numFrames = None, duration = None, callback = None, process = True):
+        """ Acquires and processes frames until 'numFrames' have been processed,
+        'duration' (s) has passed or stop() is called. For each frame,
+        callback(rawFrame, processedFrame) is called if provided, e.g. for
+        recording. rawFrame may be a read-only view onto the acquisition
+        buffer, so should be copied if it is kept. If super-resolution is
+        enabled, processedFrame is a newly reconstructed image, or None. If
+        multi-process processing has been started, rawFrame is None and
+        processed frames are recorded. Returns a dictionary of throughput
+        statistics, also stored in 'stats'. The time each frame reaches each
+        stage is recorded in 'metrics'.
+        """
+        self.running = True
+        numProcessed = 0
+        processTime = 0
+        droppedAtStart = self.get_num_dropped_frames()
+        t0 = time.perf_counter()
+
+        while self.running:
+            if numFrames is not None and numProcessed >= numFrames:
+                break
+            if duration is not None and time.perf_counter() - t0 >= duration:
+                break
+
+            if self.pipeline is not None:
+                # Frames were acquired and processed in other processes
+                processedFrame = self.pipeline.get_next()
+                if processedFrame is None:
+                    time.sleep(0.0005)
+                    continue
+                rawFrame = None
+                frameNumber = self.pipeline.frameNumber
+                acquiredTime = self.pipeline.timestamp
+            else:
+                rawFrame = self.imageThread.get_next_image()
+                if rawFrame is None:
+                    time.sleep(0.0005)
+                    continue
+                frameNumber = self.get_frame_number(rawFrame)
+                acquiredTime = self.get_frame_timestamp(rawFrame)
+
+            tProc = time.perf_counter()
+            self.numFramesReceived = self.numFramesReceived + 1
+            frameId = frameNumber if frameNumber is not None else self.numFramesReceived
+            if self.driftTracker is not None:
+                self.track_drift(rawFrame, frameId)
+            if acquiredTime is not None:
+                self.metrics.mark('acquired', frameId, acquiredTime)
+            self.metrics.mark('dequeued', frameId, tProc)
+
+            if self.pipeline is not None:
+                # Already processed by the pipeline workers
+                pass
+            elif self.superRes is not None:
+                # Reconstructed images are returned in place of processed
+                # frames when each set is complete
+                self.superRes.add(rawFrame, frameNumber)
+                processedFrame, setNumber = self.superRes.get_result()
+                if processedFrame is not None:
+                    self.metrics.mark('superRes', setNumber)
+            elif process:
+                processedFrame = self.process(rawFrame, frameNumber)
+            else:
+                processedFrame = None
+            processTime = processTime + time.perf_counter() - tProc
+            numProcessed = numProcessed + 1
+            self.metrics.mark('processed', frameId)
+
+            if self.recorder is not None and not self.recordInThread:
+                frame = rawFrame if self.recordRaw and rawFrame is not None else processedFrame
+                self.recorder.put(frame, acquiredTime, frameNumber = frameNumber, **self.get_frame_metadata(frameNumber))
+
+            if callback is not None:
+                callback(rawFrame, processedFrame)
+                self.metrics.mark('delivered', frameId)
+
+            self.metrics.set_count('droppedFrames', self.get_num_dropped_frames())
+            if self.dualMode:
+                self.metrics.set_count('unpairedFrames', self.enhancedMode.numUnpaired)
+            if self.recorder is not None:
+                self.metrics.set_count('recordedFrames', self.recorder.numWritten)
+                self.metrics.set_count('recordDroppedFrames', self.recorder.numDropped)
+            if self.superRes is not None:
+                self.metrics.set_count('superResSets', self.superRes.numReconstructed)
+                self.metrics.set_count('superResDroppedSets', self.superRes.numDroppedSets + self.superRes.numIncompleteSets)
+
+        self.running = False
+        elapsed = time.perf_counter() - t0
+
+        self.stats = {'numFrames': numProcessed,
+                      'elapsed': elapsed,
+                      'fps': numProcessed / elapsed if elapsed > 0 else 0,
+                      'meanProcessTime': processTime / numProcessed if numProcessed > 0 else 0,
+                      'numDroppedFrames': self.get_num_dropped_frames() - droppedAtStart}
+        if self.superRes is not None:
+            self.stats.update({'superRes' + name[0].upper() + name[1:]: value for name, value in self.superRes.get_stats().items()})
+        if self.pipeline is not None:
+            pipelineStats = self.pipeline.get_stats()
+            self.stats['numWorkers'] = pipelineStats['numWorkers']
+            self.stats['meanProcessTime'] = pipelineStats['meanProcessTime']
+        return self.stats
+
+
+    def stop(self):
+        """ Stops run(), can be called from another thread.
+        """
+        self.running = False
+
+
+    def close(self):
+        """ Stops recording, super-resolution, multi-process processing,
+        drift tracking, scanning and acquisition.
+        """
+        self.stop()
+        self.stop_recording()
+        self.disable_drift_tracking()
+        self.disable_super_res()
+        self.stop_multiprocess()
+        self.set_processing_threads(1)
+        self.stop_scanning()
+        self.close_camera()
+
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Headless endomicroscope acquisition, reports pipeline throughput.")
+    parser.add_argument('--camera', default = 'SimulatedCamera', help = "camera class name")
+    parser.add_argument('--source', help = "file for simulated camera")
+    parser.add_argument('--calibration', help = "pybundle calibration file")
+    parser.add_argument('--background', help = "background image file")
+    parser.add_argument('--frames', type = int, default = 500)
+    parser.add_argument('--fps', type = float, help = "simulated camera frame rate")
+    parser.add_argument('--record', help = "record raw frames to this folder (or .tif file)")
+    parser.add_argument('--record-processed', action = 'store_true', help = "record processed rather than raw frames")
+    parser.add_argument('--super-res', type = int, help = "number of shifted frames for super-resolution")
+    parser.add_argument('--sr-shifts', help = "text file of super-resolution shifts, x and y (pixels) per line")
+    parser.add_argument('--sr-workers', type = int, default = 2, help = "super-resolution workers")
+    parser.add_argument('--sr-processes', action = 'store_true', help = "use processes rather than threads for super-resolution")
+    parser.add_argument('--threads', type = int, default = 1, help = "process each frame on this many threads")
+    parser.add_argument('--processes', type = int, help = "acquire and process in this many worker processes, using shared memory")
+    args = parser.parse_args()
+
+    engine = EndomicroscopeEngine()
+    camArgs = {'filename': args.source} if args.source is not None else {}
+    if args.processes is None:
+        if not engine.open_camera(args.camera, **camArgs):
+            sys.exit("Unable to open camera.")
+        if args.fps is not None:
+            engine.imageThread.cam.set_frame_rate(args.fps)
+    if args.background is not None:
+        engine.load_background(args.background)
+    if args.calibration is not None:
+        engine.load_calibration(args.calibration)
+    elif args.background is not None:
+        engine.pyb.set_core_method(engine.pyb.TRILIN)
+        engine.calibrate_bundle()
+
+    engine.set_processing_threads(args.threads)
+
+    if args.super_res is not None:
+        if args.sr_shifts is None or args.background is None:
+            sys.exit("Super-resolution needs --sr-shifts and --background.")
+        engine.enable_super_res(args.super_res, numWorkers = args.sr_workers, useProcesses = args.sr_processes)
+        engine.calibrate_super_res(shifts = np.loadtxt(args.sr_shifts, ndmin = 2))
+        print(f"Super-resolution calibration: {engine.superRes.calibrationTime:.2f} s")
+
+    if args.processes is not None:
+        try:
+            engine.start_multiprocess(args.camera, numWorkers = args.processes, frameRate = args.fps, **camArgs)
+        except RuntimeError as e:
+            sys.exit(str(e))
+
+    if args.record is not None:
+        recordFormat = 'tif' if args.record.lower().endswith(('.tif', '.tiff')) else 'chunked'
+        engine.start_recording(args.record, raw = not args.record_processed, format = recordFormat)
+
+    stats = engine.run(numFrames = args.frames)
+    recordStats = engine.stop_recording()
+    engine.close()
+    for key, value in stats.items():
+        print(f"{key}: {value}")
+    if recordStats is not None:
+        print(f"Recorded {recordStats['numWritten']} frames, {recordStats['numDropped']} dropped, "
+              f"maximum queue fill {recordStats['maxQueueFill']}.")
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Image processor for the Endomicroscope GUI.
+
+Extends the CAS BundleProcessor, using enhanced_mode.EnhancedModeStage for
+dual (enhanced) mode linescan, so that pairs of frames are combined in
+preallocated buffers rather than allocating new images for every frame.
+
+Mosaicing is done by mosaic_stage.MosaicWorker in its own thread rather
+than by the pybundle Mosaic in the processing thread, so mosaicing never
+slows down processing. It is kept as self.mosaic so that the CAS mosaic
+panel (reset, reset threshold and intensity) works unchanged.
+
+If processingThreads is more than 1, each frame is split into tiles which
+are processed on a pool of threads, see parallel_bundle.
+
+Frames from an acquisition_thread.TaggedAcquisitionThread arrive as
+(frame, frameNumber), and are returned as (processedFrame, frameNumber),
+which CAS stores as the GUI's imageId.
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+from cas_gui.threads.bundle_processor import BundleProcessor
+
+from enhanced_mode import EnhancedModeStage
+from mosaic_stage import MosaicWorker
+from parallel_bundle import ParallelBundleProcessor
+
+
+class EndomicroscopeProcessor(BundleProcessor):
+
+    # Keyword arguments for the MosaicWorker, e.g. {'maxTiles': 64}
+    mosaicOptions = {}
+
+    # Number of threads each frame is processed on
+    processingThreads = 1
+
+    def __init__(self, **kwargs):
+
+        super().__init__(**kwargs)
+        self.enhancedMode = EnhancedModeStage()
+        self.mosaic = MosaicWorker(**kwargs.get('mosaicOptions', self.mosaicOptions))
+        self.processingThreads = kwargs.get('processingThreads', self.processingThreads)
+        self.parallel = None
+
+
+    def process(self, inputFrame):
+
+        frameNumber = None
+        if isinstance(inputFrame, tuple):
+            inputFrame, frameNumber = inputFrame
+        outputFrame = inputFrame
+
+        if self.dualMode:
+            combined = self.enhancedMode.process(inputFrame)
+            if combined is not None:
+                outputFrame = combined
+        elif self.enhancedMode.hasPrevious:
+            self.enhancedMode.reset()
+
+        if self.processingThreads > 1:
+            if self.parallel is None or self.parallel.pyb is not self.pyb:
+                self.parallel = ParallelBundleProcessor(self.pyb, numThreads = self.processingThreads)
+            outputFrame = self.parallel.process(outputFrame)
+        else:
+            outputFrame = self.pyb.process(outputFrame)
+
+        if self.mosaicing and outputFrame is not None:
+            self.mosaic.start()
+            self.mosaic.submit(outputFrame)
+
+        if frameNumber is not None:
+            return outputFrame, frameNumber
+        return outputFrame
+
+
+    def get_mosaic(self):
+        """ Returns the latest preview of the mosaic, or None if mosaicing
+        is off or there is no mosaic yet.
+        """
+        if self.mosaicing:
+            return self.mosaic.get_mosaic()
+
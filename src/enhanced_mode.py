@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Enhanced (dual) mode processing for virtual slit linescan.
+
+In enhanced mode the scanner alternates between two ramps, offset from each
+other (see linescan_utilities.scan_waveform), so that alternate frames are
+imaged with the slit aligned and misaligned with the rolling shutter. The
+difference between each frame and the previous one removes the out-of-focus
+background. Every new frame is combined with the one before it, so the
+output frame rate is the same as the camera frame rate.
+
+EnhancedModeStage does this using buffers which are allocated once, with the
+difference taken and clipped in place. If frame numbers are provided, a
+frame is only combined with the previous one if they were consecutive
+camera frames, so a dropped frame does not produce a corrupted output.
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import numpy as np
+
+
+class EnhancedModeStage:
+    """ Combines pairs of consecutive enhanced mode frames.
+
+    Keyword Arguments:
+        polarityStep : int
+                       pixel step used when deciding which frame of a pair
+                       is aligned, default 4
+    """
+
+    def __init__(self, **kwargs):
+
+        self.polarityStep = kwargs.get('polarityStep', 4)
+
+        self.previous = None
+        self.output = None
+        self.reset()
+
+
+    def reset(self):
+        """ Forgets the previous frame, e.g. after the scan is changed.
+        """
+        self.hasPrevious = False
+        self.previousNumber = None
+        self.numFrames = 0
+        self.numCombined = 0
+        self.numUnpaired = 0
+
+
+    def _allocate(self, frame):
+
+        if self.previous is None or self.previous.shape != frame.shape or self.previous.dtype != frame.dtype:
+            self.previous = np.empty(frame.shape, dtype = frame.dtype)
+            self.output = np.empty(frame.shape, dtype = 'float32')
+            self.hasPrevious = False
+
+
+    def _get_polarity(self, frame):
+        # Returns 1 if 'frame' is the aligned frame of the pair, -1 if the
+        # previous frame is, using a subsampled difference. This is checked
+        # for every pair, as a missed scanner trigger swaps the order
+        s = self.polarityStep
+        diff = frame[::s, ::s].astype('float32') - self.previous[::s, ::s]
+        return -1 if np.min(diff) < -np.max(diff) else 1
+
+
+    def process(self, frame, frameNumber = None):
+        """ Adds a frame, returns the combination of this frame and the
+        previous one as a float32 image, or None if there is no previous frame
+        to pair with. The returned array is reused for the next frame, so
+        copy it if it is needed afterwards.
+        """
+        frame = np.asarray(frame)
+        self._allocate(frame)
+        self.numFrames = self.numFrames + 1
+
+        paired = self.hasPrevious
+        if paired and frameNumber is not None and self.previousNumber is not None:
+            paired = frameNumber - self.previousNumber == 1
+
+        result = None
+        if paired:
+            if self._get_polarity(frame) > 0:
+                np.subtract(frame, self.previous, out = self.output, dtype = 'float32')
+            else:
+                np.subtract(self.previous, frame, out = self.output, dtype = 'float32')
+            np.maximum(self.output, 0, out = self.output)
+            self.numCombined = self.numCombined + 1
+            result = self.output
+        elif self.hasPrevious:
+            self.numUnpaired = self.numUnpaired + 1
+
+        np.copyto(self.previous, frame)
+        self.hasPrevious = True
+        self.previousNumber = frameNumber
+
+        return result
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Preallocated ring buffer for raw camera frames.
+
+FrameRingBuffer holds a fixed number of frames in a single preallocated
+array of the camera's native data type, so that no memory is allocated as
+frames are acquired. A producer (e.g. an acquisition thread) either copies
+each frame into the next slot using put(), or writes into the slot directly
+using acquire_slot() and commit_slot(). A consumer reads frames in order
+using get_next() or the most recent frame using get_latest(). These return
+read-only views onto the buffer rather than copies. A view is borrowed
+until the consumer's next call to the same method, or to release(), and
+the slot will not be overwritten until then. Copy the frame if it is needed
+for longer.
+
+If the consumer falls behind, the oldest unread frame is overwritten and
+numOverruns is incremented, or, if overwrite is False, the new frame is
+discarded. Frames which cannot be stored at all are counted in numDropped.
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import collections
+import threading
+import time
+
+import numpy as np
+
+
+class FrameRingBuffer:
+    """ Ring buffer of 'numSlots' frames. The buffer is allocated when the
+    first frame is stored, or by calling allocate(), and is reallocated if
+    the frame shape or data type changes.
+
+    Arguments:
+        numSlots  : int
+                    number of frames held, default 10
+
+    Keyword Arguments:
+        shape     : tuple
+                    frame shape (h, w), if given the buffer is allocated now
+        dtype     : str or numpy dtype
+                    frame data type, default 'uint16'
+        overwrite : bool
+                    if True (default) the oldest unread frame is overwritten
+                    when the buffer is full, otherwise new frames are dropped
+    """
+
+    def __init__(self, numSlots = 10, shape = None, dtype = 'uint16', overwrite = True):
+
+        self.numSlots = max(int(numSlots), 3)
+        self.overwrite = overwrite
+        self.condition = threading.Condition()
+
+        self.frames = None
+        self.shape = None
+        self.dtype = None
+        self.free = collections.deque()
+        self.waiting = collections.deque()
+        self.writing = None
+        self.borrowedNext = None
+        self.borrowedLatest = None
+        self.latest = None
+        self.retired = []
+        self.reset_counters()
+
+        if shape is not None:
+            self.allocate(shape, dtype)
+
+
+    def allocate(self, shape, dtype = 'uint16'):
+        """ Allocates the buffer for frames of 'shape' and 'dtype'. Any frames
+        in the buffer are discarded.
+        """
+        with self.condition:
+
+            # Views borrowed from the old buffer stay valid, so the old
+            # buffer is kept until they are released
+            borrowed = set()
+            if self.borrowedNext is not None:
+                borrowed.add('next')
+            if self.borrowedLatest is not None:
+                borrowed.add('latest')
+            if self.frames is not None and len(borrowed) > 0:
+                self.retired.append((self.frames, self.timestamps, self.frameNumbers, borrowed))
+
+            self.shape = tuple(shape)
+            self.dtype = np.dtype(dtype)
+            self.frames = np.zeros((self.numSlots,) + self.shape, dtype = self.dtype)
+            self.timestamps = np.zeros(self.numSlots)
+            self.frameNumbers = np.zeros(self.numSlots, dtype = 'int64')
+
+            # Each slot is either free, waiting to be read, being written
+            # or borrowed by a consumer
+            self.free = collections.deque(range(self.numSlots))
+            self.waiting = collections.deque()
+            self.writing = None
+            self.borrowedNext = None
+            self.borrowedLatest = None
+            self.latest = None
+
+
+    def reset_counters(self):
+        """ Resets the frame, drop and overrun counters.
+        """
+        self.numWritten = 0
+        self.numRead = 0
+        self.numDropped = 0
+        self.numOverruns = 0
+
+
+    ##### Producer
+
+    def acquire_slot(self, shape = None, dtype = None):
+        """ Returns a writable view of the next slot, to be filled by the
+        producer and then passed to the consumer using commit_slot(). If
+        'shape' or 'dtype' differ from the current buffer, it is reallocated.
+        Returns None, and counts a dropped frame, if no slot is available.
+        """
+        if self.frames is None or (shape is not None and tuple(shape) != self.shape) \
+                or (dtype is not None and np.dtype(dtype) != self.dtype):
+            self.allocate(shape if shape is not None else self.shape,
+                          dtype if dtype is not None else self.dtype)
+
+        with self.condition:
+            if len(self.free) > 0:
+                slot = self.free.popleft()
+            else:
+                slot = self._reclaim_waiting_slot()
+                if slot is None:
+                    self.numDropped = self.numDropped + 1
+                    return None
+            self.writing = slot
+
+        return self.frames[slot]
+
+
+    def _reclaim_waiting_slot(self):
+        # Takes the oldest unread slot which is not borrowed, for overwriting
+        if not self.overwrite:
+            return None
+        for slot in self.waiting:
+            if slot != self.borrowedLatest:
+                self.waiting.remove(slot)
+                self.numOverruns = self.numOverruns + 1
+                return slot
+        return None
+
+
+    def commit_slot(self, timestamp = None, frameNumber = None):
+        """ Makes the slot returned by acquire_slot() available to the consumer.
+        'frameNumber' should be the camera frame number, so that frames
+        dropped by the buffer leave a gap. If None, frames are numbered in
+        the order they are stored.
+        """
+        with self.condition:
+            if self.writing is None:
+                return
+            slot = self.writing
+            self.writing = None
+            self.numWritten = self.numWritten + 1
+            self.timestamps[slot] = time.perf_counter() if timestamp is None else timestamp
+            self.frameNumbers[slot] = self.numWritten if frameNumber is None else frameNumber
+            self.waiting.append(slot)
+            self.latest = slot
+            self.condition.notify_all()
+
+
+    def put(self, image, timestamp = None, frameNumber = None):
+        """ Copies 'image' into the next slot, see commit_slot(). Returns False
+        if the frame was dropped.
+        """
+        image = np.asarray(image)
+        slot = self.acquire_slot(image.shape, image.dtype)
+        if slot is None:
+            return False
+        np.copyto(slot, image)
+        self.commit_slot(timestamp, frameNumber)
+        return True
+
+
+    ##### Consumer
+
+    def _borrow(self, slot):
+        view = self.frames[slot].view()
+        view.flags.writeable = False
+        return view
+
+
+    def _return_slot(self, slot):
+        # Returns a slot to the free list if it is no longer in use
+        if slot is None or slot in self.waiting or slot == self.writing:
+            return
+        if slot == self.borrowedNext or slot == self.borrowedLatest:
+            return
+        if slot not in self.free:
+            self.free.append(slot)
+
+
+    def _release_retired(self, kind):
+        # The consumer has released its 'next' or 'latest' view, so old
+        # buffers are no longer needed for it
+        for retired in self.retired:
+            retired[3].discard(kind)
+        self.retired = [retired for retired in self.retired if len(retired[3]) > 0]
+
+
+    def get_next(self):
+        """ Returns a read-only view of the oldest unread frame, or None if
+        there are none. The previous frame returned by get_next is released.
+        """
+        with self.condition:
+            previous = self.borrowedNext
+            self.borrowedNext = None
+            self._return_slot(previous)
+            self._release_retired('next')
+            if len(self.waiting) == 0:
+                return None
+            slot = self.waiting.popleft()
+            self.borrowedNext = slot
+            self.numRead = self.numRead + 1
+            return self._borrow(slot)
+
+
+    def get_next_wait(self, timeout = None):
+        """ As get_next, but waits up to 'timeout' (s) for a frame to arrive,
+        or indefinitely if timeout is None. Returns None if no frame arrives.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.waiting) > 0, timeout)
+        return self.get_next()
+
+
+    def get_latest(self):
+        """ Returns a read-only view of the most recent frame, whether or not
+        it has been read, or None if no frames have been stored. The previous
+        frame returned by get_latest is released.
+        """
+        with self.condition:
+            previous = self.borrowedLatest
+            self.borrowedLatest = self.latest
+            self._return_slot(previous)
+            self._release_retired('latest')
+            if self.latest is None:
+                return None
+            return self._borrow(self.latest)
+
+
+    def get_timestamp(self, frame):
+        """ Returns the time a frame returned by get_next or get_latest was
+        stored.
+        """
+        timestamps, frameNumbers, slot = self._slot_of(frame)
+        return float(timestamps[slot])
+
+
+    def get_frame_number(self, frame):
+        """ Returns the number of a frame returned by get_next or
+        get_latest, see commit_slot().
+        """
+        timestamps, frameNumbers, slot = self._slot_of(frame)
+        return int(frameNumbers[slot])
+
+
+    def _slot_of(self, frame):
+        # Finds the buffer (current or retired) holding a borrowed view, and
+        # returns its timestamps, frame numbers and the slot index
+        address = frame.__array_interface__['data'][0]
+        with self.condition:
+            buffers = [(self.frames, self.timestamps, self.frameNumbers)] if self.frames is not None else []
+            buffers = buffers + [retired[:3] for retired in self.retired]
+        for frames, timestamps, frameNumbers in buffers:
+            offset = address - frames.__array_interface__['data'][0]
+            if 0 <= offset < frames.nbytes:
+                return timestamps, frameNumbers, offset // frames[0].nbytes
+        raise ValueError("Frame is not from this buffer.")
+
+
+    def release(self):
+        """ Releases all frames borrowed by the consumer.
+        """
+        with self.condition:
+            borrowed = self.borrowedNext, self.borrowedLatest
+            self.borrowedNext = None
+            self.borrowedLatest = None
+            for slot in borrowed:
+                self._return_slot(slot)
+            self.retired = []
+
+
+    def flush(self):
+        """ Discards all unread frames.
+        """
+        with self.condition:
+            waiting = list(self.waiting)
+            self.waiting.clear()
+            for slot in waiting:
+                self._return_slot(slot)
+
+
+    def num_waiting(self):
+        """ Returns the number of unread frames.
+        """
+        return len(self.waiting)
+
+
+    def get_counters(self):
+        """ Returns a dictionary of frame counts.
+        """
+        return {'numWritten': self.numWritten,
+                'numRead': self.numRead,
+                'numDropped': self.numDropped,
+                'numOverruns': self.numOverruns,
+                'numWaiting': self.num_waiting()}
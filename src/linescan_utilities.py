@@ -5,10 +5,208 @@ Utility functions for linescan endomicroscopy.
 @author: Mike Hughes, Applied Optics Group, University of Kent
 """
 
+import time
+import functools
+
 import numpy as np
-import matplotlib.pyplot as plt
 
 
+"""  scan_waveform
+
+Generates the galvo voltage ramp for virtual slit scanning, a linear ramp
+from 'offset' to 'offset + scanRange' (V) at 'scanSpeed' (V/s) sampled at 
+'sampleRate' (Hz). If 'dual' is True (enhanced mode) a second ramp shifted by
+'dualOffset' (V) is appended, so that alternate frames are scanned with 
+alternate ramps. Returns the waveform and the number of points in a single
+ramp. Waveforms are cached, so the returned array is read-only.
+"""
+@functools.lru_cache(maxsize = 32)
+def scan_waveform(offset, scanSpeed, scanRange, dual, dualOffset, sampleRate):
+    
+    if scanSpeed > 0:
+        nPoints = np.abs(int(scanRange / scanSpeed * sampleRate))
+    else:
+        nPoints = 1
+    vals = np.linspace(offset, offset + scanRange, nPoints)
+    
+    if dual:
+        vals = np.concatenate((vals, vals + dualOffset))
+    
+    vals.flags.writeable = False
+    
+    return vals, nPoints
+    
+
+"""  line_profiles
+
+Reduces a stack of images to one row profile per image by averaging each
+image horizontally. The stack may be either (height, width, image no.), as
+used by calibrate_virtual_slit, or (image no., height, width), set using
+the optional parameter 'stackAxis' (2 or 0 respectively, default 2). The
+reduction is done in a single NumPy pass over the stack without copying it.
+Returns a 2D array (image no., height).
+"""
+def line_profiles(imStack, stackAxis = 2):
+    
+    if stackAxis == 2:
+        return np.mean(imStack, axis = 1).T
+    elif stackAxis == 0:
+        return np.mean(imStack, axis = 2)
+    else:
+        raise ValueError("stackAxis must be 0 or 2.")
+    
+    
+"""  line_peaks
+
+Finds the line in each of a set of row profiles (a 2D array of (image no., 
+height), as returned by line_profiles). Returns the peak row, the prominance 
+(maximum gradient relative to mean gradient) and the brightness (maximum
+relative to mean) for every profile, each as a 1D array.
+"""
+def line_peaks(profiles):
+    
+    profiles = np.atleast_2d(profiles)
+    
+    peak = np.argmax(profiles, axis = 1)
+    
+    # peak should be sharp, so have high gradient
+    grad = np.abs(np.diff(profiles, axis = 1))
+    prominance = np.max(grad, axis = 1) / np.mean(grad, axis = 1)
+    brightness = np.max(profiles, axis = 1) / np.mean(profiles, axis = 1)
+    
+    return peak, prominance, brightness
+    
+
+"""  subpixel_peaks
+
+Refines integer peak positions (e.g. from line_peaks) to sub-pixel accuracy
+for a set of row profiles (a 2D array of (image no., height)), all at once.
+A parabola is fitted through each peak and its two neighbours, or if the 
+optional parameter 'method' is 'gaussian' a parabola is fitted to the 
+logarithm of the profile, which is exact for a Gaussian line. Peaks on the
+first or last row cannot be refined and are returned unchanged.
+"""
+def subpixel_peaks(profiles, peak, method = 'parabolic'):
+    
+    profiles = np.atleast_2d(profiles)
+    peak = np.asarray(peak)
+    h = np.shape(profiles)[1]
+    
+    # Neighbouring rows, clipped at the edges of the image
+    idx = np.clip(peak, 1, h - 2)[:, None] + np.array([-1, 0, 1])
+    vals = np.take_along_axis(profiles, idx, axis = 1).astype('float64')
+    
+    if method == 'gaussian':
+        vals = np.log(np.maximum(vals, np.finfo('float64').tiny))
+    elif method != 'parabolic':
+        raise ValueError("method must be 'parabolic' or 'gaussian'.")
+    
+    a, b, c = vals[:,0], vals[:,1], vals[:,2]
+    denom = a - 2 * b + c
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        delta = np.where(denom < 0, 0.5 * (a - c) / denom, 0)
+    
+    # Only refine if the integer peak was not on the edge, and don't move
+    # by more than half a pixel
+    delta = np.where((peak > 0) & (peak < h - 1), np.clip(delta, -0.5, 0.5), 0)
+    
+    return peak + delta
+
+
+"""  robust_linear_fit
+
+Straight line fit of y against x which is insensitive to outliers, such 
+as an image where a false line was detected. The optional parameter 'method' 
+may be 'huber' (default), an iteratively reweighted least squares fit with 
+the Huber loss, 'ransac', which fits to the largest set of points consistent
+with a line through a pair of points, or 'linear', an ordinary least squares 
+fit. Points with a residual less than 'threshold' (default is 3 times a 
+robust estimate of the residual standard deviation) are inliers, and for
+the robust methods the final line is a least squares fit to the inliers. 
+With fewer than 4 points, outliers cannot be identified and all points are
+inliers unless a threshold is given.
+Returns the fit as (slope, intercept), the residuals of all points and a 
+boolean inlier mask.
+"""
+def robust_linear_fit(x, y, method = 'huber', threshold = None, **kwargs):
+    
+    if method not in ('huber', 'ransac', 'linear'):
+        raise ValueError("method must be 'huber', 'ransac' or 'linear'.")
+        
+    x = np.asarray(x, dtype = 'float64')
+    y = np.asarray(y, dtype = 'float64')
+    n = len(x)
+    
+    fit, _ = linear_fit(x, y)
+    
+    if method == 'huber' and n > 3:
+        huberK = kwargs.get('huberK', 1.345)
+        for iteration in range(kwargs.get('maxIterations', 20)):
+            residuals = y - fit[0] * x - fit[1]
+            scale = _robust_scale(residuals)
+            if scale == 0:
+                break
+            absRes = np.maximum(np.abs(residuals), 1e-12)
+            weights = np.minimum(1, huberK * scale / absRes)
+            newFit = np.polyfit(x, y, 1, w = np.sqrt(weights))
+            converged = np.allclose(newFit, fit, rtol = 1e-9, atol = 1e-12)
+            fit = newFit
+            if converged:
+                break
+            
+    elif method == 'ransac' and n > 3:
+        
+        # With few points (a calibration sweep) all pairs are tested, 
+        # otherwise a random selection of pairs
+        maxPairs = kwargs.get('maxPairs', 2000)
+        i1, i2 = np.triu_indices(n, 1)
+        if len(i1) > maxPairs:
+            choice = np.random.default_rng(kwargs.get('seed', 0)).choice(len(i1), maxPairs, replace = False)
+            i1, i2 = i1[choice], i2[choice]
+        dx = x[i2] - x[i1]
+        keep = dx != 0
+        i1, i2, dx = i1[keep], i2[keep], dx[keep]
+        slopes = (y[i2] - y[i1]) / dx
+        intercepts = y[i1] - slopes * x[i1]
+        
+        # Residuals of every point from every candidate line
+        allResiduals = np.abs(y[None,:] - slopes[:,None] * x[None,:] - intercepts[:,None])
+        if threshold is None:
+            ransacThreshold = 3 * _robust_scale(y - fit[0] * x - fit[1])
+        else:
+            ransacThreshold = threshold
+        if len(slopes) > 0 and ransacThreshold > 0:
+            counts = np.sum(allResiduals < ransacThreshold, axis = 1)
+            
+            # Ties are broken by the smallest total inlier residual
+            inlierRes = np.sum(np.where(allResiduals < ransacThreshold, allResiduals, 0), axis = 1)
+            best = np.lexsort((inlierRes, -counts))[0]
+            fit = slopes[best], intercepts[best]
+
+    residuals = y - fit[0] * x - fit[1]
+    if threshold is None and n <= 3:
+        
+        # Too few points to identify outliers
+        inliers = np.ones(n, dtype = bool)
+    else:
+        if threshold is None:
+            threshold = 3 * _robust_scale(residuals)
+        inliers = np.abs(residuals) <= max(threshold, 1e-9 * np.max(np.abs(y), initial = 0))
+    
+    # Final least squares fit to the inliers only
+    if method != 'linear' and np.sum(inliers) >= 2 and np.sum(inliers) < n:
+        fit, _ = linear_fit(x[inliers], y[inliers])
+        residuals = y - fit[0] * x - fit[1]
+    
+    return (fit[0], fit[1]), residuals, inliers
+
+
+def _robust_scale(residuals):
+    """ Estimate of standard deviation from the median absolute deviation.
+    """
+    return 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+    
+
 """  calibrate_virtual_slit
 
 Determines the scan parameters (speed, offset and range) for virtual
@@ -16,7 +214,16 @@ slit (endo)microscopy. The function takes a 3D numpy array (height, width, image
 which contains a stack of images acquired with the scanner fixed at different
 voltages. This should produce a strong horizontal line across the image,
 providing that the particular voltage results in the line being within the
-field-of-view. 
+field-of-view. A stack of (image no., height, width) can be used instead by
+passing the optional parameter 'stackAxis = 0'; in either case all images
+are analysed together and the stack is not copied.
+
+The line position in each image is found to sub-pixel accuracy (the method
+can be set using the optional parameter 'peakMethod' as 'parabolic' 
+(default), 'gaussian' or None for the nearest row). The voltage/position fit 
+is robust to images with falsely detected lines, the optional parameter 
+'fitMethod' may be 'huber' (default), 'ransac' or 'linear' (see 
+robust_linear_fit).
 
 The function checks each image for a prominant line, removing
 those that do not have one (this can be adjusted by change the optional parameter 
@@ -30,43 +237,271 @@ def calibrate_virtual_slit(imStack, volts, lineRate, **kwargs):
     
     prominanceThreshold = kwargs.get('promThreshold', 10)
     brightnessThreshold = kwargs.get('brightThreshold', 2)
+    stackAxis = kwargs.get('stackAxis', 2)
+    peakMethod = kwargs.get('peakMethod', 'parabolic')
+    fitMethod = kwargs.get('fitMethod', 'huber')
 
-    h,w,nImages = np.shape(imStack)
+    if stackAxis == 2:
+        h = np.shape(imStack)[0]
+    else:
+        h = np.shape(imStack)[1]
     
-    peak = np.zeros((nImages))
-    prominance = np.zeros((nImages))
-    brightness = np.zeros((nImages))
-
-    # For each image, average horizonally and then detect the peak
-    for i in range(nImages):
-        
-        plot = np.mean(imStack[:,:,i], axis = 1)
-    
-        peak[i] = np.argmax(plot)
-        #print(peak[i])
-    
-        # peak should be sharp, so have high gradient
-        grad = np.abs(np.diff(plot))
-        prominance[i] = np.max(grad) / np.mean(grad)
-        brightness[i] = np.max(plot) / np.mean(plot)
-        #plt.figure()
-        #plt.imshow(imStack[:,:,i])
-    #print(prominance)
-    #print(brightness)
+    # Average every image horizonally and then detect the peaks
+    profiles = line_profiles(imStack, stackAxis)
+    peak, prominance, brightness = line_peaks(profiles)
+    if peakMethod is not None:
+        peak = subpixel_peaks(profiles, peak, peakMethod)
     
     # Select only images where the prominance of the peak is sufficient to
     # mean we must have the laser line visible    
-    usePeak = peak[np.logical_and(prominance > prominanceThreshold, brightness > brightnessThreshold)]
-    useVolts = volts[np.logical_and(prominance > prominanceThreshold, brightness > brightnessThreshold)]
-    #print(usePeak)
-    #print(useVolts)      
-    # Linear fit allosw requiered scan speed and offset to be determined  
-    fit = np.polyfit(usePeak,useVolts,1)
-    #plt.figure()
-    #plt.plot(useVolts, usePeak)
+    valid = np.logical_and(prominance > prominanceThreshold, brightness > brightnessThreshold)
+    usePeak = peak[valid]
+    useVolts = np.asarray(volts)[valid]
+
+    # Linear fit allows required scan speed and offset to be determined  
+    fit, residuals, inliers = robust_linear_fit(usePeak, useVolts, fitMethod)
+
     speed = lineRate * fit[0]
     offset = fit[1]    
     scanRange = h * fit[0]
     
     return speed, offset, scanRange
+
+
+"""  linear_fit
+
+Least squares straight line fit of y against x. Returns the fit as
+(slope, intercept) and the standard errors of the slope and intercept. The
+errors are infinite if there are not enough points (at least 3) to estimate
+them.
+"""
+def linear_fit(x, y):
+    
+    x = np.asarray(x, dtype = 'float64')
+    y = np.asarray(y, dtype = 'float64')
+    n = len(x)
+    
+    xMean = np.mean(x)
+    yMean = np.mean(y)
+    sxx = np.sum((x - xMean)**2)
+    slope = np.sum((x - xMean) * (y - yMean)) / sxx
+    intercept = yMean - slope * xMean
+    
+    if n > 2:
+        residualVar = np.sum((y - slope * x - intercept)**2) / (n - 2)
+        slopeErr = np.sqrt(residualVar / sxx)
+        interceptErr = np.sqrt(residualVar * (1 / n + xMean**2 / sxx))
+    else:
+        slopeErr = np.inf
+        interceptErr = np.inf
+        
+    return (slope, intercept), (slopeErr, interceptErr)
+
+
+class VirtualSlitCalibrator:
+    """ Incremental version of calibrate_virtual_slit. Rather than requiring
+    the full stack of images, images are added one at a time, together with 
+    the scanner voltage they were acquired at, using add(). Only the row 
+    profile of each image is kept, and a running estimate of the scan 
+    parameters and their uncertainties is available after each image. This
+    allows a calibration sweep to be stopped as soon as the fit has 
+    converged.
+    
+    Arguments:
+        lineRate        : float
+                          line readout rate of the camera in Hz
+                          
+    Keyword Arguments:
+        promThreshold   : float
+                          minimum prominance for a line to be used, default 10
+        brightThreshold : float
+                          minimum brightness for a line to be used, default 2
+        peakMethod      : str or None
+                          sub-pixel line location method, see subpixel_peaks,
+                          default 'parabolic'
+        fitMethod       : str
+                          fitting method, see robust_linear_fit, default 
+                          'huber'
+    """
+    
+    def __init__(self, lineRate, **kwargs):
+        
+        self.lineRate = lineRate
+        self.prominanceThreshold = kwargs.get('promThreshold', 10)
+        self.brightnessThreshold = kwargs.get('brightThreshold', 2)
+        self.peakMethod = kwargs.get('peakMethod', 'parabolic')
+        self.fitMethod = kwargs.get('fitMethod', 'huber')
+        self.reset()
+        
+        
+    def reset(self):
+        """ Removes all images added so far.
+        """
+        self.height = None
+        self.volts = []
+        self.profiles = []
+        self.peaks = []
+        self.valid = []
+        self.inliers = None
+        self.fit = None
+        self.fitErr = None
+    
+    
+    def add(self, volts, image):
+        """ Adds an image acquired with the scanner fixed at 'volts'. Returns
+        True if a line was found in the image.
+        """
+        profile = np.mean(image, axis = 1)
+        peak, prominance, brightness = line_peaks(profile)
+        if self.peakMethod is not None:
+            peak = subpixel_peaks(profile, peak, self.peakMethod)
+        
+        self.height = len(profile)
+        self.volts.append(volts)
+        self.profiles.append(profile)
+        self.peaks.append(peak[0])
+        self.valid.append(prominance[0] > self.prominanceThreshold and brightness[0] > self.brightnessThreshold)
+        
+        if self.num_valid() >= 2:
+            usePeaks = np.array(self.peaks)[self.valid]
+            useVolts = np.array(self.volts)[self.valid]
+            
+            # Outliers are rejected before estimating the fit and its errors
+            fit, residuals, self.inliers = robust_linear_fit(usePeaks, useVolts, self.fitMethod)
+            if np.sum(self.inliers) < 2:
+                self.inliers[:] = True
+            self.fit, self.fitErr = linear_fit(usePeaks[self.inliers], useVolts[self.inliers])
+        
+        return self.valid[-1]
+    
+    
+    def num_valid(self):
+        """ Returns the number of images added so far which contained a line.
+        """
+        return int(np.sum(self.valid))
+        
+    
+    def get_scan_parameters(self):
+        """ Returns the current estimate of the scan speed (V/s), offset (V)
+        and range (V), or None if fewer than two lines have been found.
+        """
+        if self.fit is None:
+            return None
+        speed = self.lineRate * self.fit[0]
+        offset = self.fit[1]
+        scanRange = self.height * self.fit[0]
+        return speed, offset, scanRange
+    
+    
+    def get_uncertainty(self):
+        """ Returns the standard errors of the current estimate of the scan 
+        speed (V/s), offset (V) and range (V), or None if fewer than two lines 
+        have been found.
+        """
+        if self.fitErr is None:
+            return None
+        return self.lineRate * self.fitErr[0], self.fitErr[1], self.height * self.fitErr[0]
+    
+    
+    def is_converged(self, tolerance = 0.01, minLines = 4):
+        """ Returns True if at least 'minLines' lines have been found (not
+        counting outliers) and the standard error of the scan speed is less 
+        than 'tolerance' of its value.
+        """
+        if self.fit is None or np.sum(self.inliers) < minLines:
+            return False
+        return self.fitErr[0] < tolerance * np.abs(self.fit[0])
+        
+        
+class SettleDetector:
+    """ Determines when the scanner has settled after a voltage change by
+    watching the position of the line in a stream of images. Rather than 
+    waiting a fixed time, wait() returns as soon as the line position (or
+    the absence of a line) is stable over consecutive images. The time and
+    number of images needed for each call to wait() is recorded in 
+    'timings'.
+    
+    Keyword Arguments:
+        tolerance       : float
+                          maximum change in line position (pixels) between
+                          images for the line to be considered stable, 
+                          default 0.5
+        numStable       : int
+                          number of consecutive stable image pairs 
+                          required, default 1
+        timeout         : float
+                          maximum time (s) to wait for settling, default 1
+        promThreshold   : float
+                          minimum prominance for a line, default 10
+        brightThreshold : float
+                          minimum brightness for a line, default 2
+    """
+    
+    def __init__(self, **kwargs):
+        
+        self.tolerance = kwargs.get('tolerance', 0.5)
+        self.numStable = kwargs.get('numStable', 1)
+        self.timeout = kwargs.get('timeout', 1)
+        self.prominanceThreshold = kwargs.get('promThreshold', 10)
+        self.brightnessThreshold = kwargs.get('brightThreshold', 2)
+        self.timings = []
+        
+        
+    def line_position(self, image):
+        """ Returns the sub-pixel position of the line in an image, or None if
+        there is no line.
+        """
+        profile = np.mean(image, axis = 1)
+        peak, prominance, brightness = line_peaks(profile)
+        if prominance[0] > self.prominanceThreshold and brightness[0] > self.brightnessThreshold:
+            return subpixel_peaks(profile, peak)[0]
+        else:
+            return None
+        
+        
+    def wait(self, getImage):
+        """ Repeatedly calls getImage(), which should return the next image
+        acquired, until the line position is stable. Returns the last image.
+        Whether settling was achieved before the timeout, the time taken and
+        the number of images used are appended to 'timings' as a dictionary.
+        """
+        t0 = time.perf_counter()
+        
+        lastPosition = None
+        numStable = 0
+        numImages = 0
+        settled = False
+        
+        while True:
+            image = getImage()
+            position = self.line_position(image)
+            numImages = numImages + 1
+            
+            if numImages > 1:
+                if position is None and lastPosition is None:
+                    numStable = numStable + 1
+                elif position is not None and lastPosition is not None and np.abs(position - lastPosition) <= self.tolerance:
+                    numStable = numStable + 1
+                else:
+                    numStable = 0
+                    
+            lastPosition = position
+
+            if numStable >= self.numStable:
+                settled = True
+                break
+            if time.perf_counter() - t0 > self.timeout:
+                break
+            
+        self.timings.append({'settled': settled, 
+                             'settleTime': time.perf_counter() - t0,
+                             'numImages': numImages,
+                             'position': position})
+        
+        return image
+    
     
+    def reset_timings(self):
+        """ Clears the record of timings.
+        """
+        self.timings = []
@@ -0,0 +1,744 @@
+# -*- coding: utf-8 -*-
+"""
+Real-time mosaicing of processed fibre bundle images.
+
+MosaicStage registers each new frame to a reference frame using phase
+correlation (FFT) on a downsampled copy of the frame, refines the shift by
+registering the centre of the frames at full resolution, and blends it into
+a TiledCanvas at the position of the reference frame plus the shift. A new
+reference frame is taken when the probe has moved by more than
+'refDistance' of the frame size, so registration errors only add up once
+per reference frame. The canvas is made of square
+tiles which are only allocated when an image is blended into them, so the
+mosaic can grow in any direction. If a maximum number of tiles in memory
+is set, the least recently used tiles are saved to disk and loaded again
+when needed, so memory use is bounded however large the mosaic becomes.
+
+To save time when the probe is not moving, registration (and blending) can
+be skipped for frames which differ from the last registered frame by less
+than 'motionThreshold', using a cheap comparison of thumbnails.
+
+MosaicWorker runs a MosaicStage in its own thread, taking frames through a
+bounded queue (frames are dropped if it falls behind, it never blocks the
+caller), and periodically renders a downsampled preview of the mosaic for
+display.
+
+As in the pybundle Mosaic, the mosaic can be reset automatically if the
+registration confidence falls below 'resetThresh' (e.g. the probe has moved
+too fast) or the mean intensity of a frame falls below 'resetIntensity'
+(e.g. the probe is out of contact).
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import os
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import collections
+
+import numpy as np
+
+from display_pipeline import decimate
+
+
+class ShiftEstimator:
+    """ Estimates the shift between images by phase correlation.
+
+    prepare() returns the FFT of a windowed image, and estimate() the shift
+    (dy, dx) of the second image relative to the first, to sub-pixel
+    accuracy, and a confidence between 0 and 1 (the height of the phase
+    correlation peak). A shift of (dy, dx) means that features in the
+    first image appear at (y + dy, x + dx) in the second.
+
+    The sub-pixel position is found by evaluating the correlation on a grid
+    'upsample' times finer than the pixels around the peak, using a matrix
+    Fourier transform of the cross power spectrum (Guizar-Sicairos et al.,
+    Opt. Lett. 33, 156 (2008)). Fitting a parabola to the peak is biased
+    towards whole pixels, by up to a few tenths of a pixel, and as shifts
+    are accumulated from frame to frame the bias adds up.
+
+    Keyword Arguments:
+        upsample : int
+                   sub-pixel resolution is 1 / upsample pixels, default 20
+        radius   : float or None
+                   for circular images, the radius of the window as a
+                   fraction of half the image size, default None (square
+                   window)
+    """
+
+    def __init__(self, **kwargs):
+
+        self.upsample = kwargs.get('upsample', 20)
+        self.radius = kwargs.get('radius', None)
+        self.windows = {}
+        self.kernels = {}
+
+
+    def _window(self, shape):
+
+        if shape not in self.windows:
+            if self.radius is None:
+                window = np.outer(np.hanning(shape[0]), np.hanning(shape[1]))
+            else:
+                # Hann window falling to zero at 'radius', so that the edge
+                # of a circular image, which does not move, is not
+                # registered
+                y, x = np.mgrid[0:shape[0], 0:shape[1]]
+                r = np.sqrt((y - (shape[0] - 1) / 2)**2 + (x - (shape[1] - 1) / 2)**2) / (self.radius * min(shape) / 2)
+                window = 0.5 + 0.5 * np.cos(np.pi * np.minimum(r, 1))
+            self.windows[shape] = window.astype('float32')
+        return self.windows[shape]
+
+
+    def prepare(self, image):
+        """ Returns the FFT of 'image' for use by estimate().
+        """
+        image = np.asarray(image, dtype = 'float32')
+        image = (image - np.mean(image)) * self._window(image.shape)
+        return np.fft.rfft2(image)
+
+
+    def _kernel(self, n, half):
+        # Fourier frequencies of an axis of length n (half the spectrum if
+        # 'half', as for rfft2) and the sub-pixel offsets to evaluate
+        key = (n, half)
+        if key not in self.kernels:
+            if half:
+                freqs = np.arange(n // 2 + 1)
+                # Frequencies not stored by rfft2 are the conjugates of
+                # those that are, so count all but 0 and n / 2 twice
+                weights = np.full(len(freqs), 2.0)
+                weights[0] = 1
+                if n % 2 == 0:
+                    weights[-1] = 1
+            else:
+                freqs = np.fft.fftfreq(n) * n
+                weights = None
+            offsets = np.arange(-self.upsample, self.upsample + 1) / self.upsample
+            self.kernels[key] = (freqs, weights, offsets)
+        return self.kernels[key]
+
+
+    def _refine(self, cross, peak, shape):
+        # Evaluates the correlation from -1 to +1 pixels around the integer
+        # peak, in steps of 1 / upsample, and returns the position of the
+        # maximum
+        freqsY, _, offsets = self._kernel(shape[0], False)
+        freqsX, weights, _ = self._kernel(shape[1], True)
+        ky = np.exp(2j * np.pi * np.outer(peak[0] + offsets, freqsY) / shape[0])
+        kx = np.exp(2j * np.pi * np.outer(freqsX, peak[1] + offsets) / shape[1])
+        corr = np.real(ky @ (cross * weights) @ kx)
+        iy, ix = np.unravel_index(np.argmax(corr), corr.shape)
+
+        # On the fine grid the peak is close to a parabola, so a parabolic
+        # fit removes most of the remaining error
+        iy = min(max(iy, 1), len(offsets) - 2)
+        ix = min(max(ix, 1), len(offsets) - 2)
+        sub = [0, 0]
+        for axis, values in enumerate((corr[iy - 1:iy + 2, ix], corr[iy, ix - 1:ix + 2])):
+            denom = values[0] - 2 * values[1] + values[2]
+            if denom < 0:
+                sub[axis] = 0.5 * (values[0] - values[2]) / denom / self.upsample
+        return peak[0] + offsets[iy] + sub[0], peak[1] + offsets[ix] + sub[1]
+
+
+    def estimate(self, fft1, fft2, shape):
+        """ Returns (dy, dx, confidence) for two prepared images of 'shape'.
+        """
+        cross = fft2 * np.conj(fft1)
+        cross /= np.abs(cross) + 1e-12
+        corr = np.fft.irfft2(cross, s = shape)
+
+        peak = np.unravel_index(np.argmax(corr), shape)
+        confidence = float(corr[peak])
+
+        shift = list(self._refine(cross, peak, shape))
+        for axis in range(2):
+            if shift[axis] > shape[axis] / 2:
+                shift[axis] = shift[axis] - shape[axis]
+
+        return shift[0], shift[1], confidence
+
+
+class TiledCanvas:
+    """ Unbounded 2D canvas of float32 tiles allocated on demand.
+
+    Each tile stores the blended value (premultiplied by coverage) and the
+    coverage, so that images can be blended in with a weight mask and the
+    most recent image dominates.
+
+    Keyword Arguments:
+        tileSize    : int
+                      width and height of tiles, default 256
+        maxTiles    : int or None
+                      maximum number of tiles kept in memory, others are
+                      saved to disk, default None (no limit)
+        spillFolder : str or None
+                      folder for tiles saved to disk, default is a temporary
+                      folder which is removed by close()
+    """
+
+    def __init__(self, **kwargs):
+
+        self.tileSize = kwargs.get('tileSize', 256)
+        self.maxTiles = kwargs.get('maxTiles', None)
+        self.spillFolder = kwargs.get('spillFolder', None)
+        self.ownsSpillFolder = False
+
+        self.tiles = collections.OrderedDict()
+        self.spilled = set()
+        self.numSpills = 0
+        self.numLoads = 0
+
+
+    def clear(self):
+        """ Removes all tiles.
+        """
+        self.tiles.clear()
+        for key in self.spilled:
+            try:
+                os.remove(self._spill_filename(key))
+            except OSError:
+                pass
+        self.spilled = set()
+
+
+    def close(self):
+        """ Removes all tiles and the spill folder if it was created here.
+        """
+        self.clear()
+        if self.ownsSpillFolder and self.spillFolder is not None:
+            shutil.rmtree(self.spillFolder, ignore_errors = True)
+            self.spillFolder = None
+            self.ownsSpillFolder = False
+
+
+    def _spill_filename(self, key):
+
+        return os.path.join(self.spillFolder, f"tile_{key[0]}_{key[1]}.npy")
+
+
+    def _spill(self):
+        # Saves least recently used tiles to disk until within maxTiles
+        if self.spillFolder is None:
+            self.spillFolder = tempfile.mkdtemp(prefix = 'mosaic_')
+            self.ownsSpillFolder = True
+        os.makedirs(self.spillFolder, exist_ok = True)
+        while len(self.tiles) > self.maxTiles:
+            key, tile = self.tiles.popitem(last = False)
+            np.save(self._spill_filename(key), tile)
+            self.spilled.add(key)
+            self.numSpills = self.numSpills + 1
+
+
+    def get_tile(self, key, create = True):
+        """ Returns the tile (2, tileSize, tileSize) at tile index 'key'
+        (row, column), loading it from disk or allocating it if necessary,
+        or None if it does not exist and 'create' is False.
+        """
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+
+        if key in self.spilled:
+            tile = np.load(self._spill_filename(key))
+            self.spilled.discard(key)
+            self.numLoads = self.numLoads + 1
+        elif create:
+            tile = np.zeros((2, self.tileSize, self.tileSize), dtype = 'float32')
+        else:
+            return None
+
+        self.tiles[key] = tile
+        if self.maxTiles is not None and len(self.tiles) > self.maxTiles:
+            self._spill()
+        return tile
+
+
+    def blend(self, image, weight, y, x):
+        """ Blends 'image' into the canvas with its top left corner at
+        integer position (y, x), using 'weight' (same shape as image, values
+        from 0 to 1) as the opacity.
+        """
+        h, w = np.shape(image)
+        t = self.tileSize
+        for ty in range(y // t, (y + h - 1) // t + 1):
+            for tx in range(x // t, (x + w - 1) // t + 1):
+
+                # Overlap of image and tile in canvas coordinates
+                y0, y1 = max(y, ty * t), min(y + h, (ty + 1) * t)
+                x0, x1 = max(x, tx * t), min(x + w, (tx + 1) * t)
+                alpha = weight[y0 - y:y1 - y, x0 - x:x1 - x]
+                if not alpha.any():
+                    continue
+
+                tile = self.get_tile((ty, tx))
+                value = tile[0, y0 - ty * t:y1 - ty * t, x0 - tx * t:x1 - tx * t]
+                coverage = tile[1, y0 - ty * t:y1 - ty * t, x0 - tx * t:x1 - tx * t]
+                keep = 1 - alpha
+                value *= keep
+                value += alpha * image[y0 - y:y1 - y, x0 - x:x1 - x]
+                coverage *= keep
+                coverage += alpha
+
+
+    def get_keys(self):
+        """ Returns the indices of all tiles, in memory or on disk.
+        """
+        return list(self.tiles.keys()) + list(self.spilled)
+
+
+    def get_bounds(self):
+        """ Returns (y0, x0, y1, x1), the extent of all tiles in canvas
+        coordinates, or None if the canvas is empty.
+        """
+        keys = self.get_keys()
+        if len(keys) == 0:
+            return None
+        t = self.tileSize
+        rows = [key[0] for key in keys]
+        cols = [key[1] for key in keys]
+        return min(rows) * t, min(cols) * t, (max(rows) + 1) * t, (max(cols) + 1) * t
+
+
+    def get_image(self, maxSize = None):
+        """ Returns the whole canvas as a float32 image, with uncovered areas
+        0, and its top left position in canvas coordinates, or (None, None)
+        if the canvas is empty. If 'maxSize' (height, width) is given, the
+        image is downsampled by a power of two so that it fits. Tiles on disk
+        are read without being loaded into memory.
+        """
+        bounds = self.get_bounds()
+        if bounds is None:
+            return None, None
+        y0, x0, y1, x1 = bounds
+        t = self.tileSize
+
+        factor = 1
+        if maxSize is not None:
+            while factor < t and ((y1 - y0) / factor > maxSize[0] or (x1 - x0) / factor > maxSize[1]):
+                factor = factor * 2
+        ts = t // factor
+
+        output = np.zeros(((y1 - y0) // factor, (x1 - x0) // factor), dtype = 'float32')
+        for key in self.get_keys():
+            tile = self.tiles.get(key)
+            if tile is None:
+                tile = np.load(self._spill_filename(key), mmap_mode = 'r')
+            if factor > 1:
+                tile = tile.reshape(2, ts, factor, ts, factor).mean(axis = (2, 4))
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                values = np.where(tile[1] > 0, tile[0] / tile[1], 0)
+            oy = (key[0] * t - y0) // factor
+            ox = (key[1] * t - x0) // factor
+            output[oy:oy + ts, ox:ox + ts] = values
+
+        return output, (y0, x0)
+
+
+    def get_memory(self):
+        """ Returns the number of bytes used by tiles in memory.
+        """
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+
+class MosaicStage:
+    """ Registers and blends frames into a mosaic, see module description.
+
+    Keyword Arguments:
+        regSize         : int
+                          frames are downsampled to at most this size for
+                          registration, default 128
+        cropFraction    : float
+                          diameter of circular region of each frame used, as
+                          a fraction of the frame size, default 0.9
+        blendDist       : float
+                          width of feathered edge (pixels), default 20
+        circular        : boolean
+                          if True (default) frames are circular (as bundle
+                          images), otherwise rectangular
+        motionThreshold : float or None
+                          registration is skipped if the mean absolute change
+                          from the last registered frame, relative to its mean,
+                          is less than this, default None (never skip)
+        minBlendDistance: float
+                          a frame is only blended in if it has moved by at
+                          least this many pixels since the last one blended,
+                          default 2
+        refDistance     : float
+                          frames are registered to the same reference frame
+                          until they have moved from it by more than this
+                          fraction of the frame size, default 0.2
+        resetThresh     : float or None
+                          reset the mosaic if registration confidence falls
+                          below this, default None
+        resetIntensity  : float or None
+                          reset the mosaic if the mean frame intensity falls
+                          below this, default None
+
+    Other keyword arguments (tileSize, maxTiles, spillFolder) are passed to
+    TiledCanvas.
+    """
+
+    def __init__(self, **kwargs):
+
+        self.regSize = kwargs.get('regSize', 128)
+        self.cropFraction = kwargs.get('cropFraction', 0.9)
+        self.blendDist = kwargs.get('blendDist', 20)
+        self.circular = kwargs.get('circular', True)
+        self.motionThreshold = kwargs.get('motionThreshold', None)
+        self.minBlendDistance = kwargs.get('minBlendDistance', 2)
+        self.refDistance = kwargs.get('refDistance', 0.2)
+        self.resetThresh = kwargs.get('resetThresh', None)
+        self.resetIntensity = kwargs.get('resetIntensity', None)
+
+        self.canvas = TiledCanvas(**kwargs)
+        self.estimator = ShiftEstimator(radius = self.cropFraction if self.circular else None)
+        self.fineEstimator = ShiftEstimator()
+        self.weight = None
+        self.reset()
+
+
+    def reset(self):
+        """ Clears the mosaic and starts again from the next frame.
+        """
+        self.canvas.clear()
+        self.refFFT = None
+        self.refCropFFT = None
+        self.refThumb = None
+        self.refPosition = np.zeros(2)
+        self.position = np.zeros(2)
+        self.lastBlended = None
+        self.lastShift = (0, 0)
+        self.lastConfidence = None
+
+        self.numFrames = 0
+        self.numRegistered = 0
+        self.numSkipped = 0
+        self.numBlended = 0
+        self.numReferences = 0
+        self.numResets = 0
+
+
+    def close(self):
+        """ Releases the canvas, including any tiles on disk.
+        """
+        self.canvas.close()
+
+
+    def _get_weight(self, shape):
+        # Feathered mask, computed once for each frame shape
+        if self.weight is None or self.weight.shape != shape:
+            h, w = shape
+            y, x = np.mgrid[0:h, 0:w]
+            if self.circular:
+                radius = self.cropFraction * min(h, w) / 2
+                dist = radius - np.sqrt((y - (h - 1) / 2)**2 + (x - (w - 1) / 2)**2)
+            else:
+                dist = np.minimum(np.minimum(y, h - 1 - y), np.minimum(x, w - 1 - x)) + 1
+            self.weight = np.clip(dist / max(self.blendDist, 1), 0, 1).astype('float32')
+        return self.weight
+
+
+    def _thumbnail(self, small):
+
+        thumb = small[::4, ::4]
+        return thumb / max(float(np.mean(thumb)), 1e-9)
+
+
+    def _set_reference(self, frame, small, fft = None):
+        # Makes 'frame' the frame that following frames are registered to
+        self.refFFT = self.estimator.prepare(small) if fft is None else fft
+        self.refCropFFT = None
+        if np.shape(frame)[0] > np.shape(small)[0]:
+            self.refCropFFT = self.fineEstimator.prepare(self._crop(frame))
+        self.refPosition = self.position.copy()
+        self.numReferences = self.numReferences + 1
+
+
+    def _crop(self, frame, dy = 0, dx = 0):
+        # Returns the regSize square at the centre of 'frame' moved by
+        # (dy, dx), or None if that is not within the frame
+        h, w = np.shape(frame)
+        size = min(self.regSize, h, w)
+        y = (h - size) // 2 + dy
+        x = (w - size) // 2 + dx
+        if y < 0 or x < 0 or y + size > h or x + size > w:
+            return None
+        return frame[y:y + size, x:x + size]
+
+
+    def _refine_shift(self, frame, dy, dx):
+        # Refines the shift (dy, dx) found from downsampled frames by
+        # registering the centre of the last frame to the same features in
+        # 'frame' at full resolution. Averaging blocks of pixels when
+        # downsampling makes the shift depend on where features fall
+        # within the blocks, an error of up to a few tenths of a
+        # downsampled pixel which would add up along the path.
+        if self.refCropFFT is None:
+            return dy, dx
+        iy, ix = int(round(dy)), int(round(dx))
+        crop = self._crop(frame, iy, ix)
+        if crop is None:
+            return dy, dx
+        fineY, fineX, _ = self.fineEstimator.estimate(self.refCropFFT, self.fineEstimator.prepare(crop), crop.shape)
+        if abs(fineY) > 2 or abs(fineX) > 2:
+            return dy, dx
+        return iy + fineY, ix + fineX
+
+
+    def process(self, frame):
+        """ Adds a frame to the mosaic. Returns the position (y, x) of the
+        frame in the mosaic, or None if the mosaic was reset.
+        """
+        frame = np.asarray(frame, dtype = 'float32')
+        self.numFrames = self.numFrames + 1
+
+        if self.resetIntensity is not None and np.mean(frame[::4, ::4]) < self.resetIntensity:
+            self._reset_mosaic()
+            return None
+
+        small = decimate(frame, (self.regSize, self.regSize))
+        scale = np.shape(frame)[0] / np.shape(small)[0]
+
+        if self.refFFT is not None:
+            thumb = self._thumbnail(small)
+            if (self.motionThreshold is not None and thumb.shape == self.refThumb.shape
+                    and np.mean(np.abs(thumb - self.refThumb)) < self.motionThreshold):
+                self.numSkipped = self.numSkipped + 1
+                return tuple(self.position)
+
+            fft = self.estimator.prepare(small)
+            dy, dx, confidence = self.estimator.estimate(self.refFFT, fft, small.shape)
+            if scale > 1:
+                dy, dx = self._refine_shift(frame, dy * scale, dx * scale)
+            else:
+                dy, dx = dy * scale, dx * scale
+            self.numRegistered = self.numRegistered + 1
+            self.lastConfidence = confidence
+            self.refThumb = thumb
+
+            if self.resetThresh is not None and confidence < self.resetThresh:
+                self._reset_mosaic()
+                return None
+
+            # Features moving by +shift means the probe moved by -shift
+            position = self.refPosition - (dy, dx)
+            self.lastShift = tuple(self.position - position)
+            self.position = position
+
+            # The reference frame is kept until the probe has moved far
+            # from it, so that errors only add up from one reference
+            # frame to the next rather than from every frame
+            if np.max(np.abs(self.position - self.refPosition)) > self.refDistance * min(np.shape(frame)):
+                self._set_reference(frame, small, fft)
+        else:
+            self.refThumb = self._thumbnail(small)
+            self._set_reference(frame, small)
+
+        if self.lastBlended is None or np.max(np.abs(self.position - self.lastBlended)) >= self.minBlendDistance:
+            y, x = np.round(self.position).astype(int)
+            self.canvas.blend(frame, self._get_weight(frame.shape), y, x)
+            self.lastBlended = self.position.copy()
+            self.numBlended = self.numBlended + 1
+
+        return tuple(self.position)
+
+
+    def _reset_mosaic(self):
+
+        numResets = self.numResets
+        self.reset()
+        self.numResets = numResets + 1
+
+
+    def get_mosaic(self, maxSize = None):
+        """ Returns the mosaic as a float32 image, downsampled to fit within
+        'maxSize' (height, width) if given, or None if it is empty.
+        """
+        return self.canvas.get_image(maxSize)[0]
+
+
+class MosaicWorker:
+    """ Runs a MosaicStage in a background thread.
+
+    Keyword Arguments:
+        queueSize   : int
+                      maximum number of frames waiting, default 4
+        previewSize : (int, int)
+                      size (height, width) of preview mosaic, default
+                      (500, 500)
+        previewFps  : float
+                      maximum rate of preview updates, default 5
+
+    Other keyword arguments are passed to MosaicStage.
+    """
+
+    def __init__(self, **kwargs):
+
+        self.queueSize = kwargs.get('queueSize', 4)
+        self.previewSize = kwargs.get('previewSize', (500, 500))
+        self.previewFps = kwargs.get('previewFps', 5)
+
+        self.stage = MosaicStage(**kwargs)
+        self.queue = queue.Queue(maxsize = self.queueSize)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.resetRequested = False
+
+        self.preview = None
+        self.previewTime = 0
+        self.previewChanged = False
+        self.numSubmitted = 0
+        self.numDropped = 0
+        self.processTime = 0
+
+
+    # The processor is pickled when processing is on another core (CAS
+    # multiCore), so the thread, lock and queue are recreated when unpickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('queue', 'lock', 'thread'):
+            del state[key]
+        state['running'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.queue = queue.Queue(maxsize = self.queueSize)
+        self.lock = threading.Lock()
+        self.thread = None
+
+
+    # Reset options are set on the stage, as the CAS mosaic panel sets them
+    # on the processor's mosaic
+    @property
+    def resetThresh(self):
+        return self.stage.resetThresh
+
+    @resetThresh.setter
+    def resetThresh(self, value):
+        self.stage.resetThresh = value
+
+    @property
+    def resetIntensity(self):
+        return self.stage.resetIntensity
+
+    @resetIntensity.setter
+    def resetIntensity(self, value):
+        self.stage.resetIntensity = value
+
+
+    def start(self):
+        """ Starts the worker thread.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.running = True
+            self.thread = threading.Thread(target = self._run, daemon = True)
+            self.thread.start()
+
+
+    def stop(self):
+        """ Stops the worker thread and releases the mosaic.
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout = 2)
+            self.thread = None
+        self.stage.close()
+
+
+    def submit(self, frame, copy = False):
+        """ Queues a frame for mosaicing. Returns False if the queue is full
+        and the frame was dropped.
+        """
+        if frame is None:
+            return False
+        try:
+            self.queue.put_nowait(np.array(frame) if copy else frame)
+        except queue.Full:
+            self.numDropped = self.numDropped + 1
+            return False
+        self.numSubmitted = self.numSubmitted + 1
+        return True
+
+
+    def reset(self):
+        """ Clears the mosaic, done by the worker before the next frame.
+        """
+        self.resetRequested = True
+
+
+    def get_mosaic(self):
+        """ Returns the latest preview of the mosaic, or None if there is
+        none yet.
+        """
+        with self.lock:
+            self.previewChanged = False
+            return self.preview
+
+
+    def is_preview_changed(self):
+        """ Returns True if the preview has changed since get_mosaic() was
+        last called.
+        """
+        return self.previewChanged
+
+
+    def get_stats(self):
+        """ Returns a dictionary of frame counts, the last shift and
+        confidence, the time to process the last frame and canvas memory.
+        """
+        stage = self.stage
+        return {'numSubmitted': self.numSubmitted,
+                'numDropped': self.numDropped,
+                'numFrames': stage.numFrames,
+                'numRegistered': stage.numRegistered,
+                'numSkipped': stage.numSkipped,
+                'numBlended': stage.numBlended,
+                'numReferences': stage.numReferences,
+                'numResets': stage.numResets,
+                'lastShift': stage.lastShift,
+                'lastConfidence': stage.lastConfidence,
+                'processTime': self.processTime,
+                'tilesInMemory': len(stage.canvas.tiles),
+                'tilesOnDisk': len(stage.canvas.spilled)}
+
+
+    def _update_preview(self, force = False):
+
+        if not force and time.perf_counter() - self.previewTime < 1 / self.previewFps:
+            return
+        preview = self.stage.get_mosaic(self.previewSize)
+        with self.lock:
+            self.preview = preview
+            self.previewChanged = True
+        self.previewTime = time.perf_counter()
+
+
+    def _run(self):
+
+        while self.running:
+            if self.resetRequested:
+                self.resetRequested = False
+                self.stage.reset()
+                self._update_preview(force = True)
+
+            try:
+                frame = self.queue.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+
+            t0 = time.perf_counter()
+            try:
+                self.stage.process(frame)
+            except Exception as e:
+                print(f"Mosaic error: {e}")
+                continue
+            self.processTime = time.perf_counter() - t0
+            self._update_preview()
@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-process acquisition and processing using shared memory.
+
+In the normal (threaded) pipeline, acquisition, processing and display all
+run in one Python process and share the GIL, so under load pybundle
+processing can starve the camera thread and frames are dropped.
+MultiProcessPipeline instead runs:
+    - an acquisition process, which owns the camera
+    - one or more processing worker processes
+    - the calling (e.g. GUI or engine) process, which displays or records
+      the processed frames
+
+Frames are never pickled. Raw and processed frames are held in
+SharedFrameSlots, a fixed number of frame slots in a
+multiprocessing.shared_memory block, and only small descriptors (slot
+index, sequence number, camera frame number and timestamp) are passed
+between processes through queues. Each slot is owned by one process at a
+time and is returned to the producer through a queue of free slots.
+
+The acquisition process never waits: if all raw slots are in use the frame
+is dropped and counted. Raw frames are shared between the workers in the
+order they were acquired, so processing scales across workers. A worker
+reserves an output slot before taking a frame, and results are put back in
+acquisition order by get_next(), so frames are always delivered in order.
+
+The processor is any picklable callable taking a raw frame and returning
+the processed frame, e.g. the process method of a calibrated PyBundle. It
+is copied to each worker when the pipeline starts, so later changes (e.g.
+recalibration) require a restart. Frames are processed independently, so
+dual (enhanced) mode, which combines consecutive frames, is not supported.
+Cameras which need objects in the calling process (e.g.
+SimulatedLinescanCamera, which needs the scanner) cannot be used.
+
+    pipeline = MultiProcessPipeline('MappedFileCamera', pyb.process,
+                                    numWorkers = 3, filename = 'record.tif')
+    pipeline.start()
+    frame = pipeline.get_next_wait(1)
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import os
+import time
+import queue
+import importlib
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+
+class SharedFrameSlots:
+    """ 'numSlots' frames of 'shape' and 'dtype' in a shared memory block.
+    The block is created by the process that creates this object, which
+    must also call unlink() when it is no longer needed. Other processes
+    attach to it using the spec, see get_spec() and attach().
+    """
+
+    def __init__(self, numSlots, shape, dtype, name = None):
+
+        self.numSlots = numSlots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(numSlots * np.prod(self.shape)) * self.dtype.itemsize, 1)
+        if name is None:
+            self.sharedMemory = shared_memory.SharedMemory(create = True, size = size)
+            self.owner = True
+        else:
+            self.sharedMemory = shared_memory.SharedMemory(name = name)
+            self.owner = False
+        self.frames = np.ndarray((numSlots,) + self.shape, dtype = self.dtype, buffer = self.sharedMemory.buf)
+
+
+    def get_spec(self):
+        """ Returns what another process needs to attach to the slots.
+        """
+        return self.numSlots, self.shape, self.dtype.str, self.sharedMemory.name
+
+
+    @classmethod
+    def attach(cls, spec):
+        """ Attaches to slots created by another process, given the spec
+        returned by get_spec().
+        """
+        numSlots, shape, dtype, name = spec
+        return cls(numSlots, shape, dtype, name)
+
+
+    def view(self, slot):
+        """ Returns a read-only view of the frame in 'slot'.
+        """
+        view = self.frames[slot].view()
+        view.flags.writeable = False
+        return view
+
+
+    def close(self):
+        """ Detaches from the shared memory. Views of the frames must not be
+        used after this.
+        """
+        self.frames = None
+        self.sharedMemory.close()
+
+
+    def unlink(self):
+        """ Closes and, if this process created it, frees the shared memory.
+        """
+        self.close()
+        if self.owner:
+            self.sharedMemory.unlink()
+
+
+# Indices of counters shared between processes
+NUM_ACQUIRED = 0
+NUM_DROPPED = 1
+NUM_PROCESSED = 2
+NUM_FAILED = 3
+PROCESS_TIME_US = 4
+NUM_COUNTERS = 5
+
+
+def _increment(counters, index, value = 1):
+    with counters.get_lock():
+        counters[index] = counters[index] + value
+
+
+def _open_camera(camName, cameraID, frameRate, camArgs):
+    # Cameras are looked up in the same way as by the CAS acquisition thread
+    try:
+        camModule = importlib.import_module("cas_gui.cameras." + camName)
+    except ImportError:
+        camModule = importlib.import_module(camName)
+    cam = getattr(camModule, camName)(**camArgs)
+    cam.open_camera(cameraID)
+    if frameRate is not None:
+        cam.set_frame_rate(frameRate)
+    return cam
+
+
+def _close_camera(cam):
+    cam.close_camera()
+    cam.dispose()
+
+
+def _acquire(camName, cameraID, frameRate, camArgs, infoQueue, specQueue, freeSlots, taskQueue,
+             counters, stopEvent, numWorkers):
+    # Acquisition process. Reports the frame shape and type, waits for the
+    # shared memory to be created, and then copies each frame into a free
+    # slot and queues its descriptor for the workers.
+    try:
+        cam = _open_camera(camName, cameraID, frameRate, camArgs)
+        frame = None
+        while frame is None and not stopEvent.is_set():
+            frame = cam.get_image()
+            if frame is None:
+                time.sleep(0.002)
+    except Exception as e:
+        infoQueue.put(('error', str(e)))
+        return
+    if frame is None:
+        infoQueue.put(('error', "No frames acquired."))
+        _close_camera(cam)
+        return
+    frame = np.asarray(frame)
+    infoQueue.put(('ready', frame.shape, frame.dtype.str))
+
+    spec = specQueue.get()
+    if spec is None:
+        _close_camera(cam)
+        return
+    slots = SharedFrameSlots.attach(spec)
+
+    # Descriptors not yet read when stopping are discarded
+    taskQueue.cancel_join_thread()
+    sequence = 0
+    frameNumber = 0
+    while not stopEvent.is_set():
+        if frame is None:
+            frame = cam.get_image()
+            if frame is None:
+                time.sleep(0.0005)
+                continue
+        timestamp = time.perf_counter()
+        frameNumber = frameNumber + 1
+        _increment(counters, NUM_ACQUIRED)
+        try:
+            slot = freeSlots.get_nowait()
+        except queue.Empty:
+            _increment(counters, NUM_DROPPED)
+        else:
+            np.copyto(slots.frames[slot], frame, casting = 'unsafe')
+            sequence = sequence + 1
+            taskQueue.put((sequence, slot, frameNumber, timestamp))
+        frame = None
+
+    for idx in range(numWorkers):
+        taskQueue.put(None)
+    _close_camera(cam)
+    slots.close()
+
+
+def _process(rawSpec, outSpec, processor, taskQueue, rawFree, outFree, resultQueue,
+             counters, stopEvent):
+    # Processing worker. An output slot is reserved before each raw frame is
+    # taken, so that frames which are ahead in the queue can always be
+    # completed and delivered in order.
+    rawSlots = SharedFrameSlots.attach(rawSpec)
+    outSlots = SharedFrameSlots.attach(outSpec)
+    for q in (rawFree, outFree, resultQueue):
+        q.cancel_join_thread()
+    outSlot = None
+    while not stopEvent.is_set():
+        if outSlot is None:
+            try:
+                outSlot = outFree.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+        try:
+            task = taskQueue.get(timeout = 0.1)
+        except queue.Empty:
+            continue
+        if task is None:
+            break
+        sequence, rawSlot, frameNumber, timestamp = task
+
+        t0 = time.perf_counter()
+        try:
+            processed = processor(rawSlots.frames[rawSlot])
+        except Exception as e:
+            print(f"Processing of frame {frameNumber} failed: {e}")
+            processed = None
+        rawFree.put(rawSlot)
+
+        if processed is None or np.shape(processed) != outSlots.shape:
+            _increment(counters, NUM_FAILED)
+            resultQueue.put((sequence, None, frameNumber, timestamp))
+            continue
+        np.copyto(outSlots.frames[outSlot], processed, casting = 'unsafe')
+        _increment(counters, PROCESS_TIME_US, int((time.perf_counter() - t0) * 1e6))
+        _increment(counters, NUM_PROCESSED)
+        resultQueue.put((sequence, outSlot, frameNumber, timestamp))
+        outSlot = None
+
+    rawSlots.close()
+    outSlots.close()
+
+
+class MultiProcessPipeline:
+    """ Acquires frames from camera class 'camName' in one process and
+    processes them with 'processor' in 'numWorkers' worker processes,
+    delivering processed frames in acquisition order, see module
+    docstring.
+
+    Arguments:
+        camName      : str
+                       camera class name (a CAS camera or a module of the
+                       same name on the path)
+        processor    : callable
+                       picklable function of a raw frame, returning the
+                       processed frame, or None if it cannot be processed
+
+    Keyword Arguments:
+        numWorkers   : int
+                       number of processing processes, default 2
+        numSlots     : int
+                       number of raw frame slots, default 16
+        numOutSlots  : int
+                       number of processed frame slots, default numWorkers
+                       + 4
+        outDtype     : str or numpy dtype
+                       processed frame type, default 'float32'
+        cameraID     : int
+                       camera ID, default 0
+        frameRate    : float
+                       if given, the camera frame rate is set to this
+        startTimeout : float
+                       maximum time (s) to wait for the camera, default 10
+
+    Other keyword arguments are passed to the camera.
+    """
+
+    def __init__(self, camName, processor, **kwargs):
+
+        self.camName = camName
+        self.processor = processor
+        self.numWorkers = max(int(kwargs.pop('numWorkers', 2)), 1)
+        self.numSlots = max(int(kwargs.pop('numSlots', 16)), 2)
+        self.numOutSlots = max(int(kwargs.pop('numOutSlots', self.numWorkers + 4)), self.numWorkers + 2)
+        self.outDtype = np.dtype(kwargs.pop('outDtype', 'float32'))
+        self.cameraID = kwargs.pop('cameraID', 0)
+        self.frameRate = kwargs.pop('frameRate', None)
+        self.startTimeout = kwargs.pop('startTimeout', 10)
+        self.camArgs = kwargs
+
+        self.rawSlots = None
+        self.outSlots = None
+        self.processes = []
+        self.counters = None
+        self.running = False
+        self.numDelivered = 0
+        self.numSkipped = 0
+        self.startTime = self.stopTime = time.perf_counter()
+
+
+    def start(self):
+        """ Starts the acquisition and worker processes. Returns once the
+        first frame has been acquired, raises RuntimeError if the camera
+        cannot be opened.
+        """
+        if self.running:
+            return
+
+        self.infoQueue = multiprocessing.Queue()
+        self.specQueue = multiprocessing.Queue()
+        self.rawFree = multiprocessing.Queue()
+        self.outFree = multiprocessing.Queue()
+        self.taskQueue = multiprocessing.Queue()
+        self.resultQueue = multiprocessing.Queue()
+        self.counters = multiprocessing.Array('q', NUM_COUNTERS)
+        self.stopEvent = multiprocessing.Event()
+
+        # All processes must share one resource tracker, otherwise the
+        # shared memory is freed when the first process to attach exits
+        if os.name == 'posix':
+            resource_tracker.ensure_running()
+
+        acquisition = multiprocessing.Process(target = _acquire, daemon = True,
+                                              args = (self.camName, self.cameraID, self.frameRate, self.camArgs,
+                                                      self.infoQueue, self.specQueue, self.rawFree,
+                                                      self.taskQueue, self.counters, self.stopEvent,
+                                                      self.numWorkers))
+        acquisition.start()
+        self.processes = [acquisition]
+
+        try:
+            info = self.infoQueue.get(timeout = self.startTimeout)
+        except queue.Empty:
+            info = ('error', "Timed out waiting for the camera.")
+        if info[0] != 'ready':
+            self.stop()
+            raise RuntimeError(f"Unable to start acquisition process: {info[1]}")
+        shape, dtype = info[1], info[2]
+
+        # The processed frame shape is found by processing a blank frame
+        with np.errstate(all = 'ignore'):
+            outShape = np.shape(self.processor(np.zeros(shape, dtype = dtype)))
+
+        self.rawSlots = SharedFrameSlots(self.numSlots, shape, dtype)
+        self.outSlots = SharedFrameSlots(self.numOutSlots, outShape, self.outDtype)
+        for slot in range(self.numSlots):
+            self.rawFree.put(slot)
+        for slot in range(self.numOutSlots):
+            self.outFree.put(slot)
+
+        for idx in range(self.numWorkers):
+            worker = multiprocessing.Process(target = _process, daemon = True,
+                                             args = (self.rawSlots.get_spec(), self.outSlots.get_spec(),
+                                                     self.processor, self.taskQueue, self.rawFree,
+                                                     self.outFree, self.resultQueue, self.counters,
+                                                     self.stopEvent))
+            worker.start()
+            self.processes.append(worker)
+
+        self.pending = {}
+        self.nextSequence = 1
+        self.borrowed = None
+        self.frameNumber = None
+        self.timestamp = None
+        self.numDelivered = 0
+        self.numSkipped = 0
+        self.startTime = time.perf_counter()
+        self.running = True
+        self.specQueue.put(self.rawSlots.get_spec())
+
+
+    def _collect(self, timeout = None):
+        # Moves results from the workers into 'pending', waiting up to
+        # 'timeout' for the first if there are none
+        try:
+            while True:
+                if timeout is not None and self.nextSequence not in self.pending:
+                    result = self.resultQueue.get(timeout = timeout)
+                    timeout = None
+                else:
+                    result = self.resultQueue.get_nowait()
+                self.pending[result[0]] = result
+        except queue.Empty:
+            pass
+
+
+    def _release(self):
+        if self.borrowed is not None:
+            self.outFree.put(self.borrowed)
+            self.borrowed = None
+
+
+    def _take_next(self):
+        # Returns the descriptor of the next frame in order, if it is ready,
+        # skipping frames which could not be processed
+        while self.nextSequence in self.pending:
+            sequence, slot, frameNumber, timestamp = self.pending.pop(self.nextSequence)
+            self.nextSequence = self.nextSequence + 1
+            if slot is not None:
+                return slot, frameNumber, timestamp
+            self.numSkipped = self.numSkipped + 1
+        return None
+
+
+    def get_next(self, timeout = None):
+        """ Returns a read-only view of the next processed frame in
+        acquisition order, or None if it is not ready, waiting up to
+        'timeout' (s) if given. The view is valid until the next call to
+        get_next, get_next_wait or get_latest. The camera frame number and
+        acquisition time (time.perf_counter in the acquisition process) are
+        stored in 'frameNumber' and 'timestamp'.
+        """
+        if not self.running:
+            return None
+        self._release()
+        self._collect(timeout)
+        taken = self._take_next()
+        if taken is None:
+            return None
+        self.borrowed, self.frameNumber, self.timestamp = taken
+        self.numDelivered = self.numDelivered + 1
+        return self.outSlots.view(self.borrowed)
+
+
+    def get_next_wait(self, timeout = 1):
+        """ As get_next, waiting up to 'timeout' (s) for the frame.
+        """
+        return self.get_next(timeout)
+
+
+    def get_latest(self):
+        """ Returns a read-only view of the most recent processed frame which
+        is ready, discarding any older ones, or None if there are none. Use
+        this for display rather than get_next if frames may be skipped.
+        """
+        if not self.running:
+            return None
+        self._release()
+        self._collect()
+        latest = None
+        taken = self._take_next()
+        while taken is not None:
+            if latest is not None:
+                self.outFree.put(latest[0])
+                self.numSkipped = self.numSkipped + 1
+            latest = taken
+            taken = self._take_next()
+        if latest is None:
+            return None
+        self.borrowed, self.frameNumber, self.timestamp = latest
+        self.numDelivered = self.numDelivered + 1
+        return self.outSlots.view(self.borrowed)
+
+
+    def get_stats(self):
+        """ Returns a dictionary of frame counts and rates.
+        """
+        counters = list(self.counters) if self.counters is not None else [0] * NUM_COUNTERS
+        elapsed = (time.perf_counter() if self.running else self.stopTime) - self.startTime
+        return {'numAcquired': counters[NUM_ACQUIRED],
+                'numDropped': counters[NUM_DROPPED],
+                'numProcessed': counters[NUM_PROCESSED],
+                'numFailed': counters[NUM_FAILED],
+                'numDelivered': self.numDelivered,
+                'numSkipped': self.numSkipped,
+                'numWorkers': self.numWorkers,
+                'meanProcessTime': counters[PROCESS_TIME_US] / 1e6 / max(counters[NUM_PROCESSED], 1),
+                'processedFps': counters[NUM_PROCESSED] / elapsed if elapsed > 0 else 0}
+
+
+    def stop(self):
+        """ Stops the processes and frees the shared memory. Frames returned
+        by get_next or get_latest must not be used after this.
+        """
+        if self.processes:
+            self.stopEvent.set()
+            if not self.running:
+                self.specQueue.put(None)
+            for process in self.processes:
+                process.join(timeout = 2)
+                if process.is_alive():
+                    process.terminate()
+            self.processes = []
+        for slots in (self.rawSlots, self.outSlots):
+            if slots is not None:
+                slots.unlink()
+        self.rawSlots = None
+        self.outSlots = None
+        if self.running:
+            self.stopTime = time.perf_counter()
+        self.running = False
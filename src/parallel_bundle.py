@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Tile-parallel fibre bundle processing.
+
+pybundle processes each frame on a single core, which for large sensors can
+take longer than the camera frame period. ParallelBundleProcessor gives the
+same result as PyBundle.process for triangular linear interpolation
+(TRILIN), but splits each frame across a thread pool:
+    - the raw image is split into horizontal bands, overlapping by the
+      Gaussian filter kernel, and each band is filtered (OpenCV) and the
+      intensity of the cores lying within it extracted
+    - after background subtraction and normalisation of the core values,
+      the reconstruction grid is split into blocks of pixels and each block
+      is interpolated from the core values (NumPy)
+OpenCV filtering and large NumPy operations release the GIL, so the pieces
+run in parallel on separate cores.
+
+The work split depends on the calibration, and is recalculated when the
+PyBundle calibration changes. Other core methods, colour images and
+super-resolution are passed to PyBundle.process unchanged.
+
+    parallel = ParallelBundleProcessor(pyb, numThreads = 8)
+    imgOut = parallel.process(img)
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2 as cv
+
+
+class ParallelBundleProcessor:
+    """ Processes frames using the settings and calibration of PyBundle
+    'pyb' on a pool of threads.
+
+    Arguments:
+        pyb         : PyBundle
+                      calibrated PyBundle, using the TRILIN core method
+
+    Keyword Arguments:
+        numThreads  : int
+                      number of threads, default is the number of CPUs
+        numBands    : int
+                      number of bands the image is split into for filtering
+                      and core extraction, default numThreads
+        numBlocks   : int
+                      number of blocks the reconstruction grid is split into
+                      for interpolation, default numThreads
+    """
+
+    def __init__(self, pyb, **kwargs):
+
+        self.pyb = pyb
+        self.numThreads = max(int(kwargs.get('numThreads', os.cpu_count() or 1)), 1)
+        self.numBands = max(int(kwargs.get('numBands', self.numThreads)), 1)
+        self.numBlocks = max(int(kwargs.get('numBlocks', self.numThreads)), 1)
+        self.pool = None
+        self.calibration = None
+        self.imageShape = None
+
+
+    def __getstate__(self):
+        # The thread pool cannot be pickled (e.g. for CAS multi-core
+        # processing), it is recreated when needed
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['calibration'] = None
+        return state
+
+
+    def _prepare(self, calib, shape):
+        # Splits the cores between bands of the image, and the reconstruction
+        # grid into blocks, for this calibration and image size
+        self.calibration = calib
+        self.imageShape = shape
+        height = shape[0]
+
+        if calib.filterSize is not None:
+            kernelSize = round(calib.filterSize * 4)
+            self.kernelSize = kernelSize + 1 - kernelSize % 2
+        else:
+            self.kernelSize = None
+        halo = self.kernelSize // 2 if self.kernelSize is not None else 0
+
+        # Each band needs 'halo' extra rows either side for the filter
+        edges = np.linspace(0, height, self.numBands + 1).astype(int)
+        coreY = np.asarray(calib.coreY)
+        self.bands = []
+        for start, end in zip(edges[:-1], edges[1:]):
+            cores = np.nonzero((coreY >= start) & (coreY < end))[0]
+            if len(cores) == 0:
+                continue
+            top = max(start - halo, 0)
+            bottom = min(end + halo, height)
+            self.bands.append((top, bottom, cores,
+                               np.asarray(calib.coreY[cores], dtype = 'intp') - top,
+                               np.asarray(calib.coreX[cores], dtype = 'intp')))
+
+        # Pixels outside the triangulation, or the mask, are set to 0
+        numPixels = np.shape(calib.baryCoords)[0]
+        self.weight = (np.asarray(calib.mapping) >= 0).astype('float64')
+        if calib.mask is not None:
+            self.weight = self.weight * np.ravel(calib.mask)
+        edges = np.linspace(0, numPixels, self.numBlocks + 1).astype(int)
+        self.blocks = [(start, end) for start, end in zip(edges[:-1], edges[1:]) if end > start]
+
+        self.coreVals = np.zeros(len(calib.coreX), dtype = 'float64')
+        self.pixelVals = np.zeros(numPixels, dtype = 'float64')
+
+
+    def _extract_band(self, img, band):
+        top, bottom, cores, bandY, bandX = band
+        region = img[top:bottom]
+        if self.kernelSize is not None:
+            region = cv.GaussianBlur(region, (self.kernelSize, self.kernelSize), self.calibration.filterSize)
+        self.coreVals[cores] = region[bandY, bandX]
+
+
+    def _interpolate_block(self, coreVals, block):
+        start, end = block
+        calib = self.calibration
+        vals = coreVals[calib.coreIdx[start:end]]
+        np.multiply(calib.baryCoords[start:end], vals, out = vals)
+        np.sum(vals, 1, out = self.pixelVals[start:end])
+        np.multiply(self.pixelVals[start:end], self.weight[start:end], out = self.pixelVals[start:end])
+
+
+    def reconstruct(self, img):
+        """ Returns the triangular linear interpolation reconstruction of 2D
+        image 'img' using the current calibration, as recon_tri_interp.
+        """
+        calib = self.pyb.calibration
+        if calib is not self.calibration or np.shape(img) != self.imageShape:
+            self._prepare(calib, np.shape(img))
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers = self.numThreads)
+
+        for future in [self.pool.submit(self._extract_band, img, band) for band in self.bands]:
+            future.result()
+
+        coreVals = self.coreVals
+        if calib.background is not None:
+            coreVals = coreVals - calib.backgroundVals
+        if calib.normalise is not None:
+            coreVals = coreVals / calib.normaliseVals * 255
+
+        for future in [self.pool.submit(self._interpolate_block, coreVals, block) for block in self.blocks]:
+            future.result()
+
+        return np.reshape(self.pixelVals, (calib.gridSize, calib.gridSize)).copy()
+
+
+    def process(self, img):
+        """ Processes a fibre bundle image, as PyBundle.process. Returns the
+        processed image.
+        """
+        pyb = self.pyb
+        if pyb.coreMethod != pyb.TRILIN or pyb.superRes or pyb.calibration is None \
+                or np.ndim(img) != 2 or getattr(pyb.calibration, 'col', False):
+            return pyb.process(img)
+
+        imgOut = self.reconstruct(img)
+
+        # As PyBundle.process
+        if pyb.autoContrast:
+            imgOut = imgOut - np.min(imgOut)
+            imgOut = imgOut / np.max(imgOut)
+            if pyb.outputType == 'uint8':
+                imgOut = imgOut * 255
+            elif pyb.outputType == 'uint16':
+                imgOut = imgOut * (2**16 - 1)
+        if imgOut.dtype != pyb.outputType:
+            imgOut = imgOut.astype(pyb.outputType)
+
+        return imgOut
+
+
+    def close(self):
+        """ Shuts down the thread pool.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait = True)
+            self.pool = None
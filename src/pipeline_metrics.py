@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the acquisition and processing pipeline.
+
+PipelineMetrics records a monotonic timestamp (time.perf_counter) each time
+a frame reaches a stage of the pipeline, e.g. 'acquired', 'processed',
+'displayed'. From these it gives the rate at which frames pass each stage,
+and, for frames which are identified by a frame ID, the latency from the
+previous stage and from the first stage. Only the most recent frames are
+kept, so the statistics and histograms are rolling. Named counters hold
+totals such as dropped frames and DAQ reconfigurations.
+
+Metrics can be exported to JSON (summary, counters, histograms and per-frame
+timestamps) or CSV (per-frame timestamps).
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import csv
+import json
+import time
+import threading
+import collections
+
+import numpy as np
+
+# Latency histogram bin edges (s), logarithmic from 10 us to 10 s
+HISTOGRAM_BINS = np.logspace(-5, 1, 61)
+
+
+def _to_json(value):
+    # Converts NumPy values, which json cannot serialise, to Python types
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class PipelineMetrics:
+    """ Rolling per-stage timing and counters.
+
+    Keyword Arguments:
+        maxFrames : int
+                    number of recent frames and events kept, default 1000
+    """
+
+    def __init__(self, maxFrames = 1000):
+
+        self.maxFrames = maxFrames
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        """ Clears all timings and counters.
+        """
+        with self.lock:
+            self.stages = []
+            self.frames = collections.OrderedDict()
+            self.eventTimes = {}
+            self.stageLatencies = {}
+            self.totalLatencies = {}
+            self.counters = {}
+            self.startTime = time.perf_counter()
+
+
+    def mark(self, stage, frameId = None, t = None):
+        """ Records that a frame reached 'stage' at time t (default now). If
+        'frameId' is given, latencies are calculated from the earlier stages
+        reached by the same frame.
+        """
+        if t is None:
+            t = time.perf_counter()
+
+        with self.lock:
+            if stage not in self.eventTimes:
+                self.stages.append(stage)
+                self.eventTimes[stage] = collections.deque(maxlen = self.maxFrames)
+                self.stageLatencies[stage] = collections.deque(maxlen = self.maxFrames)
+                self.totalLatencies[stage] = collections.deque(maxlen = self.maxFrames)
+            self.eventTimes[stage].append(t)
+
+            if frameId is None:
+                return
+
+            frame = self.frames.get(frameId)
+            if frame is None:
+                frame = {}
+                self.frames[frameId] = frame
+                if len(self.frames) > self.maxFrames:
+                    self.frames.popitem(last = False)
+            elif stage not in frame:
+                self.stageLatencies[stage].append(t - max(frame.values()))
+                self.totalLatencies[stage].append(t - min(frame.values()))
+            frame[stage] = t
+
+
+    def count(self, name, n = 1):
+        """ Adds 'n' to counter 'name'.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+
+    def set_count(self, name, value):
+        """ Sets counter 'name', for totals which are kept elsewhere. NumPy
+        values are stored as Python numbers, so they can be exported.
+        """
+        if isinstance(value, np.generic):
+            value = value.item()
+        with self.lock:
+            self.counters[name] = value
+
+
+    def get_count(self, name):
+        """ Returns the value of counter 'name', 0 if it has not been set.
+        """
+        return self.counters.get(name, 0)
+
+
+    def get_fps(self, stage):
+        """ Returns the recent rate (Hz) at which frames reached 'stage'.
+        """
+        times = self.eventTimes.get(stage)
+        if times is None or len(times) < 2:
+            return 0
+        times = list(times)
+        return (len(times) - 1) / max(times[-1] - times[0], 1e-9)
+
+
+    def get_latencies(self, stage, total = False):
+        """ Returns the recent latencies (s) of 'stage' from the previous
+        stage, or from the first stage if 'total' is True, as a numpy array.
+        """
+        latencies = self.totalLatencies if total else self.stageLatencies
+        return np.array(latencies.get(stage, []))
+
+
+    def get_histogram(self, stage, total = False):
+        """ Returns (counts, bin edges) of recent latencies of 'stage', see
+        get_latencies.
+        """
+        return np.histogram(self.get_latencies(stage, total), bins = HISTOGRAM_BINS)
+
+
+    def _latency_stats(self, latencies):
+
+        if len(latencies) == 0:
+            return None
+        return {'mean': float(np.mean(latencies)),
+                'median': float(np.median(latencies)),
+                'p95': float(np.percentile(latencies, 95)),
+                'max': float(np.max(latencies)),
+                'n': len(latencies)}
+
+
+    def get_summary(self):
+        """ Returns a dictionary of rates, latency statistics and counters.
+        """
+        with self.lock:
+            stages = list(self.stages)
+            counters = dict(self.counters)
+
+        summary = {'elapsed': time.perf_counter() - self.startTime,
+                   'stages': {},
+                   'counters': counters}
+        for stage in stages:
+            summary['stages'][stage] = {'fps': self.get_fps(stage),
+                                        'latency': self._latency_stats(self.get_latencies(stage)),
+                                        'totalLatency': self._latency_stats(self.get_latencies(stage, True))}
+        return summary
+
+
+    def summary_text(self):
+        """ Returns a short multi-line description of the summary, for display.
+        """
+        summary = self.get_summary()
+        lines = []
+        for stage, stats in summary['stages'].items():
+            line = f"{stage}: {stats['fps']:.1f} fps"
+            if stats['latency'] is not None:
+                line = line + f", {stats['latency']['median'] * 1000:.1f} ms (p95 {stats['latency']['p95'] * 1000:.1f} ms)"
+            lines.append(line)
+        for name, value in summary['counters'].items():
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines)
+
+
+    def get_frame_table(self):
+        """ Returns (stages, rows) of recent per-frame timestamps, where each
+        row is [frameId, timestamp of each stage or None].
+        """
+        with self.lock:
+            stages = list(self.stages)
+            rows = [[frameId] + [frame.get(stage) for stage in stages] for frameId, frame in self.frames.items()]
+        return stages, rows
+
+
+    def export_json(self, filename):
+        """ Saves summary, histograms and per-frame timestamps as JSON.
+        """
+        stages, rows = self.get_frame_table()
+        histograms = {}
+        for stage in stages:
+            counts, edges = self.get_histogram(stage)
+            histograms[stage] = {'counts': counts.tolist(), 'edges': edges.tolist()}
+
+        with open(filename, 'w') as f:
+            json.dump({'summary': self.get_summary(),
+                       'histograms': histograms,
+                       'frameStages': stages,
+                       'frames': rows}, f, indent = 2, default = _to_json)
+
+
+    def export_csv(self, filename):
+        """ Saves per-frame timestamps as CSV, one row per frame.
+        """
+        stages, rows = self.get_frame_table()
+        with open(filename, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frameId'] + stages)
+            writer.writerows(rows)
+
+
+    def export(self, filename):
+        """ Saves as CSV if filename ends in .csv, otherwise JSON.
+        """
+        if filename.lower().endswith('.csv'):
+            self.export_csv(filename)
+        else:
+            self.export_json(filename)
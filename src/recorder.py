@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+"""
+Recording of raw or processed frames in a background writer thread.
+
+FrameRecorder takes frames from the acquisition or processing side through
+a bounded queue, so that writing to disk never holds up acquisition. If
+the queue is full the frame is either dropped (the default) or put() waits
+for space (backpressure), and the number of dropped frames, the time spent
+waiting and the maximum queue fill are reported by get_stats().
+
+Two formats can be written:
+    'tif'     : a TIFF stack, as recorded by CAS, written by the writer
+                thread rather than on the acquisition side
+    'chunked' : a folder containing blocks of frames ('chunks'), each
+                compressed after shuffling the bytes of each pixel so that
+                the high bytes of 16 bit images compress well. Chunks are
+                compressed by a small pool of threads. Compression is
+                lossless, using lz4 if the lz4 package is installed
+                (fast enough for full camera rates), otherwise chunks are
+                not compressed unless zlib is chosen (better compression,
+                but much slower). Read it back using ChunkedFrameReader.
+
+For both formats the timestamp of each frame and any per-frame metadata
+passed to put() (e.g. camera frame number, scan voltage, dual mode phase)
+are written to a CSV file alongside the frames (for 'tif', the same name
+with .csv as the extension). Metadata for the whole recording, e.g. scan
+parameters, can be passed as 'metadata' when the recorder is created and is
+saved in the CSV header ('tif') or recording.json ('chunked').
+
+Example:
+
+    recorder = FrameRecorder('record', format = 'chunked')
+    recorder.start()
+    recorder.put(frame, timestamp, frameNumber = 1, dualPhase = 0)
+    stats = recorder.stop()
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import os
+import csv
+import json
+import time
+import zlib
+import queue
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+CHUNKED_FORMAT_VERSION = 1
+
+
+def default_compression():
+    """ Returns 'lz4' if the lz4 package is installed, otherwise None.
+    """
+    try:
+        import lz4.frame
+        return 'lz4'
+    except ImportError:
+        return None
+
+
+def compress(data, compression, level = 1):
+    """ Compresses bytes using 'lz4', 'zlib' (at 'level') or None.
+    """
+    if compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(data)
+    elif compression == 'zlib':
+        return zlib.compress(data, level)
+    elif compression is None:
+        return data
+    raise ValueError(f"Unknown compression '{compression}'.")
+
+
+def decompress(data, compression):
+    """ Reverses compress.
+    """
+    if compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(data)
+    elif compression == 'zlib':
+        return zlib.decompress(data)
+    elif compression is None:
+        return data
+    raise ValueError(f"Unknown compression '{compression}'.")
+
+
+def shuffle_bytes(arr):
+    """ Returns the bytes of 'arr' with the first byte of every element,
+    then the second byte of every element, etc.
+    """
+    arr = np.ascontiguousarray(arr)
+    if arr.itemsize == 1:
+        return arr.tobytes()
+    return arr.view('uint8').reshape(-1, arr.itemsize).T.tobytes()
+
+
+def unshuffle_bytes(data, dtype, shape):
+    """ Reverses shuffle_bytes, returns an array of 'dtype' and 'shape'.
+    """
+    dtype = np.dtype(dtype)
+    raw = np.frombuffer(data, dtype = 'uint8')
+    if dtype.itemsize > 1:
+        raw = np.ascontiguousarray(raw.reshape(dtype.itemsize, -1).T)
+    return raw.view(dtype).reshape(shape)
+
+
+class FrameMetadataLog:
+    """ CSV file with one row of timestamp and metadata per frame. The
+    columns are set by the first frame. Metadata for the whole recording
+    is written as comment lines (starting #) at the top of the file.
+    """
+
+    def __init__(self, filename, metadata = None):
+
+        self.file = open(filename, 'w', newline = '')
+        for key, value in (metadata or {}).items():
+            self.file.write(f"# {key}: {value}\n")
+        self.writer = csv.writer(self.file)
+        self.columns = None
+
+
+    def write(self, index, timestamp, metadata):
+
+        if self.columns is None:
+            self.columns = list(metadata.keys())
+            self.writer.writerow(['index', 'timestamp'] + self.columns)
+        self.writer.writerow([index, timestamp] + [metadata.get(column) for column in self.columns])
+
+
+    def close(self):
+
+        self.file.close()
+
+
+def read_metadata_log(filename):
+    """ Reads a FrameMetadataLog CSV file, returns a list of dictionaries, one
+    per frame. Values are converted to numbers where possible.
+    """
+    def convert(value):
+        for t in (int, float):
+            try:
+                return t(value)
+            except ValueError:
+                pass
+        return value
+
+    with open(filename, newline = '') as f:
+        rows = csv.DictReader(line for line in f if not line.startswith('#'))
+        return [{key: convert(value) for key, value in row.items()} for row in rows]
+
+
+class TiffFrameWriter:
+    """ Writes frames to a TIFF stack, with a CSV file of per-frame metadata.
+    """
+
+    def __init__(self, filename, metadata = None):
+
+        from PIL import TiffImagePlugin
+        self.filename = filename
+        self.tif = TiffImagePlugin.AppendingTiffWriter(filename, True)
+        self.log = FrameMetadataLog(os.path.splitext(filename)[0] + '.csv', metadata)
+        self.numFrames = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+
+    def write(self, frame, timestamp, metadata):
+
+        from PIL import Image
+        Image.fromarray(frame).save(self.tif)
+        self.tif.newFrame()
+        self.log.write(self.numFrames, timestamp, metadata)
+        self.numFrames = self.numFrames + 1
+        self.bytesIn = self.bytesIn + frame.nbytes
+        self.bytesOut = self.bytesOut + frame.nbytes
+
+
+    def close(self):
+
+        self.tif.close()
+        self.log.close()
+
+
+class ChunkedFrameWriter:
+    """ Writes frames to a chunked recording folder.
+
+    Keyword Arguments:
+        metadata    : dict
+                      metadata for the whole recording, saved in
+                      recording.json
+        chunkFrames : int
+                      number of frames in each chunk, default 32
+        compression : str or None
+                      'lz4', 'zlib' or None, default is 'lz4' if installed,
+                      otherwise None
+        level       : int
+                      zlib compression level, default 1
+        shuffle     : boolean
+                      shuffle bytes before compression, default True
+        numThreads  : int
+                      number of threads compressing chunks, default 2
+    """
+
+    def __init__(self, folder, **kwargs):
+
+        self.folder = folder
+        self.metadata = kwargs.get('metadata', None) or {}
+        self.chunkFrames = kwargs.get('chunkFrames', 32)
+        self.compression = kwargs.get('compression', default_compression())
+        self.level = kwargs.get('level', 1)
+        self.shuffle = kwargs.get('shuffle', True)
+        self.numThreads = kwargs.get('numThreads', 2)
+
+        os.makedirs(folder, exist_ok = True)
+        self.log = FrameMetadataLog(os.path.join(folder, 'frames.csv'))
+        self.pool = ThreadPoolExecutor(max_workers = self.numThreads)
+        self.pending = collections.deque()
+
+        self.shape = None
+        self.dtype = None
+        self.chunk = None
+        self.chunkFill = 0
+        self.numChunks = 0
+        self.numFrames = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+
+    def _write_header(self, complete = False):
+
+        header = {'version': CHUNKED_FORMAT_VERSION,
+                  'shape': list(self.shape) if self.shape is not None else None,
+                  'dtype': str(self.dtype) if self.dtype is not None else None,
+                  'chunkFrames': self.chunkFrames,
+                  'compression': self.compression,
+                  'shuffle': self.shuffle,
+                  'numFrames': self.numFrames,
+                  'complete': complete,
+                  'metadata': self.metadata}
+        with open(os.path.join(self.folder, 'recording.json'), 'w') as f:
+            json.dump(header, f, indent = 2, default = str)
+
+
+    def _encode(self, chunk):
+        # Called in the compression threads
+        data = shuffle_bytes(chunk) if self.shuffle else chunk.tobytes()
+        return compress(data, self.compression, self.level)
+
+
+    def _flush_pending(self, wait = False):
+        # Writes compressed chunks to disk, in order. If 'wait' is True,
+        # waits for all of them, otherwise only writes those completed and
+        # waits only if too many are outstanding
+        while self.pending and (wait or self.pending[0][1].done() or len(self.pending) > 2 * self.numThreads):
+            idx, future, nbytes = self.pending.popleft()
+            data = future.result()
+            with open(os.path.join(self.folder, f"chunk_{idx:06d}.bin"), 'wb') as f:
+                f.write(data)
+            self.bytesIn = self.bytesIn + nbytes
+            self.bytesOut = self.bytesOut + len(data)
+
+
+    def _submit_chunk(self):
+
+        if self.chunkFill > 0:
+            chunk = self.chunk[:self.chunkFill]
+            self.pending.append((self.numChunks, self.pool.submit(self._encode, chunk), chunk.nbytes))
+            self.numChunks = self.numChunks + 1
+            self.chunk = None
+            self.chunkFill = 0
+        self._flush_pending()
+
+
+    def write(self, frame, timestamp, metadata):
+        """ Adds a frame. All frames must have the same shape and type as
+        the first, otherwise ValueError is raised.
+        """
+        frame = np.asarray(frame)
+        if self.shape is None:
+            self.shape = frame.shape
+            self.dtype = frame.dtype
+            self._write_header()
+        elif frame.shape != self.shape or frame.dtype != self.dtype:
+            raise ValueError(f"Frame {frame.shape} {frame.dtype} does not match recording {self.shape} {self.dtype}.")
+
+        if self.chunk is None:
+            self.chunk = np.empty((self.chunkFrames,) + self.shape, dtype = self.dtype)
+        self.chunk[self.chunkFill] = frame
+        self.chunkFill = self.chunkFill + 1
+
+        self.log.write(self.numFrames, timestamp, metadata)
+        self.numFrames = self.numFrames + 1
+
+        if self.chunkFill == self.chunkFrames:
+            self._submit_chunk()
+
+
+    def close(self):
+
+        self._submit_chunk()
+        self._flush_pending(wait = True)
+        self.pool.shutdown()
+        self.log.close()
+        self._write_header(complete = True)
+
+
+class ChunkedFrameReader:
+    """ Reads a recording written by ChunkedFrameWriter. Frames are returned
+    as 2D numpy arrays by get_frame(idx), the per-frame timestamps and
+    metadata as a dictionary by get_metadata(idx). If the recording was not
+    completed (e.g. the program crashed), frames which were written are
+    still available.
+    """
+
+    def __init__(self, folder):
+
+        self.folder = folder
+        with open(os.path.join(folder, 'recording.json')) as f:
+            self.header = json.load(f)
+        if self.header.get('version', 0) > CHUNKED_FORMAT_VERSION:
+            raise ValueError(f"Recording {folder} is from a newer version (format {self.header['version']}).")
+
+        self.shape = tuple(self.header['shape'] or ())
+        self.dtype = np.dtype(self.header['dtype'] or 'uint8')
+        self.chunkFrames = self.header['chunkFrames']
+        self.metadata = self.header.get('metadata', {})
+
+        self.frameMetadata = read_metadata_log(os.path.join(folder, 'frames.csv'))
+        numChunks = 0
+        while os.path.exists(self._chunk_filename(numChunks)):
+            numChunks = numChunks + 1
+        self.n_frames = min(len(self.frameMetadata), numChunks * self.chunkFrames)
+        if self.header['shape'] is None:
+            self.n_frames = 0
+
+        self.cachedChunkIdx = None
+        self.cachedChunk = None
+
+
+    def _chunk_filename(self, chunkIdx):
+
+        return os.path.join(self.folder, f"chunk_{chunkIdx:06d}.bin")
+
+
+    def get_chunk(self, chunkIdx):
+        """ Returns chunk 'chunkIdx' as a 3D array (frame, height, width).
+        """
+        if chunkIdx != self.cachedChunkIdx:
+            with open(self._chunk_filename(chunkIdx), 'rb') as f:
+                data = f.read()
+            data = decompress(data, self.header.get('compression'))
+            numFrames = len(data) // (self.dtype.itemsize * int(np.prod(self.shape)))
+            if self.header.get('shuffle', True):
+                self.cachedChunk = unshuffle_bytes(data, self.dtype, (numFrames,) + self.shape)
+            else:
+                self.cachedChunk = np.frombuffer(data, dtype = self.dtype).reshape((numFrames,) + self.shape)
+            self.cachedChunkIdx = chunkIdx
+        return self.cachedChunk
+
+
+    def get_frame(self, idx):
+        """ Returns frame 'idx'.
+        """
+        if idx < 0 or idx >= self.n_frames:
+            raise IndexError(f"Frame {idx} is not in recording of {self.n_frames} frames.")
+        return self.get_chunk(idx // self.chunkFrames)[idx % self.chunkFrames]
+
+
+    def get_metadata(self, idx):
+        """ Returns the timestamp and metadata of frame 'idx' as a dictionary.
+        """
+        return self.frameMetadata[idx]
+
+
+    def close(self):
+
+        self.cachedChunk = None
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+class FrameRecorder:
+    """ Records frames in a background thread, see module description.
+
+    Arguments:
+        filename    : str
+                      TIFF file or, for chunked, folder to write to
+
+    Keyword Arguments:
+        format      : str
+                      'chunked' (default) or 'tif'
+        queueSize   : int
+                      maximum number of frames waiting to be written,
+                      default 256
+        block       : boolean
+                      if True, put() waits for space in the queue rather than
+                      dropping the frame, default False
+        blockTimeout: float
+                      maximum time (s) put() waits if 'block' is True,
+                      default 1
+        metadata    : dict
+                      metadata for the whole recording
+
+    Other keyword arguments are passed to ChunkedFrameWriter.
+    """
+
+    def __init__(self, filename, **kwargs):
+
+        self.filename = filename
+        self.format = kwargs.pop('format', 'chunked')
+        self.queueSize = kwargs.pop('queueSize', 256)
+        self.block = kwargs.pop('block', False)
+        self.blockTimeout = kwargs.pop('blockTimeout', 1)
+        self.writerArgs = kwargs
+
+        if self.format not in ('chunked', 'tif'):
+            raise ValueError(f"Unknown recording format '{self.format}'.")
+
+        self.queue = queue.Queue(maxsize = self.queueSize)
+        self.writer = None
+        self.thread = None
+        self.running = False
+        self.error = None
+
+        self.numQueued = 0
+        self.numDropped = 0
+        self.numBlocked = 0
+        self.blockedTime = 0
+        self.maxQueueFill = 0
+        self.numWritten = 0
+        self.numRejected = 0
+        self.startTime = None
+        self.stopTime = None
+
+
+    def start(self):
+        """ Creates the file and starts the writer thread.
+        """
+        if self.format == 'tif':
+            self.writer = TiffFrameWriter(self.filename, self.writerArgs.get('metadata', None))
+        else:
+            self.writer = ChunkedFrameWriter(self.filename, **self.writerArgs)
+
+        self.running = True
+        self.startTime = time.perf_counter()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+
+    def put(self, frame, timestamp = None, copy = True, **metadata):
+        """ Queues a frame for writing, with a timestamp (default now) and
+        any per-frame metadata as keyword arguments. Unless 'copy' is False
+        the frame is copied, so it can be reused by the caller. Returns False
+        if the frame was dropped.
+        """
+        if not self.running or frame is None:
+            return False
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        item = (np.array(frame) if copy else frame, timestamp, metadata)
+
+        try:
+            if self.block:
+                if self.queue.full():
+                    self.numBlocked = self.numBlocked + 1
+                    t0 = time.perf_counter()
+                    try:
+                        self.queue.put(item, timeout = self.blockTimeout)
+                    finally:
+                        self.blockedTime = self.blockedTime + time.perf_counter() - t0
+                else:
+                    self.queue.put_nowait(item)
+            else:
+                self.queue.put_nowait(item)
+        except queue.Full:
+            self.numDropped = self.numDropped + 1
+            return False
+
+        self.numQueued = self.numQueued + 1
+        self.maxQueueFill = max(self.maxQueueFill, self.queue.qsize())
+        return True
+
+
+    def _run(self):
+
+        while self.running or not self.queue.empty():
+            try:
+                frame, timestamp, metadata = self.queue.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+            try:
+                self.writer.write(frame, timestamp, metadata)
+                self.numWritten = self.numWritten + 1
+            except ValueError as e:
+                self.numRejected = self.numRejected + 1
+                if self.numRejected == 1:
+                    print(f"Recording: {e}")
+            except Exception as e:
+                # e.g. disk full, stop recording
+                self.error = e
+                self.running = False
+                print(f"Recording stopped: {e}")
+                break
+
+        try:
+            self.writer.close()
+        except Exception as e:
+            self.error = self.error or e
+            print(f"Error closing recording: {e}")
+
+
+    def stop(self):
+        """ Stops accepting frames, waits for those queued to be written,
+        closes the file and returns the statistics (see get_stats).
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.stopTime = time.perf_counter()
+        return self.get_stats()
+
+
+    def is_recording(self):
+        """ Returns True if frames are being accepted.
+        """
+        return self.running
+
+
+    def get_stats(self):
+        """ Returns a dictionary of the number of frames queued, dropped and
+        written, the current and maximum queue fill, the number of times and
+        total time put() waited for space, the write rate, and the ratio of
+        raw to stored size.
+        """
+        endTime = self.stopTime if self.stopTime is not None else time.perf_counter()
+        elapsed = endTime - self.startTime if self.startTime is not None else 0
+        bytesIn = getattr(self.writer, 'bytesIn', 0)
+        bytesOut = getattr(self.writer, 'bytesOut', 0)
+        return {'numQueued': self.numQueued,
+                'numDropped': self.numDropped,
+                'numWritten': self.numWritten,
+                'numRejected': self.numRejected,
+                'queueFill': self.queue.qsize(),
+                'maxQueueFill': self.maxQueueFill,
+                'queueSize': self.queueSize,
+                'numBlocked': self.numBlocked,
+                'blockedTime': self.blockedTime,
+                'elapsed': elapsed,
+                'writeFps': self.numWritten / elapsed if elapsed > 0 else 0,
+                'compressionRatio': bytesIn / bytesOut if bytesOut > 0 else None,
+                'error': str(self.error) if self.error is not None else None}
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Timing checks for camera-triggered virtual slit linescan.
+
+Each camera strobe retriggers the counter which clocks the galvo ramp out of
+the DAQ, nPoints samples at sampleRate. A strobe which arrives while the
+ramp from the previous one is still being output is ignored, so if the ramp
+is longer than the frame period, scans are silently skipped and the line is
+no longer aligned with the rolling shutter.
+
+scan_timing() checks a ramp against the camera frame period, exposure and
+line rate before the DAQ is set up, and returns a report with the maximum
+frame rate the ramp allows, and lists of errors (scans will be missed) and
+warnings (e.g. the ramp does not cover all of the rows read out).
+
+analyse_trigger_times() measures the period and jitter of a series of
+trigger times, such as SimulatedScanner.triggerTimes or the timestamps
+saved with a recording (load_trigger_times), finds gaps where triggers
+were missed and, given the ramp duration, how close the triggers came to
+being missed and the highest frame rate which is safe with the measured
+jitter. simulate_triggers() drives a SimulatedScanner with jittered strobes
+to test a scan before using hardware.
+
+Run this file directly to check scan parameters, e.g.
+
+    python scan_timing.py --speed 272 --range 2 --fps 120 --exposure 0.002 --rows 960
+    python scan_timing.py --speed 272 --range 2 --fps 130 --simulate 2000 --jitter 0.00005
+    python scan_timing.py --recording record_2024_06_07_15_04_29
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import os
+
+import numpy as np
+
+
+def scan_timing(nPoints, sampleRate, framePeriod = None, **kwargs):
+    """ Checks the timing of a camera-triggered ramp of 'nPoints' samples at
+    'sampleRate' (Hz) against the camera 'framePeriod' (s). Returns a
+    dictionary with the ramp duration, the minimum frame period and maximum
+    frame rate the ramp allows, the spare time in each frame ('slack'), and
+    lists of 'errors' and 'warnings'. 'ok' is False if there are errors.
+
+    Keyword Arguments:
+        exposure     : float
+                       camera exposure (s), default None (not checked)
+        lineRate     : float
+                       rolling shutter line rate (Hz), default None
+        numRows      : int
+                       number of camera rows read out, default None
+        scanRange    : float
+                       requested scan range (V), with scanSpeed used to find
+                       the error from rounding the ramp to whole samples
+        scanSpeed    : float
+                       requested scan speed (V/s)
+        rearmSamples : int
+                       sample periods after the ramp before the counter can be
+                       retriggered, default 2
+        jitter       : float
+                       standard deviation of trigger period (s), default 0
+        numSigma     : float
+                       number of standard deviations of jitter allowed for,
+                       default 6
+        margin       : float
+                       warn if the ramp uses more than (1 - margin) of the
+                       frame period, default 0.05
+        minPoints    : int
+                       warn if the ramp has fewer samples than this, default
+                       100
+    """
+    exposure = kwargs.get('exposure', None)
+    lineRate = kwargs.get('lineRate', None)
+    numRows = kwargs.get('numRows', None)
+    scanRange = kwargs.get('scanRange', None)
+    scanSpeed = kwargs.get('scanSpeed', None)
+    rearmSamples = kwargs.get('rearmSamples', 2)
+    jitter = kwargs.get('jitter', 0)
+    numSigma = kwargs.get('numSigma', 6)
+    margin = kwargs.get('margin', 0.05)
+    minPoints = kwargs.get('minPoints', 100)
+
+    errors = []
+    warnings = []
+
+    rampDuration = nPoints / sampleRate
+    rearmTime = rearmSamples / sampleRate
+    minFramePeriod = rampDuration + rearmTime + numSigma * jitter
+
+    report = {'nPoints': int(nPoints),
+              'sampleRate': sampleRate,
+              'rampDuration': rampDuration,
+              'rearmTime': rearmTime,
+              'minFramePeriod': minFramePeriod,
+              'maxFrameRate': 1 / minFramePeriod,
+              'framePeriod': framePeriod,
+              'slack': None,
+              'sweepTime': None,
+              'slitWidthRows': None,
+              'speedError': None}
+
+    if nPoints < 2:
+        errors.append("Ramp has fewer than 2 samples, check the scan speed is positive.")
+    elif nPoints < minPoints:
+        warnings.append(f"Ramp has only {nPoints} samples, so scan speed is rounded by up to {100 / nPoints:.1f}%.")
+
+    if scanRange is not None and scanSpeed:
+        requested = abs(scanRange / scanSpeed) * sampleRate
+        report['speedError'] = (requested - nPoints) / requested if requested > 0 else None
+
+    if framePeriod is not None and framePeriod > 0:
+        slack = framePeriod - minFramePeriod
+        report['slack'] = slack
+        if rampDuration + rearmTime > framePeriod:
+            errors.append(f"Ramp ({rampDuration * 1000:.3f} ms) is longer than the frame period "
+                          f"({framePeriod * 1000:.3f} ms), every other trigger will be missed. "
+                          f"Maximum frame rate is {1 / (rampDuration + rearmTime):.1f} Hz.")
+        elif slack < 0:
+            errors.append(f"Trigger jitter ({jitter * 1e6:.1f} us) may cause triggers to be missed, "
+                          f"maximum safe frame rate is {1 / minFramePeriod:.1f} Hz.")
+        elif minFramePeriod > framePeriod * (1 - margin):
+            warnings.append(f"Ramp uses {minFramePeriod / framePeriod * 100:.0f}% of the frame period.")
+
+        if exposure is not None and exposure > framePeriod:
+            warnings.append(f"Exposure ({exposure * 1000:.3f} ms) is longer than the frame period "
+                            f"({framePeriod * 1000:.3f} ms), the camera frame rate will be lower than set.")
+
+    if lineRate is not None and numRows is not None:
+        sweepTime = numRows / lineRate
+        report['sweepTime'] = sweepTime
+        if rampDuration < sweepTime * (1 - margin):
+            warnings.append(f"Ramp ({rampDuration * 1000:.3f} ms) ends before the last rows are read out "
+                            f"({sweepTime * 1000:.3f} ms), about {int(numRows - rampDuration * lineRate)} rows will not be scanned.")
+        if exposure is not None:
+            report['slitWidthRows'] = exposure * lineRate
+            if rampDuration > sweepTime + exposure:
+                warnings.append(f"Ramp continues for {(rampDuration - sweepTime - exposure) * 1000:.3f} ms "
+                                f"after the last row has been exposed.")
+
+    report['errors'] = errors
+    report['warnings'] = warnings
+    report['ok'] = len(errors) == 0
+    return report
+
+
+def analyse_trigger_times(times, rampDuration = None, **kwargs):
+    """ Analyses a series of trigger (or frame) times (s). Returns a
+    dictionary with the nominal period and frame rate, the jitter (standard
+    deviation, peak-to-peak and 99.9th percentile of the deviation of each
+    period from a whole number of nominal periods), the phase jitter
+    (deviation of each trigger from a regular clock), the number of
+    triggers missing from gaps of two or more periods, and a histogram of
+    period deviations. Returns
+    None if there are fewer than 3 times.
+
+    If 'rampDuration' (s) is given, also returns the number of periods too
+    short for the ramp (triggers which would be missed), the smallest
+    spare time and the maximum frame rate which is safe for the measured
+    jitter.
+
+    Keyword Arguments:
+        expectedPeriod : float
+                         nominal period (s), default is the median period
+        rearmTime      : float
+                         time after the ramp before the counter can be
+                         retriggered (s), default 0
+        numSigma       : float
+                         standard deviations of jitter allowed for in the
+                         safe frame rate, default 6
+        numBins        : int
+                         number of histogram bins, default 50
+    """
+    expectedPeriod = kwargs.get('expectedPeriod', None)
+    rearmTime = kwargs.get('rearmTime', 0)
+    numSigma = kwargs.get('numSigma', 6)
+    numBins = kwargs.get('numBins', 50)
+
+    times = np.asarray(times, dtype = 'float64')
+    if len(times) < 3:
+        return None
+
+    periods = np.diff(times)
+    nominal = expectedPeriod if expectedPeriod is not None else float(np.median(periods))
+
+    # Gaps of two or more periods are missed triggers (or dropped frames)
+    steps = np.maximum(np.round(periods / nominal), 1).astype(int)
+    deviations = periods - steps * nominal
+
+    # Deviation of each trigger from a regular clock fitted to all triggers
+    index = np.concatenate(([0], np.cumsum(steps)))
+    slope, intercept = np.polyfit(index, times, 1)
+    phase = times - (intercept + slope * index)
+
+    counts, edges = np.histogram(deviations, bins = numBins)
+
+    result = {'numTriggers': len(times),
+              'duration': float(times[-1] - times[0]),
+              'period': float(slope),
+              'frameRate': 1 / slope if slope > 0 else None,
+              'numMissed': int(np.sum(steps - 1)),
+              'jitter': float(np.std(deviations)),
+              'jitterPeakToPeak': float(np.ptp(deviations)),
+              'jitter999': float(np.percentile(np.abs(deviations), 99.9)),
+              'phaseJitter': float(np.std(phase)),
+              'phaseJitterMax': float(np.max(np.abs(phase))),
+              'minPeriod': float(np.min(periods)),
+              'maxPeriod': float(np.max(periods)),
+              'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()}}
+
+    if rampDuration is not None:
+        required = rampDuration + rearmTime
+        result['rampDuration'] = rampDuration
+        result['numTooShort'] = int(np.sum(periods < required))
+        result['minSlack'] = float(np.min(periods) - required)
+        result['safeFrameRate'] = 1 / (required + numSigma * result['jitter'])
+
+    return result
+
+
+def simulate_triggers(scanner, framePeriod, numTriggers, jitter = 0, seed = 0):
+    """ Sends 'numTriggers' camera strobes to a SimulatedScanner (which must
+    be scanning) every 'framePeriod' (s), with Gaussian 'jitter' (s) in the
+    time of each. Returns the times of all strobes sent, the scanner's
+    triggerTimes holds those which started a ramp.
+    """
+    rng = np.random.default_rng(seed)
+    times = np.arange(numTriggers) * framePeriod + rng.normal(0, jitter, numTriggers)
+    times = np.sort(times)
+    scanner.reset_timing()
+    for t in times:
+        scanner.trigger(t)
+    return times
+
+
+def load_trigger_times(filename):
+    """ Returns the frame timestamps saved with a recording, given the
+    recording folder (chunked format), the tif file or the CSV file. These
+    are the times frames were received by the software, so include
+    acquisition thread jitter as well as camera jitter.
+    """
+    from recorder import read_metadata_log
+
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, 'frames.csv')
+    elif not filename.lower().endswith('.csv'):
+        filename = os.path.splitext(filename)[0] + '.csv'
+    rows = read_metadata_log(filename)
+    return np.array([row['timestamp'] for row in rows if row.get('timestamp') not in (None, '')], dtype = 'float64')
+
+
+def timing_text(report):
+    """ Returns a scan_timing or analyse_trigger_times report as lines of
+    text, omitting the histogram.
+    """
+    lines = []
+    for key, value in report.items():
+        if key in ('errors', 'warnings', 'histogram'):
+            continue
+        if isinstance(value, float):
+            value = f"{value:.6g}"
+        lines.append(f"{key}: {value}")
+    for message in report.get('errors', []):
+        lines.append("Error: " + message)
+    for message in report.get('warnings', []):
+        lines.append("Warning: " + message)
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Check virtual slit scan timing and measure trigger jitter.")
+    parser.add_argument('--offset', type = float, default = 0, help = "scan offset (V)")
+    parser.add_argument('--speed', type = float, help = "scan speed (V/s)")
+    parser.add_argument('--range', type = float, help = "scan range (V)")
+    parser.add_argument('--sample-rate', type = float, default = 250000)
+    parser.add_argument('--line-rate', type = float, default = 130750.6)
+    parser.add_argument('--fps', type = float, help = "camera frame rate")
+    parser.add_argument('--exposure', type = float, help = "camera exposure (s)")
+    parser.add_argument('--rows', type = int, help = "camera rows")
+    parser.add_argument('--jitter', type = float, default = 0, help = "trigger jitter (s)")
+    parser.add_argument('--simulate', type = int, help = "number of triggers to send to a SimulatedScanner")
+    parser.add_argument('--recording', help = "analyse timestamps of a recording")
+    args = parser.parse_args()
+
+    failed = False
+    rampDuration = None
+
+    if args.speed is not None and args.range is not None:
+        import linescan_utilities
+
+        vals, nPoints = linescan_utilities.scan_waveform(args.offset, args.speed, args.range, False, 0, args.sample_rate)
+        report = scan_timing(nPoints, args.sample_rate, 1 / args.fps if args.fps else None,
+                             exposure = args.exposure, lineRate = args.line_rate, numRows = args.rows,
+                             scanRange = args.range, scanSpeed = args.speed, jitter = args.jitter)
+        print(timing_text(report))
+        failed = not report['ok']
+        rampDuration = report['rampDuration']
+
+        if args.simulate is not None and args.fps:
+            import scanners
+
+            scanner = scanners.SimulatedScanner()
+            scanner.start_scan(vals, nPoints, args.sample_rate)
+            simulate_triggers(scanner, 1 / args.fps, args.simulate, args.jitter)
+            print(f"\nSimulated {args.simulate} triggers, {scanner.numMissedTriggers} missed.")
+            analysis = analyse_trigger_times(scanner.triggerTimes, rampDuration, expectedPeriod = 1 / args.fps,
+                                             rearmTime = report['rearmTime'])
+            if analysis is not None:
+                print(timing_text(analysis))
+            failed = failed or scanner.numMissedTriggers > 0
+
+    if args.recording is not None:
+        analysis = analyse_trigger_times(load_trigger_times(args.recording), rampDuration)
+        if analysis is None:
+            print("Not enough timestamps in recording.")
+        else:
+            print(f"\nRecording {args.recording}:")
+            print(timing_text(analysis))
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Galvo scanner interfaces for virtual slit linescan endomicroscopy.
+
+GenericScanner defines the interface used by the Endomicroscope GUI.
+NIDAQScanner drives the galvo from a National Instruments DAQ, with the
+voltage ramp clocked by a counter which is retriggered by the camera strobe.
+SimulatedScanner models the same behaviour in software so that scanning
+and calibration can be tested without hardware, see also
+SimulatedLinescanCamera.
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import time
+import collections
+
+import numpy as np
+
+# nidaqmx is slow to import and only needed when scanning with an NI DAQ, so
+# it is imported by load_nidaqmx() when first used
+nidaqmx = None
+
+
+def load_nidaqmx():
+    """ Imports nidaqmx if it has not already been imported and returns the
+    module.
+    """
+    global nidaqmx
+    if nidaqmx is None:
+        import nidaqmx.stream_writers
+    return nidaqmx
+
+
+class GenericScanner:
+    """ Interface for galvo scanners. Other scanners should inherit from
+    this and implement the methods. numReconfigurations counts scans started
+    which needed the output to be set up again, numRewrites those which only
+    needed new voltages. rewriteTime is the time (s) the output was stopped
+    for the last rewrite, during which camera triggers get no ramp, and
+    numMissedTriggers counts triggers missed, if known.
+    """
+
+    numReconfigurations = 0
+    numRewrites = 0
+    rewriteTime = 0
+    numMissedTriggers = 0
+
+    def __init__(self, **kwargs):
+        pass
+
+    def start_scan(self, vals, nPoints, sampleRate):
+        """ Outputs the waveform 'vals' (V) at 'sampleRate' (Hz), 'nPoints'
+        samples for each camera trigger. If vals is longer than nPoints,
+        successive triggers continue through vals, wrapping round at the end.
+        """
+        pass
+
+    def set_voltage(self, volts):
+        """ Stops any scanning and holds the scanner at a fixed voltage.
+        """
+        pass
+
+    def stop(self):
+        """ Stops the scanner and releases any resources.
+        """
+        pass
+
+
+class NIDAQScanner(GenericScanner):
+    """ Galvo scanner driven by the analogue output of an NI DAQ. The AO is
+    clocked by a counter output, which is retriggered by the camera strobe.
+    If a scan is started with the same ramp length and sample rate as the
+    current scan, the existing tasks are kept and only the voltages
+    are rewritten. The tasks are committed when they are created, so they
+    only need to be stopped briefly for a rewrite. A camera trigger which
+    arrives while they are stopped gets no ramp.
+
+    Keyword Arguments:
+        aoChannel     : str
+                        analogue output channel, default "Dev1/ao0"
+        ctrChannel    : str
+                        counter channel used as AO clock, default "Dev1/ctr0"
+        triggerSource : str
+                        terminal with camera strobe, default "/Dev1/PFI0"
+        clockSource   : str
+                        internal output of the counter, default
+                        "/Dev1/Ctr0InternalOutput"
+    """
+
+    def __init__(self, **kwargs):
+
+        self.aoChannel = kwargs.get('aoChannel', "Dev1/ao0")
+        self.ctrChannel = kwargs.get('ctrChannel', "Dev1/ctr0")
+        self.triggerSource = kwargs.get('triggerSource', "/Dev1/PFI0")
+        self.clockSource = kwargs.get('clockSource', "/Dev1/Ctr0InternalOutput")
+
+        self.aoTask = None
+        self.ctrTask = None
+        self.holdTask = None
+        self.writer = None
+        self.scanConfig = None
+
+
+    def start_scan(self, vals, nPoints, sampleRate):
+
+        load_nidaqmx()
+        scanConfig = (nPoints, len(vals), sampleRate)
+
+        if scanConfig == self.scanConfig:
+
+            # Tasks are already configured for this ramp length, so
+            # we only need to replace the voltages. As the tasks are
+            # committed, stopping them returns them to the committed state
+            # rather than releasing the hardware, so restarting is quick.
+            t0 = time.perf_counter()
+            self.ctrTask.stop()
+            self.aoTask.stop()
+            self.writer.write_many_sample(vals)
+            self.numRewrites = self.numRewrites + 1
+
+        else:
+
+            t0 = None
+            self.stop()
+
+            self.aoTask = nidaqmx.Task()
+            self.ctrTask = nidaqmx.Task()
+
+            self.aoTask.ao_channels.add_ao_voltage_chan(self.aoChannel)
+
+            # Create a counter task that will be triggered by the camera
+            self.ctrTask.co_channels.add_co_pulse_chan_freq(self.ctrChannel, freq = sampleRate)
+            self.ctrTask.timing.cfg_implicit_timing(samps_per_chan = nPoints)
+            self.ctrTask.triggers.start_trigger.cfg_dig_edge_start_trig(self.triggerSource, trigger_edge = nidaqmx.constants.Edge.FALLING)
+            self.ctrTask.triggers.start_trigger.retriggerable = True
+
+            # Set the AO clock source to be the counter clock output so that it will be triggered by the camera
+            self.aoTask.timing.cfg_samp_clk_timing(sampleRate, sample_mode = nidaqmx.constants.AcquisitionType.CONTINUOUS, samps_per_chan = nPoints, source = self.clockSource)
+
+            self.writer = nidaqmx.stream_writers.AnalogSingleChannelWriter(self.aoTask.out_stream)
+
+            # Send voltage values
+            self.writer.write_many_sample(vals)
+
+            # Reserve and program the hardware now, so that later rewrites
+            # do not have to
+            self.aoTask.control(nidaqmx.constants.TaskMode.TASK_COMMIT)
+            self.ctrTask.control(nidaqmx.constants.TaskMode.TASK_COMMIT)
+
+            self.scanConfig = scanConfig
+            self.numReconfigurations = self.numReconfigurations + 1
+
+        # Make sure to start aotask first in case it misses some points
+        self.aoTask.start()
+        self.ctrTask.start()
+        if t0 is not None:
+            self.rewriteTime = time.perf_counter() - t0
+
+
+    def set_voltage(self, volts):
+
+        load_nidaqmx()
+        if self.holdTask is None:
+            self.stop()  # stops the current scanning
+            self.holdTask = nidaqmx.Task()
+            self.holdTask.ao_channels.add_ao_voltage_chan(self.aoChannel)
+        self.holdTask.write(volts)
+
+
+    def stop(self):
+
+        self.scanConfig = None
+
+        if self.aoTask is not None:
+            try:
+                self.aoTask.close()
+            except:
+                print("Could not close DAQ AO")
+            self.aoTask = None
+
+        if self.ctrTask is not None:
+            try:
+                self.ctrTask.close()
+            except:
+                print("Could not close DAQ Counter")
+            self.ctrTask = None
+
+        if self.holdTask is not None:
+            try:
+                self.holdTask.close()
+            except:
+                print("Could not close DAQ AO")
+            self.holdTask = None
+
+
+class SimulatedScanner(GenericScanner):
+    """ Software model of NIDAQScanner. Each call to trigger() simulates a
+    camera strobe, and returns the voltages output for that frame. As with
+    the retriggerable counter, a trigger which arrives while a ramp is still
+    being output is missed. Rewriting the voltages of a scan stops the
+    output for rewriteTime, as NIDAQScanner does, and triggers in that
+    time are also missed (counted in numRewriteMissedTriggers as well).
+    When holding a fixed voltage, the galvo approaches the new voltage
+    exponentially.
+
+    Keyword Arguments:
+        responseTime : float
+                       time constant of galvo response (s), default 0.002
+        rewriteTime  : float
+                       time output is stopped for a rewrite (s), default
+                       0.001
+        maxTriggers  : int
+                       number of recent trigger times to keep, default 10000
+    """
+
+    def __init__(self, **kwargs):
+
+        self.responseTime = kwargs.get('responseTime', 0.002)
+        self.rewriteTime = kwargs.get('rewriteTime', 0.001)
+        self.triggerTimes = collections.deque(maxlen = kwargs.get('maxTriggers', 10000))
+
+        self.vals = None
+        self.nPoints = 0
+        self.sampleRate = None
+        self.scanning = False
+        self.holdVolts = 0
+        self.startVolts = 0
+        self.changeTime = time.perf_counter()
+        self.reset_timing()
+
+
+    def start_scan(self, vals, nPoints, sampleRate):
+
+        if self.scanning and (nPoints, len(vals), sampleRate) == (self.nPoints, len(self.vals), self.sampleRate):
+            # The same scan continues, so trigger counts and times are kept
+            self.numRewrites = self.numRewrites + 1
+            self.restartTime = time.perf_counter() + self.rewriteTime
+        else:
+            self.numReconfigurations = self.numReconfigurations + 1
+            self.reset_timing()
+
+        self.vals = np.asarray(vals)
+        self.nPoints = nPoints
+        self.sampleRate = sampleRate
+        self.bufferPos = 0
+        self.scanning = True
+
+
+    def set_voltage(self, volts):
+
+        self.startVolts = self.get_voltage()
+        self.holdVolts = volts
+        self.changeTime = time.perf_counter()
+        self.scanning = False
+
+
+    def stop(self):
+
+        self.scanning = False
+
+
+    def get_voltage(self, t = None):
+        """ Returns the current voltage. If scanning, this is the last
+        voltage of the most recent ramp.
+        """
+        if self.scanning:
+            if self.lastRamp is None:
+                return self.vals[0]
+            return self.lastRamp[-1]
+
+        if t is None:
+            t = time.perf_counter()
+        settled = 1 - np.exp(-max(t - self.changeTime, 0) / self.responseTime)
+        return self.startVolts + (self.holdVolts - self.startVolts) * settled
+
+
+    def trigger(self, t = None):
+        """ Simulates a camera strobe at time t (default now). Returns the
+        voltages output for this trigger, or None if not scanning or if the
+        trigger was missed because the previous ramp was still being output.
+        """
+        if not self.scanning:
+            return None
+
+        if t is None:
+            t = time.perf_counter()
+
+        if self.restartTime is not None and t < self.restartTime:
+            self.numMissedTriggers = self.numMissedTriggers + 1
+            self.numRewriteMissedTriggers = self.numRewriteMissedTriggers + 1
+            return None
+
+        if self.lastTriggerTime is not None and t - self.lastTriggerTime < self.ramp_duration():
+            self.numMissedTriggers = self.numMissedTriggers + 1
+            return None
+
+        self.numTriggers = self.numTriggers + 1
+        self.lastTriggerTime = t
+        self.triggerTimes.append(t)
+
+        ramp = self.vals[self.bufferPos:self.bufferPos + self.nPoints]
+        self.bufferPos = (self.bufferPos + self.nPoints) % len(self.vals)
+        self.lastRamp = ramp
+
+        return ramp
+
+
+    def ramp_duration(self):
+        """ Returns the time (s) taken to output the ramp for one trigger.
+        """
+        if self.sampleRate is None:
+            return 0
+        return self.nPoints / self.sampleRate
+
+
+    def reset_timing(self):
+        """ Clears trigger counts and times.
+        """
+        self.numTriggers = 0
+        self.numMissedTriggers = 0
+        self.numRewriteMissedTriggers = 0
+        self.restartTime = None
+        self.lastTriggerTime = None
+        self.lastRamp = None
+        self.triggerTimes.clear()
+
+
+    def get_timing(self):
+        """ Returns a dictionary describing the timing of the current scan.
+        """
+        return {'sampleRate': self.sampleRate,
+                'nPoints': self.nPoints,
+                'rampDuration': self.ramp_duration(),
+                'numTriggers': self.numTriggers,
+                'numMissedTriggers': self.numMissedTriggers,
+                'numRewriteMissedTriggers': self.numRewriteMissedTriggers}
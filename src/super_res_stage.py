@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Real-time multi-frame super-resolution using pybundle SuperRes.
+
+SuperResStage collects sets of 'numShifts' consecutive raw frames, each
+with the bundle shifted by a known amount relative to the camera, and
+reconstructs each complete set on a pool of worker threads or processes
+using SuperRes.recon_multi_tri_interp, so that reconstruction of one set
+overlaps with acquisition of the next. Frames are copied into preallocated
+stacks as they are added, so frames which are views onto the acquisition
+ring buffer can be released straight away. If all stacks are busy the
+next set is dropped and counted rather than blocking acquisition.
+
+The SuperRes calibration is slow (seconds), so it is only performed when
+its inputs change. Each calibration is tagged with a hash of its inputs,
+and calibrate() reuses the current calibration, or one saved in a
+calibration_store.CalibrationStore, if the hash matches.
+
+Frame numbers (from 1) are used to place each frame in its set, so the
+first frame of each set is the one where (frameNumber - syncPhase) is a
+multiple of numShifts, and sets with missing frames are discarded.
+
+Example:
+
+    stage = SuperResStage(4, numWorkers = 2)
+    stage.calibrate(background, 3, 512, shifts = shifts, background = background)
+    stage.start()
+    for frameNumber, frame in enumerate(frames, 1):
+        stage.add(frame, frameNumber)
+        image, setNumber = stage.get_result()
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import time
+import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+
+def calibration_hash(*args, **kwargs):
+    """ Returns a SHA-256 hash of the arguments, which may be numpy arrays,
+    numbers, strings, booleans or None, to identify a calibration.
+    """
+    h = hashlib.sha256()
+    items = [(str(idx), value) for idx, value in enumerate(args)] + sorted(kwargs.items())
+    for name, value in items:
+        h.update(name.encode())
+        if isinstance(value, np.ndarray):
+            arr = np.ascontiguousarray(value)
+            h.update(str(arr.dtype).encode())
+            h.update(str(arr.shape).encode())
+            h.update(arr.data if arr.size > 0 else b'')
+        else:
+            h.update(repr(value).encode())
+    return h.hexdigest()
+
+
+# Calibration held by each worker process, set when the pool is created so
+# that it is not sent with every set
+_workerCalibration = None
+
+
+def _init_worker(calibration):
+
+    global _workerCalibration
+    _workerCalibration = calibration
+
+
+def _reconstruct(stack, calibration = None, numba = True):
+    # Reconstructs a (height, width, numShifts) stack, returns the image and
+    # the reconstruction time
+    from pybundle import SuperRes
+
+    t0 = time.perf_counter()
+    if calibration is None:
+        calibration = _workerCalibration
+    image = SuperRes.recon_multi_tri_interp(stack, calibration, numba = numba)
+    return image, time.perf_counter() - t0
+
+
+class SuperResStage:
+    """ Collects and reconstructs sets of shifted frames.
+
+    Arguments:
+        numShifts    : int
+                       number of shifted frames in each set
+
+    Keyword Arguments:
+        numWorkers   : int
+                       number of sets reconstructed at once, default 2
+        useProcesses : boolean
+                       if True, reconstruct on a pool of processes, otherwise
+                       (default) a pool of threads
+        maxPending   : int
+                       maximum number of sets being reconstructed or waiting,
+                       further sets are dropped, default numWorkers + 1
+        syncPhase    : int
+                       frame number of the first frame of a set (modulo
+                       numShifts), default 1
+        useNumba     : boolean
+                       use pybundle's numba reconstruction, default True
+        maxResults   : int
+                       reconstructed images kept until collected by
+                       get_result(), older ones are discarded, default 4
+    """
+
+    def __init__(self, numShifts, **kwargs):
+
+        self.numShifts = int(numShifts)
+        self.numWorkers = kwargs.get('numWorkers', 2)
+        self.useProcesses = kwargs.get('useProcesses', False)
+        self.maxPending = kwargs.get('maxPending', self.numWorkers + 1)
+        self.syncPhase = kwargs.get('syncPhase', 1)
+        self.useNumba = kwargs.get('useNumba', True)
+        self.maxResults = kwargs.get('maxResults', 4)
+
+        self.calibration = None
+        self.calibrationTime = None
+        self.numCalibrations = 0
+        self.numCacheHits = 0
+
+        self.pool = None
+        self.freeStacks = []
+        self.pending = collections.deque()
+        self.results = collections.deque()
+        self.completionTimes = collections.deque(maxlen = 50)
+        self.reset()
+
+
+    def reset(self):
+        """ Discards any partly collected set and resets the counters.
+        """
+        self.current = None
+        self.filled = 0
+        self.lastFrameNumber = None
+        self.numFramesAdded = 0
+
+        self.numSets = 0
+        self.numReconstructed = 0
+        self.numDroppedSets = 0
+        self.numIncompleteSets = 0
+        self.numDiscardedResults = 0
+        self.numErrors = 0
+        self.totalReconTime = 0
+        self.totalLatency = 0
+        self.completionTimes.clear()
+
+
+    ##### Calibration
+
+    def calibrate(self, calibImage, coreSize, gridSize, store = None, key = None, **kwargs):
+        """ Performs the SuperRes calibration (calib_multi_tri_interp) unless
+        the current calibration, or one stored in 'store' (a
+        calibration_store.CalibrationStore) under 'key', was made from the
+        same inputs. Give either the known 'shifts' (numShifts, 2) or a set of
+        'calibImages' (height, width, numShifts) from which they are found.
+        Other keyword arguments (e.g. background, normalise, normToImage)
+        are passed to calib_multi_tri_interp. Returns True if a new
+        calibration was made.
+        """
+        inputHash = calibration_hash(calibImage, coreSize = coreSize, gridSize = gridSize, **kwargs)
+
+        if self.calibration is not None and getattr(self.calibration, 'inputHash', None) == inputHash:
+            self.numCacheHits = self.numCacheHits + 1
+            return False
+
+        if store is not None and key is not None:
+            try:
+                record = store.load(key) or {}
+            except ValueError as e:
+                print(f"Stored super-resolution calibration not used: {e}")
+                record = {}
+            stored = record.get('superResCalibration')
+            if stored is not None and getattr(stored, 'inputHash', None) == inputHash:
+                self.set_calibration(stored)
+                self.numCacheHits = self.numCacheHits + 1
+                return False
+
+        from pybundle import SuperRes
+
+        calibImages = kwargs.pop('calibImages', None)
+        t0 = time.perf_counter()
+        calibration = SuperRes.calib_multi_tri_interp(calibImage, calibImages, coreSize, gridSize, **kwargs)
+        self.calibrationTime = time.perf_counter() - t0
+        calibration.inputHash = inputHash
+        self.set_calibration(calibration)
+        self.numCalibrations = self.numCalibrations + 1
+
+        if store is not None and key is not None:
+            store.save(key, superResCalibration = calibration)
+        return True
+
+
+    def set_calibration(self, calibration):
+        """ Uses an existing SuperRes calibration. Raises ValueError if it
+        is for a different number of shifts.
+        """
+        if calibration.nShifts != self.numShifts:
+            raise ValueError(f"Calibration is for {calibration.nShifts} shifts, not {self.numShifts}.")
+        self.calibration = calibration
+
+        # Worker processes hold their own copy of the calibration
+        if self.useProcesses and self.pool is not None:
+            self.stop()
+            self.start()
+
+
+    ##### Reconstruction
+
+    def start(self):
+        """ Creates the pool of workers.
+        """
+        if self.pool is not None:
+            return
+        if self.useProcesses:
+            self.pool = ProcessPoolExecutor(self.numWorkers, initializer = _init_worker,
+                                            initargs = (self.calibration,))
+        else:
+            self.pool = ThreadPoolExecutor(self.numWorkers)
+
+
+    def stop(self, wait = True):
+        """ Shuts down the pool of workers, waiting for sets being
+        reconstructed if 'wait' is True, and collects their results.
+        """
+        if self.pool is None:
+            return
+        self.pool.shutdown(wait = wait, cancel_futures = not wait)
+        self.pool = None
+        self._collect()
+        self.pending.clear()
+
+
+    def _get_stack(self, frame):
+        # Returns a free stack for frames like 'frame', or None if all are busy
+        if len(self.pending) >= self.maxPending:
+            return None
+        shape = (self.numShifts,) + np.shape(frame)
+        self.freeStacks = [stack for stack in self.freeStacks if stack.shape == shape and stack.dtype == frame.dtype]
+        if len(self.freeStacks) > 0:
+            return self.freeStacks.pop()
+        return np.empty(shape, dtype = frame.dtype)
+
+
+    def add(self, frame, frameNumber = None):
+        """ Adds a raw frame. 'frameNumber' (from 1) is the camera frame
+        number, if None frames are numbered in the order they are added. The
+        frame is copied, so may be reused by the caller. Returns True if the
+        frame completed a set, which was sent for reconstruction.
+        """
+        self._collect()
+        self.numFramesAdded = self.numFramesAdded + 1
+        if frameNumber is None:
+            frameNumber = self.numFramesAdded
+
+        if self.lastFrameNumber is not None and frameNumber != self.lastFrameNumber + 1 and self.filled > 0:
+            self._discard_current()
+        self.lastFrameNumber = frameNumber
+
+        idx = (frameNumber - self.syncPhase) % self.numShifts
+        if idx == 0:
+            if self.filled > 0:
+                self._discard_current()
+            self.current = self._get_stack(frame)
+            if self.current is None:
+                self.numDroppedSets = self.numDroppedSets + 1
+                return False
+            self.firstFrameNumber = frameNumber
+        elif self.current is None or self.filled != idx:
+            return False
+
+        self.current[idx] = frame
+        self.filled = self.filled + 1
+
+        if self.filled < self.numShifts:
+            return False
+
+        self._submit(self.current)
+        self.current = None
+        self.filled = 0
+        return True
+
+
+    def _discard_current(self):
+
+        if self.current is not None:
+            self.freeStacks.append(self.current)
+        self.current = None
+        self.filled = 0
+        self.numIncompleteSets = self.numIncompleteSets + 1
+
+
+    def _submit(self, stack):
+
+        if self.calibration is None:
+            self.freeStacks.append(stack)
+            self.numDroppedSets = self.numDroppedSets + 1
+            return
+        self.start()
+
+        # pybundle expects frames along the last axis
+        frames = np.moveaxis(stack, 0, -1)
+        if self.useProcesses:
+            future = self.pool.submit(_reconstruct, frames, None, self.useNumba)
+        else:
+            future = self.pool.submit(_reconstruct, frames, self.calibration, self.useNumba)
+        self.numSets = self.numSets + 1
+        self.pending.append((self.numSets, self.firstFrameNumber, future, stack, time.perf_counter()))
+
+
+    def _collect(self):
+        # Moves completed reconstructions, in order, to results
+        while len(self.pending) > 0 and self.pending[0][2].done():
+            setNumber, firstFrameNumber, future, stack, tSubmit = self.pending.popleft()
+            self.freeStacks.append(stack)
+            try:
+                image, reconTime = future.result()
+            except Exception as e:
+                print(f"Super-resolution error: {e}")
+                self.numErrors = self.numErrors + 1
+                continue
+            now = time.perf_counter()
+            self.numReconstructed = self.numReconstructed + 1
+            self.totalReconTime = self.totalReconTime + reconTime
+            self.totalLatency = self.totalLatency + now - tSubmit
+            self.completionTimes.append(now)
+            self.results.append((image, setNumber))
+            if len(self.results) > self.maxResults:
+                self.results.popleft()
+                self.numDiscardedResults = self.numDiscardedResults + 1
+
+
+    def get_result(self):
+        """ Returns (image, setNumber) for the oldest reconstruction not yet
+        returned, or (None, None) if there is none.
+        """
+        self._collect()
+        if len(self.results) == 0:
+            return None, None
+        return self.results.popleft()
+
+
+    def get_latest_result(self):
+        """ Returns (image, setNumber) for the newest reconstruction not yet
+        returned, discarding any older ones, or (None, None) if there is none.
+        """
+        self._collect()
+        if len(self.results) == 0:
+            return None, None
+        result = self.results.pop()
+        self.numDiscardedResults = self.numDiscardedResults + len(self.results)
+        self.results.clear()
+        return result
+
+
+    def wait(self, timeout = None):
+        """ Waits for all sets sent for reconstruction to finish.
+        """
+        tEnd = None if timeout is None else time.perf_counter() + timeout
+        while len(self.pending) > 0:
+            remaining = None if tEnd is None else max(tEnd - time.perf_counter(), 0)
+            try:
+                self.pending[0][2].result(timeout = remaining)
+            except Exception:
+                pass
+            self._collect()
+            if tEnd is not None and time.perf_counter() >= tEnd:
+                break
+
+
+    def get_output_rate(self):
+        """ Returns the rate (sets/s) at which recent sets have been
+        reconstructed, or 0 if fewer than two have been.
+        """
+        if len(self.completionTimes) < 2:
+            return 0
+        span = self.completionTimes[-1] - self.completionTimes[0]
+        return (len(self.completionTimes) - 1) / span if span > 0 else 0
+
+
+    def get_stats(self):
+        """ Returns a dictionary of set counts, the output rate (sets/s), and
+        the mean reconstruction time and latency (s).
+        """
+        n = self.numReconstructed
+        return {'numSets': self.numSets,
+                'numReconstructed': n,
+                'numDroppedSets': self.numDroppedSets,
+                'numIncompleteSets': self.numIncompleteSets,
+                'numDiscardedResults': self.numDiscardedResults,
+                'numErrors': self.numErrors,
+                'numPending': len(self.pending),
+                'outputRate': self.get_output_rate(),
+                'meanReconTime': self.totalReconTime / n if n > 0 else None,
+                'meanLatency': self.totalLatency / n if n > 0 else None,
+                'calibrationTime': self.calibrationTime,
+                'numCalibrations': self.numCalibrations,
+                'numCacheHits': self.numCacheHits}
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped frame source for uncompressed TIFF stacks.
+
+TiffFrameSource maps a TIFF file into memory and returns each page as a
+read-only numpy array which is a view onto the mapped file, so frames are
+not copied and only the pages being used are held in memory, however large
+the file. Upcoming frames are prefetched so that playback is not held up
+by disk reads. Both classic TIFF and BigTIFF are supported, but pages must
+be uncompressed, single channel, and stored in strips.
+
+@author: Mike Hughes, Applied Optics Group, University of Kent
+"""
+
+import mmap
+import struct
+import threading
+
+import numpy as np
+
+
+# TIFF tags used
+WIDTH = 256
+LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+STRIP_BYTE_COUNTS = 279
+TILE_WIDTH = 322
+SAMPLE_FORMAT = 339
+
+USED_TAGS = {WIDTH, LENGTH, BITS_PER_SAMPLE, COMPRESSION, STRIP_OFFSETS, SAMPLES_PER_PIXEL,
+             STRIP_BYTE_COUNTS, TILE_WIDTH, SAMPLE_FORMAT}
+
+# Sizes and struct formats of TIFF field types
+FIELD_TYPES = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 16: 'Q', 17: 'q'}
+
+SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+class TiffFrameSource:
+    """ Memory-mapped access to the frames of an uncompressed TIFF stack.
+    Raises ValueError if the file cannot be mapped, e.g. if it is
+    compressed, in which case another reader should be used.
+
+    Arguments:
+        filename  : str
+                    TIFF file
+
+    Keyword Arguments:
+        prefetch  : int
+                    number of frames ahead to prefetch, default 4
+        loop      : bool
+                    if True (default), get_next_frame returns to the first
+                    frame after the last
+    """
+
+    def __init__(self, filename, prefetch = 4, loop = True):
+
+        self.filename = filename
+        self.prefetch = prefetch
+        self.loop = loop
+        self.currentFrame = 0
+
+        self.file = open(filename, 'rb')
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+            self.pages = self._read_pages()
+        except:
+            self.file.close()
+            raise
+
+        if len(self.pages) == 0:
+            self.close()
+            raise ValueError("TIFF file contains no pages.")
+
+        # Pages whose strips are not contiguous cannot be viewed directly
+        self.contiguous = all(len(page[0]) == 1 for page in self.pages)
+
+        self.shape = self.pages[0][1]
+        self.dtype = self.pages[0][2]
+        self.n_frames = len(self.pages)
+
+        self.useMadvise = hasattr(self.mm, 'madvise') and hasattr(mmap, 'MADV_WILLNEED')
+        self.prefetchThread = None
+        self.prefetchEvent = threading.Event()
+        self.prefetchFrom = 0
+        self.closed = False
+
+
+    def _read_pages(self):
+        """ Walks the chain of IFDs and returns a list of (strips, shape, dtype)
+        for each page, where strips is a list of (offset, byte count).
+        """
+        mm = self.mm
+        byteOrder = mm[0:2]
+        if byteOrder == b'II':
+            self.endian = '<'
+        elif byteOrder == b'MM':
+            self.endian = '>'
+        else:
+            raise ValueError("Not a TIFF file.")
+        e = self.endian
+
+        version = struct.unpack(e + 'H', mm[2:4])[0]
+        if version == 42:
+            offsetFormat, countFormat, entryFormat, entrySize, valueSize = 'I', 'H', 'HHI', 12, 4
+            ifdOffset = struct.unpack(e + 'I', mm[4:8])[0]
+        elif version == 43:
+            offsetFormat, countFormat, entryFormat, entrySize, valueSize = 'Q', 'Q', 'HHQ', 20, 8
+            ifdOffset = struct.unpack(e + 'Q', mm[8:16])[0]
+        else:
+            raise ValueError("Not a TIFF file.")
+
+        countSize = struct.calcsize(e + countFormat)
+        headerSize = struct.calcsize(e + entryFormat)
+
+        pages = []
+        while ifdOffset != 0:
+            numEntries = struct.unpack_from(e + countFormat, mm, ifdOffset)[0]
+            tags = {}
+            for idx in range(numEntries):
+                entryOffset = ifdOffset + countSize + idx * entrySize
+                tag, fieldType, count = struct.unpack_from(e + entryFormat, mm, entryOffset)
+                if tag not in USED_TAGS or fieldType not in FIELD_TYPES:
+                    continue
+                fmt = FIELD_TYPES[fieldType]
+                size = struct.calcsize(fmt) * count
+                if size <= valueSize:
+                    valueOffset = entryOffset + headerSize
+                else:
+                    valueOffset = struct.unpack_from(e + offsetFormat, mm, entryOffset + headerSize)[0]
+                tags[tag] = struct.unpack_from(e + fmt * count, mm, valueOffset)
+
+            pages.append(self._parse_page(tags))
+            ifdOffset = struct.unpack_from(e + offsetFormat, mm, ifdOffset + countSize + numEntries * entrySize)[0]
+
+        return pages
+
+
+    def _parse_page(self, tags):
+
+        if tags.get(COMPRESSION, (1,))[0] != 1:
+            raise ValueError("TIFF is compressed.")
+        if TILE_WIDTH in tags:
+            raise ValueError("Tiled TIFF is not supported.")
+        if tags.get(SAMPLES_PER_PIXEL, (1,))[0] != 1:
+            raise ValueError("Only single channel TIFF is supported.")
+
+        bits = tags.get(BITS_PER_SAMPLE, (1,))[0]
+        sampleFormat = SAMPLE_FORMATS.get(tags.get(SAMPLE_FORMAT, (1,))[0])
+        if bits % 8 != 0 or sampleFormat is None:
+            raise ValueError("Unsupported TIFF pixel format.")
+        dtype = np.dtype(self.endian + sampleFormat + str(bits // 8))
+
+        shape = (tags[LENGTH][0], tags[WIDTH][0])
+        strips = list(zip(tags[STRIP_OFFSETS], tags[STRIP_BYTE_COUNTS]))
+
+        # Merge strips which follow on from each other in the file
+        merged = [list(strips[0])]
+        for offset, count in strips[1:]:
+            if offset == merged[-1][0] + merged[-1][1]:
+                merged[-1][1] = merged[-1][1] + count
+            else:
+                merged.append([offset, count])
+
+        return [tuple(strip) for strip in merged], shape, dtype
+
+
+    def get_frame(self, idx):
+        """ Returns frame 'idx' as a read-only 2D numpy array. If the page is
+        stored contiguously, this is a view onto the mapped file, otherwise
+        a copy.
+        """
+        strips, shape, dtype = self.pages[idx]
+        numPixels = shape[0] * shape[1]
+
+        if len(strips) == 1:
+            frame = np.frombuffer(self.mm, dtype = dtype, count = numPixels, offset = strips[0][0])
+        else:
+            data = b''.join(self.mm[offset:offset + count] for offset, count in strips)
+            frame = np.frombuffer(data, dtype = dtype, count = numPixels)
+
+        self.prefetch_from(idx + 1)
+
+        return frame.reshape(shape)
+
+
+    def get_next_frame(self):
+        """ Returns the next frame, or None if we have reached the end and
+        are not looping.
+        """
+        if self.currentFrame >= self.n_frames:
+            if not self.loop:
+                return None
+            self.currentFrame = 0
+        frame = self.get_frame(self.currentFrame)
+        self.currentFrame = self.currentFrame + 1
+        return frame
+
+
+    def seek(self, idx):
+        """ Sets the frame that will be returned by get_next_frame.
+        """
+        self.currentFrame = idx
+
+
+    def prefetch_from(self, idx):
+        """ Requests that the 'prefetch' frames from frame 'idx' onwards are
+        read into memory in advance.
+        """
+        if self.prefetch <= 0 or self.closed:
+            return
+
+        if self.useMadvise:
+            for i in range(idx, idx + self.prefetch):
+                if self.loop:
+                    i = i % self.n_frames
+                elif i >= self.n_frames:
+                    break
+                for offset, count in self.pages[i][0]:
+                    start = offset - offset % mmap.PAGESIZE
+                    self.mm.madvise(mmap.MADV_WILLNEED, start, offset + count - start)
+        else:
+
+            # Touch the pages in a background thread instead
+            self.prefetchFrom = idx
+            self.prefetchEvent.set()
+            if self.prefetchThread is None:
+                self.prefetchThread = threading.Thread(target = self._prefetch_loop, daemon = True)
+                self.prefetchThread.start()
+
+
+    def _prefetch_loop(self):
+
+        while not self.closed:
+            self.prefetchEvent.wait()
+            self.prefetchEvent.clear()
+            for i in range(self.prefetchFrom, self.prefetchFrom + self.prefetch):
+                if self.closed or self.prefetchEvent.is_set():
+                    break
+                if self.loop:
+                    i = i % self.n_frames
+                elif i >= self.n_frames:
+                    break
+                for offset, count in self.pages[i][0]:
+                    self.mm[offset:offset + count:mmap.PAGESIZE]
+
+
+    def close(self):
+        """ Closes the file. Any frames still referenced remain valid until
+        they are released.
+        """
+        self.closed = True
+        self.prefetchEvent.set()
+        try:
+            self.mm.close()
+        except BufferError:
+            pass
+        self.file.close()
+
+
+    def __len__(self):
+        return self.n_frames
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()